@@ -0,0 +1,189 @@
+# batch_runner.py
+# Batch mode for the DreamSprout CLI: generate many stories from a JSONL file.
+# Each line is one dream:
+#   {"dream": "...", "elements": ["fox", "moon"] or "fox, moon",
+#    "quality": "draft", "model": "mistral", "id": "..."}   (all but dream optional)
+# The image model is loaded once and shared. A few items run at once, so the
+# text stages of upcoming dreams overlap the image stage of the current one,
+# which holds the device slot. Identical entries run once. A "started" line
+# with its run folder is appended to the results file when an item starts,
+# and a result line when it finishes. Rerunning the batch skips items already
+# done and continues the ones that were running in their own run folders,
+# from their checkpoints, so an interrupted batch resumes where it left off.
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from cache import ContentCache
+from checkpoint import RunCheckpoint
+from config import CONFIG, QUALITY_PRESETS
+from dreamsprout import create_run_dir
+from model_registry import ModelRegistry, preload_image_models
+from run_index import get_run_index, write_static_index
+
+
+# Yield (line number, entry) for each non-blank line; entry is None if it isn't a dream
+def read_batch(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                yield line_no, None
+                continue
+            if isinstance(entry, dict) and isinstance(entry.get("dream"), str) and entry["dream"].strip():
+                yield line_no, entry
+            else:
+                yield line_no, None
+
+
+# Fill in defaults so equivalent entries compare equal
+def normalize_entry(entry: dict, quality: str = None) -> dict:
+    elements = entry.get("elements", [])
+    if isinstance(elements, str):
+        elements = elements.split(",")
+    return {
+        "id": entry.get("id"),
+        "dream": " ".join(entry["dream"].split()),
+        "elements": [e.strip() for e in elements if e.strip()],
+        "quality": entry.get("quality") or quality or CONFIG["image_model"]["quality"],
+        "model": entry.get("model") or CONFIG["text_model"]["name"]
+    }
+
+# Identity of an item for deduplication and resume (the id label is not part of it)
+def batch_key(item: dict) -> str:
+    return ContentCache.make_key("batch", item["dream"], item["elements"], item["quality"], item["model"])[:16]
+
+
+# What the results file already records: keys of items done (or invalid
+# lines), and the last run folder of each item that was started
+def load_results(results_path: str):
+    completed, run_ids = set(), {}
+    if not os.path.exists(results_path):
+        return completed, run_ids
+    with open(results_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by a crash
+            if result.get("status") in ("done", "invalid"):
+                completed.add(result["key"])
+            if result.get("run_id"):
+                run_ids[result["key"]] = result["run_id"]
+    return completed, run_ids
+
+
+def run_batch(batch_path: str, results_path: str = None, lookahead: int = 2, quality: str = None) -> dict:
+    """Run every new item in batch_path; returns counts by outcome."""
+    results_path = results_path or f"{os.path.splitext(batch_path)[0]}.results.jsonl"
+    completed, run_ids = load_results(results_path)
+    output_root = CONFIG["pipeline"]["output_dir"]
+    counts = {"done": 0, "failed": 0, "invalid": 0, "duplicate": 0, "already_done": 0}
+    device_slot = threading.Semaphore(CONFIG["scheduler"]["device_slots"])
+    seen = set()
+    running = {}
+
+    print(f"\n--- Batch {batch_path}: {len(completed)} items already done, results in {results_path} ---")
+    preload_image_models()
+    with open(results_path, "a", encoding="utf-8") as results, \
+            ThreadPoolExecutor(max_workers=lookahead, thread_name_prefix="dreamsprout-batch") as pool:
+        for line_no, entry in read_batch(batch_path):
+            if entry is None:
+                if f"line-{line_no}" not in completed:
+                    _write_result(results, {"key": f"line-{line_no}", "line": line_no, "status": "invalid"})
+                    counts["invalid"] += 1
+                continue
+            item = normalize_entry(entry, quality)
+            if item["quality"] not in QUALITY_PRESETS:
+                if f"line-{line_no}" not in completed:
+                    _write_result(results, {"key": f"line-{line_no}", "line": line_no, "status": "invalid",
+                                            "error": f"Unknown quality {item['quality']!r}"})
+                    counts["invalid"] += 1
+                continue
+            key = batch_key(item)
+            if key in completed:
+                counts["already_done"] += 1
+                continue
+            if key in seen:
+                counts["duplicate"] += 1
+                continue
+            seen.add(key)
+
+            # Keep at most lookahead items in flight; read further only as they finish
+            while len(running) >= lookahead:
+                _collect(running, results, counts)
+            checkpoint = _start_item(item, results_path, output_root, run_ids.get(key))
+            _write_result(results, {"key": key, "line": line_no, "id": item["id"], "status": "started",
+                                    "run_id": checkpoint.get("run_id")})
+            running[pool.submit(_run_item, item, checkpoint, device_slot)] = (key, line_no, item)
+        while running:
+            _collect(running, results, counts)
+
+    write_static_index(get_run_index(), output_root)
+    return counts
+
+
+# Checkpoint to run an item from: its earlier run folder's, if it has one,
+# else a new run folder's. Batch checkpoints name their results file, so the
+# web app's resume on start leaves them to the batch (see find_orphaned_runs).
+def _start_item(item, results_path, output_root, run_id=None):
+    if run_id is not None:
+        checkpoint = RunCheckpoint.load(os.path.join(output_root, run_id))
+        if checkpoint is not None:
+            print(f"\n--- Batch: continuing {run_id} after stage {checkpoint.get('stage')} ---")
+            return checkpoint
+    _, output_dir, timestamp = create_run_dir(output_root)
+    return RunCheckpoint.create(
+        output_dir, dream=item["dream"], elements=item["elements"], text_model=item["model"],
+        quality=item["quality"], timestamp=timestamp, image_model=CONFIG["image_model"]["model_id"],
+        batch=os.path.abspath(results_path)
+    )
+
+
+def _run_item(item, checkpoint, device_slot):
+    # Imported here because pipeline_engine builds on dreamsprout
+    from pipeline_engine import StoryPipeline
+    start = time.perf_counter()
+    run_id = checkpoint.get("run_id")
+    try:
+        with ModelRegistry() as registry:
+            pipeline = StoryPipeline(
+                registry, item["model"], device_slot=lambda: device_slot, quality=item["quality"]
+            )
+            result = pipeline.run(item["dream"], item["elements"], checkpoint.output_dir,
+                                  checkpoint.get("timestamp"), checkpoint=checkpoint)
+    except Exception as e:
+        return {"status": "failed", "run_id": run_id, "error": str(e), "seconds": round(time.perf_counter() - start, 3)}
+    return {
+        "status": "done",
+        "run_id": run_id,
+        "html": result["html"],
+        "images": result["images"],
+        "seconds": round(time.perf_counter() - start, 3)
+    }
+
+
+# Wait for the next item to finish and append its result line
+def _collect(running, results, counts):
+    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+    for future in finished:
+        key, line_no, item = running.pop(future)
+        result = {"key": key, "line": line_no, "id": item["id"], "dream": item["dream"]}
+        result.update(future.result())
+        _write_result(results, result)
+        counts[result["status"]] += 1
+        print(f"\n--- Batch item {line_no} {result['status']} ({result['seconds']}s) ---")
+
+
+# Results must survive a crash, so each line is flushed to disk as it is written
+def _write_result(results, result: dict):
+    results.write(json.dumps(result) + "\n")
+    results.flush()
+    os.fsync(results.fileno())
@@ -0,0 +1,188 @@
+# cache.py
+# Disk-backed, content-addressed cache for LLM responses and rendered images.
+# Entries are keyed by a hash of everything that determines the output, written
+# atomically, and evicted least-recently-used once the cache exceeds its size.
+# Identical requests that arrive while one is already computing wait for it
+# instead of computing the same thing twice.
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from config import CONFIG
+
+
+class ContentCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self._total_bytes = 0
+        self._inflight = {}  # key -> threading.Event set when the leader finishes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """Hash the JSON form of parts into a hex key."""
+        blob = json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+        return hashlib.sha256(blob).hexdigest()
+
+    # --- Lookup with in-flight coalescing ---
+    def begin(self, key: str):
+        """Start a lookup for key.
+
+        Returns ("hit", data) if cached, ("wait", event) if another caller is
+        already computing it, or ("lead", None) if this caller must compute it
+        and then call finish(key, data).
+        """
+        with self._lock:
+            if key in self._entries:
+                data = self._read(key)
+                if data is not None:
+                    self.hits += 1
+                    return "hit", data
+            if key in self._inflight:
+                self.coalesced += 1
+                return "wait", self._inflight[key]
+            self.misses += 1
+            self._inflight[key] = threading.Event()
+            return "lead", None
+
+    def finish(self, key: str, data: bytes = None):
+        """Store the leader's result (None on failure) and wake any waiters."""
+        if data is not None:
+            self.put(key, data)
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def wait(self, key: str, event: threading.Event):
+        """Wait for the leader of key; returns its data, or None if it failed."""
+        event.wait()
+        with self._lock:
+            return self._read(key) if key in self._entries else None
+
+    def get_or_compute(self, key: str, compute) -> bytes:
+        """Return cached bytes for key, or compute(), store and return them."""
+        while True:
+            state, value = self.begin(key)
+            if state == "hit":
+                return value
+            if state == "wait":
+                data = self.wait(key, value)
+                if data is not None:
+                    return data
+                continue  # the leader failed; try to become the leader ourselves
+            data = None
+            try:
+                data = compute()
+                return data
+            finally:
+                self.finish(key, data)
+
+    # --- Storage ---
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._total_bytes -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions
+            }
+
+    def _read(self, key):
+        # Caller holds the lock
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._total_bytes -= self._entries.pop(key, 0)
+            return None
+        self._entries.move_to_end(key)
+        os.utime(self._path(key))
+        return data
+
+    def _evict(self):
+        # Caller holds the lock
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    # Rebuild the LRU order from file modification times after a restart
+    def _load_index(self):
+        found = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"):
+                    os.remove(entry.path)
+                    continue
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        with self._lock:
+            self._evict()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+# Shared cache instances ("text" or "image"), or None when caching is disabled
+def get_cache(kind: str):
+    settings = CONFIG["cache"]
+    if not settings["enabled"] or not settings[kind]["enabled"]:
+        return None
+    with _caches_lock:
+        if kind not in _caches:
+            _caches[kind] = ContentCache(
+                os.path.join(settings["dir"], kind),
+                settings[kind]["max_bytes"]
+            )
+        return _caches[kind]
+
+
+# Hit/miss counters for every cache created so far
+def cache_stats() -> dict:
+    with _caches_lock:
+        return {kind: cache.stats() for kind, cache in _caches.items()}
@@ -0,0 +1,156 @@
+# checkpoint.py
+# Crash-resumable runs. Each run folder keeps a state.json with the run's
+# inputs, its latest progress and every finished stage's artifacts: the
+# story, the scene split, each scene's image prompt and each scene's saved
+# images. A resumed run skips whatever is recorded. The story's Ollama context
+# (thousands of token ids) is written once to its own file rather than with
+# every progress update.
+
+import json
+import os
+import threading
+import time
+import uuid
+
+STATE_FILE = "state.json"
+CONTEXT_FILE = "story_context.json"
+# Tells this process apart from an earlier one that had the same PID (e.g. after a container restart)
+PROCESS_TOKEN = uuid.uuid4().hex
+
+
+class RunCheckpoint:
+    def __init__(self, output_dir: str, state: dict):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, STATE_FILE)
+        self.state = state
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, output_dir: str, **inputs):
+        """Start a checkpoint for a new run (dream, elements, text_model, image_model, quality, timestamp)."""
+        state = {
+            "run_id": os.path.basename(os.path.abspath(output_dir)),
+            "status": "running",
+            "pid": os.getpid(),
+            "process": PROCESS_TOKEN,
+            "stage": None,
+            "progress": {},
+            "prompts": {},
+            "images": {}
+        }
+        state.update(inputs)
+        checkpoint = cls(output_dir, state)
+        checkpoint.update()
+        return checkpoint
+
+    @classmethod
+    def load(cls, output_dir: str):
+        """The run's checkpoint, or None if it has none (or it is unreadable)."""
+        try:
+            with open(os.path.join(output_dir, STATE_FILE), encoding="utf-8") as f:
+                return cls(output_dir, json.load(f))
+        except (FileNotFoundError, NotADirectoryError, json.JSONDecodeError):
+            return None
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            return self.state.get(key, default)
+
+    def update(self, **fields):
+        """Merge fields into the state and write it to disk."""
+        with self._lock:
+            self.state.update(fields)
+            self.state["updated_at"] = time.time()
+            self._save()
+
+    def record_story(self, story: str, story_context):
+        """Record the written story; its Ollama context goes to CONTEXT_FILE."""
+        if story_context is not None:
+            _write_json(os.path.join(self.output_dir, CONTEXT_FILE), story_context)
+        self.update(stage="story", story=story)
+
+    def story_context(self):
+        """The story's Ollama context, or None if it has none."""
+        try:
+            with open(os.path.join(self.output_dir, CONTEXT_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Checkpoints written before the context had its own file
+            return self.get("story_context")
+
+    def record_prompt(self, scene: int, prompt: str):
+        with self._lock:
+            self.state["prompts"][str(scene)] = prompt
+            self._save()
+
+    def record_image(self, entry: dict):
+        """Record a scene's image_writer manifest entry (1-based scene number)."""
+        with self._lock:
+            self.state["images"][str(entry["scene"])] = entry
+            self._save()
+
+    def prompts(self) -> dict:
+        """0-based scene index -> image prompt, for scenes already planned."""
+        with self._lock:
+            return {int(i): prompt for i, prompt in self.state["prompts"].items()}
+
+    def images(self) -> dict:
+        """1-based scene number -> manifest entry, for scenes whose PNG is on disk."""
+        with self._lock:
+            entries = dict(self.state["images"])
+        return {
+            int(scene): entry for scene, entry in entries.items()
+            if os.path.exists(os.path.join(self.output_dir, entry["png"]))
+        }
+
+    def claim(self):
+        """Mark the run as running in this process (before resuming it)."""
+        self.update(status="running", pid=os.getpid(), process=PROCESS_TOKEN, error=None)
+
+    @property
+    def orphaned(self) -> bool:
+        """True if the run was left running by a process that no longer exists."""
+        with self._lock:
+            status, pid, process = self.state.get("status"), self.state.get("pid"), self.state.get("process")
+        if status != "running" or process == PROCESS_TOKEN:
+            return False
+        return pid == os.getpid() or not _pid_alive(pid)
+
+    def _save(self):
+        # Caller holds the lock
+        _write_json(self.path, self.state)
+
+
+# Write data as JSON to path; readers never see a half-written file
+def _write_json(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _pid_alive(pid) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Checkpoints of runs interrupted by a crash or restart, oldest first.
+# Batch runs are left out: rerunning their batch continues them.
+def find_orphaned_runs(output_root: str) -> list:
+    if not os.path.isdir(output_root):
+        return []
+    found = []
+    for entry in sorted(os.scandir(output_root), key=lambda e: e.name):
+        if not entry.is_dir():
+            continue
+        checkpoint = RunCheckpoint.load(entry.path)
+        if checkpoint is not None and checkpoint.orphaned and not checkpoint.get("batch"):
+            found.append(checkpoint)
+    return found
@@ -0,0 +1,239 @@
+# comparison.py
+# Model comparison: one dream, several Ollama models, one storybook page.
+# Each model writes its story in its own sub-folder of the run (a normal
+# StoryPipeline run with its own checkpoint and metrics), all at once; the
+# Ollama endpoint pool keeps each server within its parallelism and
+# loaded-model limits. Every model's scene prompts go through one shared
+# image model in combined batches (ImageBatcher), with the same seed per
+# scene number, so differences in the pictures come from the prompts.
+# comparison.html shows the stories side by side with per-model latency
+# and tokens/sec.
+
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from config import CONFIG
+from checkpoint import RunCheckpoint
+from html_renderer import rerender_run, write_page
+from image_writer import picture_sources
+from job_scheduler import JobCancelled
+from metrics import RunMetrics
+from model_registry import ModelRegistry
+from pipeline_engine import ImageBatcher, StoryPipeline, thumbnail_path
+from run_index import get_run_index
+
+PAGE = "comparison.html"
+SUMMARY_FILE = "comparison.json"
+
+
+# Sub-folder name for a model, e.g. "gemma3:4b" -> "gemma3_4b"
+def model_folder(model: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]", "_", model)
+
+
+def run_comparison(dream_input: str, core_elements: list[str], models: list[str], output_dir: str,
+                   timestamp: str, quality: str = None, on_progress=None, check_cancelled=None,
+                   device_slot=None) -> dict:
+    """Write the dream with every model in models and render comparison.html.
+
+    A model that fails is shown as failed on the page; the comparison only
+    fails if every model does. Returns {"html": ..., "models": {model: summary}}.
+    """
+    models = list(dict.fromkeys(models))
+    run_id = os.path.basename(os.path.abspath(output_dir))
+    metrics = RunMetrics(run_id)
+    progress = _ComparisonProgress(models, on_progress)
+    check_cancelled = check_cancelled or (lambda: None)
+    print(f"\n--- Comparing {', '.join(models)} ---")
+
+    with ModelRegistry() as registry:
+        def load_image_model():
+            with metrics.span("model_load"):
+                registry.register_image_model(
+                    CONFIG["image_model"]["name"],
+                    CONFIG["image_model"]["model_id"],
+                    CONFIG["image_model"]["parameters"],
+                    quality=quality
+                )
+            return registry.get_image_model(CONFIG["image_model"]["name"])
+
+        batcher = ImageBatcher(load_image_model, device_slot=device_slot, metrics=metrics)
+
+        def run_model(model):
+            pipeline = StoryPipeline(
+                registry, model,
+                on_progress=lambda fields: progress.update(model, fields),
+                check_cancelled=check_cancelled,
+                metrics=RunMetrics(f"{run_id}/{model_folder(model)}"),
+                quality=quality,
+                image_batcher=batcher,
+                add_to_gallery=False
+            )
+            try:
+                return pipeline.run(dream_input, core_elements, os.path.join(output_dir, model_folder(model)), timestamp)
+            finally:
+                progress.finish(model)
+                # The run's own metrics, whether or not it finished
+                metrics.record(f"model:{model}", pipeline.metrics.to_dict())
+
+        try:
+            with ThreadPoolExecutor(max_workers=len(models), thread_name_prefix="dreamsprout-compare") as pool:
+                futures = {model: pool.submit(run_model, model) for model in models}
+                outcomes = {}
+                for model, future in futures.items():
+                    try:
+                        outcomes[model] = future.result()
+                    except Exception as e:
+                        outcomes[model] = e
+        finally:
+            batcher.close()
+
+    summaries = {
+        model: summarize_model(metrics.values.get(f"model:{model}", {}), outcomes[model])
+        for model in models
+    }
+    metrics.record("image_batches", batcher.batches)
+    errors = [outcome for outcome in outcomes.values() if isinstance(outcome, Exception)]
+    if any(isinstance(e, JobCancelled) for e in errors) or len(errors) == len(models):
+        metrics.finish("cancelled" if any(isinstance(e, JobCancelled) for e in errors) else "failed")
+        metrics.write(output_dir)
+        raise next((e for e in errors if isinstance(e, JobCancelled)), errors[0])
+    check_cancelled()
+
+    progress.report({"percent": 95, "stage": "Rendering comparison..."})
+    with metrics.span("render"):
+        html_path = write_comparison_html(output_dir, dream_input, models, outcomes, summaries, timestamp)
+    with open(os.path.join(output_dir, SUMMARY_FILE), "w", encoding="utf-8") as f:
+        json.dump({"dream": dream_input, "elements": core_elements, "quality": quality,
+                   "timestamp": timestamp, "models": summaries}, f, indent=2)
+
+    first_done = next(model for model in models if not isinstance(outcomes[model], Exception))
+    thumbnail = thumbnail_path(os.path.join(output_dir, model_folder(first_done)),
+                               outcomes[first_done]["image_entries"])
+    output_root = os.path.dirname(os.path.abspath(output_dir))
+    get_run_index().add_run(
+        run_id=run_id,
+        title="Model comparison",
+        text_model=" vs ".join(models),
+        image_model=CONFIG["image_model"]["name"],
+        dream=dream_input,
+        created_at=timestamp,
+        html_path=os.path.relpath(html_path, output_root),
+        thumbnail=os.path.relpath(thumbnail, output_root) if thumbnail else None
+    )
+
+    metrics.finish("done")
+    metrics.write(output_dir)
+    progress.report({"percent": 100, "stage": "Complete!", "done": True, "page": PAGE})
+    return {"html": html_path, "models": summaries}
+
+
+# Latency and token rate of one model's run, from its RunMetrics dict
+def summarize_model(run_metrics: dict, outcome) -> dict:
+    seconds = {}
+    for span in run_metrics.get("spans", []):
+        seconds[span["stage"]] = seconds.get(span["stage"], 0.0) + span["seconds"]
+    calls = run_metrics.get("llm_calls", [])
+    timed = [c for c in calls if c.get("tokens_per_second")]
+    eval_seconds = sum(c["eval_count"] / c["tokens_per_second"] for c in timed)
+    return {
+        "status": "failed" if isinstance(outcome, Exception) else "done",
+        "error": str(outcome) if isinstance(outcome, Exception) else None,
+        "wait_seconds": round(seconds.get("text_model_wait", 0.0), 2),
+        "story_seconds": round(seconds["story"], 2) if "story" in seconds else None,
+        "text_seconds": round(seconds.get("story", 0.0) + seconds.get("compress", 0.0), 2),
+        "total_seconds": run_metrics.get("total_seconds"),
+        "tokens": sum(c.get("eval_count", 0) for c in calls),
+        "tokens_per_second": round(sum(c["eval_count"] for c in timed) / eval_seconds, 1) if eval_seconds else None,
+        "cached": bool(calls) and all(c["cached"] for c in calls)
+    }
+
+
+# Stream comparison.html into output_dir; outcomes map each model to its
+# pipeline result (scenes and image_entries) or the exception it failed with
+def write_comparison_html(output_dir, dream_input, models, outcomes, summaries, timestamp) -> str:
+    columns = []
+    rows = 0
+    for model in models:
+        outcome = outcomes[model]
+        column = {"model": model, "folder": model_folder(model), "summary": summaries[model], "scenes": []}
+        if not isinstance(outcome, Exception):
+            entries = {entry["scene"]: entry for entry in outcome["image_entries"]}
+            for i, text in enumerate(outcome["scenes"]):
+                entry = entries.get(i + 1)
+                column["scenes"].append({
+                    "text": text,
+                    "picture": _in_folder(picture_sources(entry), column["folder"]) if entry else None
+                })
+        rows = max(rows, len(column["scenes"]))
+        columns.append(column)
+
+    return write_page(
+        "comparison_template.html",
+        os.path.join(output_dir, PAGE),
+        title="Model comparison",
+        dream=dream_input,
+        columns=columns,
+        rows=rows,
+        image_model=CONFIG["image_model"]["model_id"],
+        timestamp=timestamp
+    )
+
+# Re-render a finished comparison and each model's storybook from the run folder,
+# e.g. after a template change (see html_renderer.rerender_all)
+def rerender_comparison(output_dir: str) -> str:
+    with open(os.path.join(output_dir, SUMMARY_FILE), encoding="utf-8") as f:
+        saved = json.load(f)
+    summaries = saved["models"]
+    outcomes = {}
+    for model, summary in summaries.items():
+        model_dir = os.path.join(output_dir, model_folder(model))
+        checkpoint = RunCheckpoint.load(model_dir)
+        if summary["status"] != "done" or checkpoint is None:
+            outcomes[model] = RuntimeError(summary["error"])
+            continue
+        rerender_run(model_dir)
+        outcomes[model] = {
+            "scenes": checkpoint.get("scenes"),
+            "image_entries": [entry for _, entry in sorted(checkpoint.images().items())]
+        }
+    return write_comparison_html(output_dir, saved["dream"], list(summaries), outcomes, summaries, saved["timestamp"])
+
+# picture_sources() names files relative to the model's folder; make them relative to the page
+def _in_folder(picture: dict, folder: str) -> dict:
+    def srcset(value):
+        return ", ".join(f"{folder}/{part}" for part in value.split(", ")) if value else value
+    return dict(
+        picture,
+        sources=[dict(source, srcset=srcset(source["srcset"])) for source in picture["sources"]],
+        src=f"{folder}/{picture['src']}",
+        srcset=srcset(picture["srcset"])
+    )
+
+
+class _ComparisonProgress:
+    """Combines the models' progress into one percent and stage line."""
+
+    def __init__(self, models, on_progress):
+        self.on_progress = on_progress or (lambda fields: None)
+        self.fields = {model: {"percent": 0, "stage": "Waiting..."} for model in models}
+
+    def update(self, model, fields):
+        self.fields[model] = dict(fields)
+        self.report()
+
+    def finish(self, model):
+        self.fields[model] = dict(self.fields[model], percent=100)
+        self.report()
+
+    def report(self, fields=None):
+        if fields is None:
+            percent = sum(f["percent"] for f in self.fields.values()) / len(self.fields)
+            fields = {
+                "percent": int(percent * 0.95),
+                "stage": " | ".join(f"{model}: {f['stage']}" for model, f in self.fields.items()),
+                "models": {model: f["percent"] for model, f in self.fields.items()}
+            }
+        self.on_progress(fields)
@@ -7,6 +7,8 @@ OUTPUT_DIR = "outputs"
 
 # Ollama settings - 
 OLLAMA_URL = "http://localhost:11434/api/generate"
+# Add more servers here to spread text generation over several Ollama boxes
+OLLAMA_URLS = [OLLAMA_URL]
 
 # Available text models for user to select in the web app
 # Make sure these models are downloaded and installed in your Ollama server
@@ -20,10 +22,64 @@ AVAILABLE_LLM_MODELS = [
     "qwen3"
 ]
 
+# Memory profiles for the image model, from fastest to most frugal.
+# "auto" (see CONFIG["image_model"]["memory_profile"]) picks the first GPU
+# profile whose min_vram_gb fits the device, or a CPU profile without a GPU.
+#   dtype: torch dtype name, or None to use image_model.parameters.dtype
+#   offload: None, "model" (whole sub-models move to GPU on demand) or
+#            "sequential" (layer by layer; slowest, smallest footprint)
+#   attention: "xformers" (falls back to PyTorch SDPA if missing), "sdpa" or "sliced"
+MEMORY_PROFILES = {
+    "full_gpu": {"device": "cuda", "dtype": None, "offload": None, "attention": "xformers",
+                 "vae_tiling": False, "max_batch_size": 4, "min_vram_gb": 16},
+    "model_offload": {"device": "cuda", "dtype": None, "offload": "model", "attention": "xformers",
+                      "vae_tiling": False, "max_batch_size": 2, "min_vram_gb": 10},
+    "sequential_offload": {"device": "cuda", "dtype": None, "offload": "sequential", "attention": "sliced",
+                           "vae_tiling": True, "max_batch_size": 1, "min_vram_gb": 0},
+    "mps": {"device": "mps", "dtype": "float16", "offload": None, "attention": "sliced",
+            "vae_tiling": True, "max_batch_size": 1},
+    "cpu": {"device": "cpu", "dtype": "float32", "offload": None, "attention": "sdpa",
+            "vae_tiling": True, "max_batch_size": 1},
+    "cpu_bfloat16": {"device": "cpu", "dtype": "bfloat16", "offload": None, "attention": "sdpa",
+                     "vae_tiling": True, "max_batch_size": 1, "max_ram_gb": 32}
+}
+
+# Samplers the image model can use (more can be added with ModelRegistry.register_sampler).
+#   scheduler: diffusers scheduler class name, or None for the model's own scheduler
+#   options: overrides applied on top of the model's scheduler config
+#   lora: "lcm" if the sampler needs the LCM-LoRA (image_model.lcm_lora) adapter switched on
+SAMPLERS = {
+    "default": {"scheduler": None, "options": {}},
+    "dpmpp_2m": {"scheduler": "DPMSolverMultistepScheduler",
+                 "options": {"algorithm_type": "dpmsolver++", "use_karras_sigmas": True}},
+    "euler_a": {"scheduler": "EulerAncestralDiscreteScheduler", "options": {}},
+    "lcm": {"scheduler": "LCMScheduler", "options": {}, "lora": "lcm"}
+}
+
+# Per-run quality presets, fastest first. Steps and guidance left out fall back
+# to image_model.parameters. Draft uses LCM when an LCM-LoRA is configured and
+# its "without_lora" settings otherwise.
+QUALITY_PRESETS = {
+    "draft": {"sampler": "lcm", "num_inference_steps": 6, "guidance_scale": 1.5,
+              "without_lora": {"sampler": "dpmpp_2m", "num_inference_steps": 8, "guidance_scale": 5.0}},
+    "standard": {"sampler": "dpmpp_2m", "num_inference_steps": 20},
+    "final": {"sampler": "default"}
+}
+
 CONFIG = {
     "text_model": { # text model configuration
         "name": "llama3.1", # default model name for OllamaRunner
         "backend": "ollama",
+        "server_urls": OLLAMA_URLS, # each request goes to the healthy server with the fewest in flight
+        "timeout": {"connect": 5, "read": 300, "health": 2}, # seconds; read is the longest wait between chunks
+        "retries": 3, # extra attempts after a failed request, with exponential backoff
+        "backoff_seconds": 0.5, # first retry delay, doubled on each further attempt
+        "cooldown_seconds": 5, # how long a failing server is skipped (doubles while it keeps failing)
+        "max_connections": 8, # keep-alive connections per server
+        "max_parallel": 4, # requests in flight per server; match OLLAMA_NUM_PARALLEL
+        "max_loaded_models": 3, # distinct models in use per server; match OLLAMA_MAX_LOADED_MODELS
+        "keep_alive": "10m", # how long Ollama keeps a model loaded after a request (None: server default)
+        "stream": True, # stream the story to the browser as it is generated
         "parameters": {
             "num_ctx": 32000, # [IMPORTANT] set the context window size high
             "max_tokens": 32000,
@@ -36,13 +92,26 @@ CONFIG = {
         "name": "sdxl",
         "backend": "diffusers",
         "model_id": "stabilityai/stable-diffusion-xl-base-1.0",
+        "memory_profile": "auto", # "auto" or a key of MEMORY_PROFILES
+        "quality": "final", # default QUALITY_PRESETS entry; the web form and CLI can override it
+        "lcm_lora": None, # local path (or hub id) of an SDXL LCM-LoRA, e.g. "latent-consistency/lcm-lora-sdxl"
         "parameters": {
-            "dtype": "float16", # torch dtype
+            "dtype": "float16", # torch dtype on GPU profiles
             "num_inference_steps": 30,
             "guidance_scale": 6.5,
             "resolution": (768, 512),
             "seed": 42,
-            "negative_prompt": "scary, horror, gore, photorealistic, harsh shadows, text overlay"
+            "negative_prompt": "scary, horror, gore, photorealistic, harsh shadows, text overlay",
+            "batch_size": 4 # scenes denoised per pass; halved automatically on out-of-memory
+        },
+        "acceleration": { # opt-in fast inference path (see image_acceleration.py)
+            "backend": "eager", # "eager", or "fast" for torch.compile + channels-last + fused QKV
+            "compile_mode": "max-autotune", # torch.compile mode for the UNet and VAE decoder
+            "channels_last": True,
+            "fuse_qkv": True,
+            "quantization": None, # None, "int8" (dynamic) or "int8_weight_only"; needs torchao
+            "warmup_steps": 2, # denoising steps per batch size run when the model is loaded
+            "compile_cache_dir": "cache/torch_compile" # reused across restarts
         }
     },
 
@@ -50,7 +119,57 @@ CONFIG = {
         "target_words": 500,
         "scenes": 4,
         "style_hint": "gentle, whimsical, storybook illustration",
+        "scene_planning": "batched", # "batched": one JSON call for all scenes, "per_scene": one call each
+        "reuse_story_context": True, # continue from the story's Ollama context instead of re-sending it
+        "resume_on_start": True, # web app re-queues runs a crash or restart left unfinished
         "output_dir": OUTPUT_DIR,
         "format": "html"
+    },
+
+    "images": { # files written for each scene (see image_writer.py)
+        "writer_threads": 2, # background threads encoding and saving images
+        "sizes": {"display": 768, "thumb": 256}, # variant name -> max width in pixels
+        "formats": ["webp", "jpeg"], # variant formats, preferred first; the last is the <img> fallback
+        "quality": 80, # WebP/JPEG quality
+        "cache_max_age": 31536000, # seconds browsers may cache scene images (they never change)
+        "step_progress_interval": 0.25, # min seconds between per-step progress events
+        "previews": { # live previews of scenes while they denoise (see image_previews.py)
+            "enabled": True,
+            "every_steps": 5, # decode a preview every K denoising steps
+            "decoder": "taesd", # "taesd" (tiny autoencoder) or "linear" (latent-to-RGB projection, no download)
+            "tiny_vae": "madebyollin/taesdxl", # hub id or local path of the tiny SDXL autoencoder
+            "size": 256 # preview width in pixels
+        }
+    },
+
+    "model_pool": { # shared, process-wide cache of loaded image pipelines
+        "preload": True, # load the configured image model when the web app starts
+        "max_idle_models": 1, # idle pipelines kept in memory (least recently used evicted first)
+        "idle_ttl_seconds": 1800, # evict unpinned idle pipelines after this long
+        "evict_interval_seconds": 60 # how often idle pipelines are checked against the TTL
+    },
+
+    "scheduler": { # job scheduler (web app threads, or the queue and worker processes)
+        "workers": 2, # stories processed at once (text stages overlap)
+        "device_slots": 1, # stories allowed on the image model at once
+        "max_queue_depth": 8, # waiting stories before /start returns 429
+        "finished_ttl_seconds": 600, # finished runs kept in memory; older status comes from their checkpoint
+        "mode": "inline", # "inline": the web app runs jobs itself; "queue": it only enqueues them for dreamsprout_worker.py
+        "queue_path": f"{OUTPUT_DIR}/jobs.sqlite", # durable job queue shared by the web app and workers
+        "lease_seconds": 30, # a job whose worker stops heartbeating for this long goes back on the queue
+        "heartbeat_seconds": 2, # how often workers renew their leases and check for cancellation
+        "max_attempts": 3 # times a job is handed to a worker before it is marked failed
+    },
+
+    "gallery": { # persistent run index behind the gallery page
+        "index_path": f"{OUTPUT_DIR}/runs.sqlite",
+        "per_page": 24
+    },
+
+    "cache": { # content-addressed cache of LLM responses and rendered images
+        "enabled": True,
+        "dir": "cache",
+        "text": {"enabled": True, "max_bytes": 64 * 1024 * 1024},
+        "image": {"enabled": True, "max_bytes": 2 * 1024 * 1024 * 1024}
     }
 }
\ No newline at end of file
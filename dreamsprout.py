@@ -1,16 +1,24 @@
 # dreamsprout.py
 # Core DreamSprout functions for story generation, scene splitting,
-# image prompt building, image generation, and HTML rendering.
+# image prompt building and image generation (HTML rendering is in html_renderer.py).
 # You can also run this as a standalone script for CLI usage for testing
+# torch and PIL are imported on first use, so importing this module (and
+# `python dreamsprout.py --help`) stays fast.
 
+import io
 import os
+import json
 import argparse
 import datetime
-from jinja2 import Environment, FileSystemLoader
 # Import DreamSprout configuration and model registry
-from config import CONFIG
-from model_registry import ModelRegistry
-from ollama_runner import OllamaRunner
+from config import CONFIG, QUALITY_PRESETS
+from cache import ContentCache, get_cache
+from image_writer import get_image_writer
+# Storybook rendering lives in html_renderer; re-exported for existing callers
+from html_renderer import render_storybook_html, render_storybook_html_alt, rerender_all  # noqa: F401
+from model_registry import ModelRegistry, adapter_scope
+from run_index import get_run_index, write_static_index
+from checkpoint import STATE_FILE, RunCheckpoint, find_orphaned_runs
 
 # Build the prompt for story generation
 # You can modify this prompt to change the story style or requirements
@@ -34,6 +42,14 @@ def generate_story(text_model_runner, dream_input: str, core_elements: list[str]
     prompt = build_story_prompt(dream_input, core_elements)
     return text_model_runner(prompt)
 
+# Generate the story and keep Ollama's context tokens for follow-up calls.
+# With on_token, the story is streamed and on_token(text) is called per chunk.
+def generate_story_with_context(ollama_runner, dream_input: str, core_elements: list[str], on_token=None):
+    prompt = build_story_prompt(dream_input, core_elements)
+    if on_token is not None:
+        return ollama_runner.generate_stream_with_context(prompt, on_token)
+    return ollama_runner.generate_with_context(prompt)
+
 # Split the story into scenes based on paragraphs
 def split_scenes(story: str, desired: int) -> list[str]:
     paragraphs = [p.strip() for p in story.split("\n") if p.strip()]
@@ -50,6 +66,77 @@ def compress_scene_for_illustration(scene_text: str, text_model_runner) -> str:
         Summary:"""
     return text_model_runner(prompt).strip()
 
+# --- Scene planning ---
+# Ask the text model once for all illustration summaries as a JSON list,
+# instead of one compress_scene_for_illustration round-trip per scene.
+def build_scene_plan_prompt(scenes: list[str], story_in_context: bool = False) -> str:
+    if story_in_context:
+        # The story is already in the model's context; refer to paragraphs by number
+        listing = "\n".join(f"{i}. (paragraph starting: \"{' '.join(s.split()[:8])}...\")" for i, s in enumerate(scenes, start=1))
+        source = "the story you just wrote"
+    else:
+        listing = "\n".join(f"{i}. {s}" for i, s in enumerate(scenes, start=1))
+        source = "the scenes below"
+    return f"""
+        For each of the {len(scenes)} numbered scenes from {source}, write a short, vivid description suitable for a storybook illustration.
+        Limit each description to 40 words.
+        Emphasize the main characters, setting, and what they’re doing.
+        Use emotionally warm language that evokes visual clarity.
+        Respond only with JSON of the form {{"scenes": ["description 1", "description 2", ...]}} with exactly {len(scenes)} entries, in order.
+        Scenes:
+{listing}"""
+
+# Parse and repair the scene plan returned by the model.
+# Returns one summary (or None where missing) per expected scene, or None if unparseable.
+def parse_scene_plan(raw: str, expected: int):
+    text = raw.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.find("\n") + 1:] if "\n" in text else text
+    data = None
+    # Try the outermost JSON value first, whether it is an object or a list
+    for opener, closer in sorted((("{", "}"), ("[", "]")), key=lambda pair: text.find(pair[0]) % (len(text) + 1)):
+        start, end = text.find(opener), text.rfind(closer)
+        if start == -1 or end <= start:
+            continue
+        try:
+            data = json.loads(text[start:end + 1])
+            break
+        except json.JSONDecodeError:
+            continue
+    if isinstance(data, dict):
+        data = data.get("scenes") or next((v for v in data.values() if isinstance(v, list)), None)
+    if not isinstance(data, list):
+        return None
+
+    summaries = []
+    for item in data[:expected]:
+        if isinstance(item, dict):
+            item = item.get("summary") or item.get("description") or next((v for v in item.values() if isinstance(v, str)), None)
+        if isinstance(item, str) and item.strip():
+            summaries.append(" ".join(item.split()[:40]))
+        else:
+            summaries.append(None)
+    summaries += [None] * (expected - len(summaries))
+    return summaries
+
+# Plan illustration summaries for all scenes in one structured call.
+# story_context is the Ollama context returned with the story, if available.
+# Falls back to per-scene compression for anything the plan is missing.
+def plan_scenes_for_illustration(scenes: list[str], ollama_runner, story_context: list[int] = None) -> list[str]:
+    if not scenes:
+        return []
+    prompt = build_scene_plan_prompt(scenes, story_in_context=bool(story_context))
+    raw, _ = ollama_runner.generate_with_context(prompt, context=story_context, format="json")
+    summaries = parse_scene_plan(raw, len(scenes))
+    if summaries is None:
+        print("Scene plan could not be parsed, compressing scenes one at a time")
+        summaries = [None] * len(scenes)
+    return [
+        summary if summary is not None else compress_scene_for_illustration(scene, ollama_runner.generate)
+        for scene, summary in zip(scenes, summaries)
+    ]
+
 # Build image prompt for a given scene
 # You can modify this prompt to change the illustration style or details
 def build_image_prompt(scene_text: str) -> str:
@@ -62,205 +149,266 @@ Palette: soft twilight pastels, cozy tones
 Composition: clear focal subject, readable for children
 """
 
-# Render the story and images into an HTML storybook using a Jinja2 template
-def render_storybook_html(
-    title: str,
-    story: str,
-    image_paths: list[str],
-    text_model: str,
-    image_model: str,
-    text_prompt: str,
-    image_prompts: list[str],
-    timestamp: str
-) -> str:    
-    paragraphs = [p.strip() for p in story.split("\n") if p.strip()]
-    scenes = []
-
-    fig_index = 0
-    for i, p in enumerate(paragraphs):
-        image = None
-        if fig_index < len(image_paths) and (i+1) % max(1, len(paragraphs)//len(image_paths)) == 0:
-            image = os.path.basename(image_paths[fig_index])
-            fig_index += 1
-        scenes.append({"text": p, "image": image})
-
-    env = Environment(loader=FileSystemLoader("templates"))
-    template = env.get_template("storybook_template.html")
-    return template.render(
-        title=title,
-        scenes=scenes,
-        text_model=text_model,
-        image_model=image_model,
-        text_prompt=text_prompt,
-        image_prompts=image_prompts,
-        timestamp=timestamp
+# --- Image generation ---
+# Render all scene prompts in micro-batches with one seeded generator per scene.
+# Scene i always uses seed + i, so results don't depend on how scenes are batched.
+# first_scene is the 0-based index of prompts[0] when rendering a subset of scenes;
+# scenes gives each prompt's index instead when they aren't consecutive.
+# on_step(positions, step, steps, latents) is called after every denoising step
+# (step counts from 1); positions index into prompts, and latents (None if the pipeline doesn't
+# pass them) has one row per position.
+# Scenes already in the image cache are not rendered again.
+def generate_images(image_model, prompts: list[str], batch_size: int = None, first_scene: int = 0,
+                    scenes: list[int] = None, on_step=None) -> list:
+    gen = image_model.generation_config
+    if scenes is None:
+        scenes = range(first_scene, first_scene + len(prompts))
+    seeds = [gen["seed"] + scene for scene in scenes]
+    cache = get_cache("image")
+    if cache is None:
+        return _render_images(image_model, prompts, seeds, batch_size, on_step)
+
+    images = [None] * len(prompts)
+    keys = [_image_cache_key(gen, p, seed) for p, seed in zip(prompts, seeds)]
+    to_render = []
+    to_wait = []
+    for i, key in enumerate(keys):
+        state, value = cache.begin(key)
+        if state == "hit":
+            images[i] = _decode_image(value)
+        elif state == "wait":
+            to_wait.append((i, value))
+        else:
+            to_render.append(i)
+
+    try:
+        rendered = _render_images(
+            image_model, [prompts[i] for i in to_render], [seeds[i] for i in to_render], batch_size,
+            on_step, positions=to_render
+        )
+    except BaseException:
+        for i in to_render:
+            cache.finish(keys[i], None)
+        raise
+    for i, img in zip(to_render, rendered):
+        images[i] = img
+        cache.finish(keys[i], _encode_image(img))
+
+    # Identical scenes another run was already rendering
+    for i, event in to_wait:
+        data = cache.wait(keys[i], event)
+        if data is not None:
+            images[i] = _decode_image(data)
+        else:
+            images[i] = _render_images(image_model, [prompts[i]], [seeds[i]], 1, on_step, positions=[i])[0]
+    return images
+
+# Run the diffusion pipeline over prompts in micro-batches.
+# On out-of-memory the batch is halved and retried, down to one scene at a time.
+# positions are what on_step reports for prompts (default: their indices).
+def _render_images(image_model, prompts: list[str], seeds: list[int], batch_size: int = None,
+                   on_step=None, positions: list[int] = None) -> list:
+    import torch
+    gen = image_model.generation_config
+    width, height = gen["resolution"]
+    if batch_size is None:
+        batch_size = gen.get("batch_size", 1)
+    batch_size = max(1, batch_size)
+
+    positions = list(range(len(prompts))) if positions is None else positions
+    images = []
+    start = 0
+    while start < len(prompts):
+        batch = prompts[start:start + batch_size]
+        callback = None
+        if on_step is not None:
+            callback = _step_callback(on_step, positions[start:start + len(batch)], gen["num_inference_steps"])
+        try:
+            with adapter_scope(image_model):
+                result = image_model(
+                    prompt=batch,
+                    negative_prompt=[gen["negative_prompt"]] * len(batch),
+                    num_inference_steps=gen["num_inference_steps"],
+                    guidance_scale=gen["guidance_scale"],
+                    width=width,
+                    height=height,
+                    generator=[torch.Generator("cpu").manual_seed(seed) for seed in seeds[start:start + len(batch)]],
+                    callback_on_step_end=callback
+                )
+        except Exception as e:
+            if not _is_out_of_memory(e) or batch_size == 1:
+                raise
+            batch_size //= 2
+            print(f"Out of memory, retrying with batch size {batch_size}")
+            _empty_device_cache()
+            continue
+        images.extend(result.images)
+        start += len(batch)
+    return images
+
+# diffusers step-end callback forwarding to on_step; must return the callback kwargs
+def _step_callback(on_step, positions, steps):
+    def callback(pipe, step, timestep, callback_kwargs):
+        on_step(positions, step + 1, steps, callback_kwargs.get("latents"))
+        return callback_kwargs
+    return callback
+
+# Everything that determines a rendered image goes into its cache key
+def _image_cache_key(gen: dict, prompt: str, seed: int) -> str:
+    return ContentCache.make_key(
+        "sdxl", gen["model_id"], prompt, gen["negative_prompt"], seed,
+        gen["num_inference_steps"], gen["guidance_scale"], list(gen["resolution"]),
+        gen.get("backend", "eager"), gen.get("sampler", "default")
     )
 
-# Alternative simple HTML renderer without Jinja2
-def render_storybook_html_alt(title: str, story: str, image_paths: list[str]) -> str:
-    paragraphs = [p for p in story.split("\n") if p.strip()]
-    html = [f"""<!DOCTYPE html>
-<html>
-<head>
-  <meta charset="UTF-8">
-  <title>{title}</title>
-  <style>
-    body {{
-      font-family: "Comic Sans MS", "Comic Neue", "Trebuchet MS", sans-serif;
-      font-size: 1.4em;
-      line-height: 1.6;
-      margin: 2em;
-      padding: 2em;
-      background: linear-gradient(to bottom right, #fffaf0, #e6f7ff);
-      color: #333;
-      border: 12px solid #f0e6d2;
-      border-radius: 24px;
-      box-shadow: 0 0 20px rgba(0,0,0,0.1);
-    }}
-    h1 {{
-      text-align: center;
-      font-size: 2em;
-      margin-bottom: 1em;
-    }}
-    .scene {{
-      margin-bottom: 3em;
-    }}
-    .scene img {{
-      display: block;
-      margin: 0 auto;
-      width: 70%;
-      border-radius: 12px;
-      box-shadow: 0 4px 12px rgba(0,0,0,0.1);
-    }}
-    .scene p {{
-      margin-top: 1em;
-      text-align: center;
-    }}
-    a {{
-      display: block;
-      text-align: center;
-      margin-top: 2em;
-      font-size: 1em;
-    }}
-  </style>
-</head>
-<body>
-  <h1>{title}</h1>
-"""]
-
-    fig_index = 0
-    for i, p in enumerate(paragraphs):
-        html.append("<div class='scene'>")
-        if fig_index < len(image_paths) and (i+1) % max(1, len(paragraphs)//len(image_paths)) == 0:
-            img_name = os.path.basename(image_paths[fig_index])
-            html.append(f"<img src='{img_name}' alt='Scene {fig_index+1}'/>")
-            fig_index += 1
-        html.append(f"<p>{p}</p>")
-        html.append("</div>")
-
-    html.append("<a href='/gallery'>Back to gallery</a>")
-    html.append("</body></html>")
-    return "\n".join(html)
+def _encode_image(img) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def _decode_image(data: bytes):
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+# Save generated images as scene_1.png, scene_2.png, ... in the output directory,
+# plus their display and thumbnail variants (see image_writer.py)
+def save_images(images: list, output_dir: str, start_index: int = 1) -> list[str]:
+    writer = get_image_writer()
+    futures = [writer.submit(img, output_dir, i) for i, img in enumerate(images, start=start_index)]
+    return [os.path.join(output_dir, future.result()["png"]) for future in futures]
+
+def _is_out_of_memory(error: Exception) -> bool:
+    import torch
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error).lower()
+
+def _empty_device_cache():
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+# Create a unique run folder named after the current time.
+# Runs started within the same second get a numeric suffix (run_<timestamp>_2, ...).
+# Returns (run_id, output_dir, timestamp).
+def create_run_dir(output_root: str):
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    os.makedirs(output_root, exist_ok=True)
+    run_id = f"run_{timestamp}"
+    suffix = 1
+    while True:
+        try:
+            os.mkdir(os.path.join(output_root, run_id))
+            return run_id, os.path.join(output_root, run_id), timestamp
+        except FileExistsError:
+            suffix += 1
+            run_id = f"run_{timestamp}_{suffix}"
 
 # --- Main pipeline function ---
-def run_pipeline(dream_input: str, core_elements: list[str]):
+# quality picks a QUALITY_PRESETS entry (default: CONFIG["image_model"]["quality"]).
+def run_pipeline(dream_input: str, core_elements: list[str], on_progress=None, quality=None):
     print("\n--- Starting DreamSprout Pipeline ---")
-    registry = ModelRegistry()
-
     # Create unique output directory
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_dir = os.path.join(CONFIG["pipeline"]["output_dir"], f"run_{timestamp}")
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Register Ollama text model
-    print("\n--- Registering Text Model ---")
-    selected_model = CONFIG["text_model"]["name"]
-    ollama_runner = OllamaRunner(model_name=selected_model)
-    registry.register_text_model(selected_model, ollama_runner.generate)
-
-    # Register image model
-    print("\n--- Registering Image Model ---")
-    registry.register_image_model(
-        CONFIG["image_model"]["name"],
-        CONFIG["image_model"]["model_id"],
-        CONFIG["image_model"]["parameters"]
-    )
-
-    # Generate story
-    print("\n--- Generating Story ---")
-    text_model = registry.get_text_model(CONFIG["text_model"]["name"])
-    story = generate_story(text_model, dream_input, core_elements)
-
-    # Split into scenes
-    print("\n--- Splitting Scenes ---")
-    scenes = split_scenes(story, CONFIG["pipeline"]["scenes"])
-    prompts = [build_image_prompt(s) for s in scenes]
-
-    # Generate images
-    print("\n--- Generating Images ---")
-    image_model = registry.get_image_model(CONFIG["image_model"]["name"])
-    print(f"Using model: {CONFIG['image_model']['name']}")  # Debug line
-    image_paths = []
-    for i, p in enumerate(prompts, start=1):
-        img = image_model(
-            prompt=p,
-            num_inference_steps=CONFIG["image_model"]["parameters"]["num_inference_steps"],
-            guidance_scale=CONFIG["image_model"]["parameters"]["guidance_scale"]
-        ).images[0]
-        path = os.path.join(output_dir, f"scene_{i}.png")
-        img.save(path)
-        image_paths.append(path)
-
-    # Render HTML
-    print("\n--- Rendering HTML ---")
-#    html = render_storybook_html("DreamSprout Story", story, image_paths)
-
-    html = render_storybook_html(
-        title="My Dream Story",
-        story=story,
-        image_paths=image_paths,
-        text_model=selected_model,
-        image_model=image_model,
-        text_prompt=dream_input,
-        image_prompts=prompts,
-        timestamp=timestamp
-    )
-
-    html_path = os.path.join(output_dir, "storybook.html")
-    with open(html_path, "w", encoding="utf-8") as f:
-        f.write(html)
+    _, output_dir, timestamp = create_run_dir(CONFIG["pipeline"]["output_dir"])
+    return _run_story(output_dir, dream_input, core_elements, timestamp,
+                      CONFIG["text_model"]["name"], quality, on_progress)
+
+# Resume an unfinished run from the checkpoint in its folder
+def resume_pipeline(output_dir: str, on_progress=None):
+    checkpoint = RunCheckpoint.load(output_dir)
+    if checkpoint is None:
+        raise ValueError(f"{output_dir} has no {STATE_FILE} to resume from")
+    state = checkpoint.state
+    print(f"\n--- Resuming DreamSprout Run {state['run_id']} after stage {state.get('stage')} ---")
+    return _run_story(output_dir, state["dream"], state["elements"], state["timestamp"],
+                      state["text_model"], state.get("quality"), on_progress, checkpoint)
+
+def _run_story(output_dir, dream_input, core_elements, timestamp, text_model, quality, on_progress, checkpoint=None):
+    # Imported here because pipeline_engine builds on the functions above
+    from pipeline_engine import StoryPipeline
+
+    with ModelRegistry() as registry:
+        on_token = None
+        if CONFIG["text_model"]["stream"]:
+            on_token = lambda token: print(token, end="", flush=True)
+        pipeline = StoryPipeline(registry, text_model, on_progress=on_progress,
+                                 on_token=on_token, quality=quality)
+        result = pipeline.run(dream_input, core_elements, output_dir, timestamp, checkpoint=checkpoint)
 
     # --- Update index.html ---
     print("\n--- Updating Index ---")
-    index_path = os.path.join(CONFIG["pipeline"]["output_dir"], "index.html")
-    rel_path = os.path.relpath(html_path, CONFIG["pipeline"]["output_dir"])
-    entry = f"<li><a href='{rel_path}'>{os.path.basename(output_dir)}</a></li>\n"
-
-    if os.path.exists(index_path):
-        with open(index_path, "a", encoding="utf-8") as f:
-            f.write(entry)
-    else:
-        with open(index_path, "w", encoding="utf-8") as f:
-            f.write("<h1>DreamSprout Runs</h1>\n<ul>\n")
-            f.write(entry)
-            f.write("</ul>\n")
+    write_static_index(get_run_index(), CONFIG["pipeline"]["output_dir"])
 
-    return {"story": story, "images": image_paths, "html": html_path}
+    return {"story": result["story"], "images": result["images"], "html": result["html"]}
 
 # --- CLI ---
 def main():
     parser = argparse.ArgumentParser(description="DreamSprout Story + Illustration Generator")
-    parser.add_argument("--dream", type=str, required=True,
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dream", type=str,
                         help="Dream description text")
+    source.add_argument("--batch", metavar="FILE.jsonl",
+                        help="Generate one story per line of a JSONL file (see batch_runner.py)")
+    source.add_argument("--resume", metavar="RUN",
+                        help="Finish an unfinished run (run folder name or path), or 'all' for every interrupted run")
+    source.add_argument("--rerender", action="store_true",
+                        help="Regenerate every stored storybook and comparison page, e.g. after a template change")
     parser.add_argument("--elements", nargs="+", default=[],
                         help="Core elements (snake, fish, bat, etc.)")
+    parser.add_argument("--quality", choices=list(QUALITY_PRESETS), default=CONFIG["image_model"]["quality"],
+                        help="Illustration quality: draft is fastest, final is best")
+    parser.add_argument("--results", metavar="FILE.jsonl",
+                        help="Batch results file (default: <batch>.results.jsonl); finished items are skipped on rerun")
+    parser.add_argument("--lookahead", type=int, default=2,
+                        help="Batch items in flight, so upcoming stories are written while images render")
+    parser.add_argument("--compare", nargs="+", metavar="MODEL",
+                        help="With --dream: write it with each of these Ollama models and show them side by side")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="With --rerender: pages rendered in parallel (default: one per core)")
     args = parser.parse_args()
 
-    result = run_pipeline(dream_input=args.dream, core_elements=args.elements)
+    if args.rerender:
+        counts = rerender_all(CONFIG["pipeline"]["output_dir"], jobs=max(1, args.jobs))
+        print("\n--- DreamSprout Re-render Complete ---")
+        print(json.dumps(counts))
+        return
+
+    if args.compare:
+        if not args.dream:
+            parser.error("--compare needs --dream")
+        # Imported here because comparison builds on pipeline_engine
+        from comparison import run_comparison
+        _, output_dir, timestamp = create_run_dir(CONFIG["pipeline"]["output_dir"])
+        result = run_comparison(args.dream, args.elements, args.compare, output_dir, timestamp, quality=args.quality)
+        write_static_index(get_run_index(), CONFIG["pipeline"]["output_dir"])
+        print("\n--- DreamSprout Comparison Complete ---")
+        print("Comparison saved to:", result["html"])
+        print(json.dumps(result["models"], indent=2))
+        return
+
+    if args.batch:
+        from batch_runner import run_batch
+        counts = run_batch(args.batch, args.results, lookahead=max(1, args.lookahead), quality=args.quality)
+        print("\n--- DreamSprout Batch Complete ---")
+        print(json.dumps(counts))
+        return
+
+    if args.resume == "all":
+        output_dirs = [checkpoint.output_dir for checkpoint in find_orphaned_runs(CONFIG["pipeline"]["output_dir"])]
+        print(f"Resuming {len(output_dirs)} interrupted runs")
+        results = [resume_pipeline(output_dir) for output_dir in output_dirs]
+    elif args.resume:
+        output_dir = args.resume
+        if not os.path.isdir(output_dir):
+            output_dir = os.path.join(CONFIG["pipeline"]["output_dir"], args.resume)
+        results = [resume_pipeline(output_dir)]
+    else:
+        results = [run_pipeline(dream_input=args.dream, core_elements=args.elements, quality=args.quality)]
 
-    print("\n--- DreamSprout Run Complete ---")
-    print("Story saved to:", result["html"])
-    print("Images generated:", result["images"])
+    for result in results:
+        print("\n--- DreamSprout Run Complete ---")
+        print("Story saved to:", result["html"])
+        print("Images generated:", result["images"])
 
 if __name__ == "__main__":
 
@@ -0,0 +1,371 @@
+# dreamsprout_benchmark.py
+# Offline benchmark for DreamSprout's orchestration layer.
+# Runs without a GPU or a live Ollama: a local stub serves /api/generate with
+# configurable latency and token rate, and a fake SDXL pipeline with a
+# configurable per-step cost is injected into the shared model pool.
+# Drives run_pipeline and the Flask /start -> /status flow at several
+# concurrency levels and prints per-stage latency percentiles, throughput
+# and peak RSS as JSON.
+# With --mode backends it instead loads the real SDXL model twice and reports
+# the speedup of the fast (compiled) image backend over eager mode.
+#
+#   python dreamsprout_benchmark.py --runs 8 --concurrency 1,2,4 --output bench.json
+#   python dreamsprout_benchmark.py --mode backends --runs 4
+
+import argparse
+import contextlib
+import json
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import CONFIG, QUALITY_PRESETS
+
+WORDS = "the little fox floated over a sleepy moon made of warm soft cheese and giggled".split()
+
+
+# --- Stub Ollama server ---
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    """Serves /api/generate like Ollama, paced by the server's latency settings."""
+
+    def do_GET(self):
+        # Health checks: /api/version, and /api/tags listing no models
+        body = {"/api/version": {"version": "stub"}, "/api/tags": {"models": []}}.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path != "/api/generate":
+            self.send_error(404)
+            return
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        settings = self.server.settings
+        text = self._response_text(payload, settings)
+        tokens = text.split(" ")
+        time.sleep(settings["latency"])
+
+        if payload.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            for i, token in enumerate(tokens):
+                time.sleep(1.0 / settings["tokens_per_second"])
+                chunk = token if i == 0 else " " + token
+                self.wfile.write(json.dumps({"response": chunk, "done": False}).encode() + b"\n")
+                self.wfile.flush()
+            self.wfile.write(json.dumps(self._final_fields(payload, tokens, settings)).encode() + b"\n")
+            return
+
+        time.sleep(len(tokens) / settings["tokens_per_second"])
+        body = {"response": text}
+        body.update(self._final_fields(payload, tokens, settings))
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    @staticmethod
+    def _response_text(payload, settings):
+        if payload.get("format") == "json":
+            match = re.search(r"exactly (\d+) entries", payload["prompt"])
+            count = int(match.group(1)) if match else CONFIG["pipeline"]["scenes"]
+            return json.dumps({"scenes": [" ".join(WORDS[:12]) for _ in range(count)]})
+        if "Summary:" in payload["prompt"]:
+            return " ".join(WORDS[:12])
+        # A story with one paragraph more than the configured scene count
+        paragraphs = CONFIG["pipeline"]["scenes"] + 1
+        per_paragraph = max(1, settings["story_words"] // paragraphs)
+        return "\n".join(
+            " ".join(WORDS[(p + i) % len(WORDS)] for i in range(per_paragraph)) for p in range(paragraphs)
+        )
+
+    @staticmethod
+    def _final_fields(payload, tokens, settings):
+        eval_ns = int(len(tokens) / settings["tokens_per_second"] * 1e9)
+        return {
+            "done": True,
+            "context": list(range(len(tokens))),
+            "eval_count": len(tokens),
+            "eval_duration": eval_ns,
+            "prompt_eval_count": len(payload["prompt"].split()),
+            "prompt_eval_duration": int(settings["latency"] * 1e9)
+        }
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_ollama(latency, tokens_per_second, story_words):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubOllamaHandler)
+    server.daemon_threads = True
+    server.settings = {"latency": latency, "tokens_per_second": tokens_per_second, "story_words": story_words}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/generate"
+
+
+# --- Fake SDXL pipeline ---
+class FakeImagePipeline:
+    """Stands in for StableDiffusionXLPipeline; sleeps step_cost per step.
+
+    Each extra image in a batch costs batch_overhead of a single image, to
+    model the partial speedup batching gives on a real GPU.
+    """
+
+    def __init__(self, step_cost, batch_overhead=0.6):
+        self.step_cost = step_cost
+        self.batch_overhead = batch_overhead
+        self.scheduler = _FakeScheduler()
+        self.lock = threading.Lock()  # one denoising loop at a time, like one GPU
+
+    def __call__(self, prompt, num_inference_steps=30, width=768, height=512, callback_on_step_end=None, **kwargs):
+        prompts = prompt if isinstance(prompt, list) else [prompt]
+        per_step = self.step_cost * (1 + self.batch_overhead * (len(prompts) - 1))
+        with self.lock:
+            for step in range(num_inference_steps):
+                time.sleep(per_step)
+                if callback_on_step_end is not None:
+                    callback_on_step_end(self, step, step, {})
+        return _FakeOutput([_blank_image(width, height) for _ in prompts])
+
+
+class _FakeScheduler:
+    config = {}
+
+
+class _FakeOutput:
+    def __init__(self, images):
+        self.images = images
+
+
+def _blank_image(width, height):
+    from PIL import Image
+    return Image.new("RGB", (width // 8, height // 8), (250, 240, 220))
+
+
+def inject_fake_image_model(step_cost):
+    from model_pool import MODEL_POOL
+    from model_registry import ModelRegistry
+    fake = FakeImagePipeline(step_cost)
+    key = ModelRegistry().image_pool_key(CONFIG["image_model"]["model_id"], CONFIG["image_model"]["parameters"])
+    MODEL_POOL.preload(key, lambda: fake)
+    return fake
+
+
+# --- Measurement helpers ---
+class StageTimer:
+    """Turns a stream of progress updates into per-stage durations."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+        self.durations = {}
+        self._stage = None
+        self._since = self.start
+
+    def update(self, fields):
+        # "Creating illustrations (1-4 of 4): step 3 of 20..." -> "Creating illustrations"
+        stage = re.sub(r"\s*\(.*\)|:\s*step \d+ of \d+", "", fields.get("stage", "")).rstrip(".")
+        now = time.perf_counter()
+        if stage != self._stage:
+            if self._stage is not None:
+                self.durations[self._stage] = self.durations.get(self._stage, 0.0) + now - self._since
+            self._stage, self._since = stage, now
+
+    def finish(self):
+        self.update({"stage": ""})
+        self.end = time.perf_counter()
+        return self
+
+    def total(self):
+        return (self.end or time.perf_counter()) - self.start
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "p50": round(statistics.median(ordered), 4),
+        "p90": round(pick(0.9), 4),
+        "p99": round(pick(0.99), 4),
+        "max": round(ordered[-1], 4)
+    }
+
+
+def summarize(timers, wall_time, concurrency):
+    stages = {}
+    for timer in timers:
+        for stage, seconds in timer.durations.items():
+            stages.setdefault(stage, []).append(seconds)
+    return {
+        "concurrency": concurrency,
+        "runs": len(timers),
+        "wall_seconds": round(wall_time, 3),
+        "stories_per_hour": round(len(timers) / wall_time * 3600, 1) if wall_time else None,
+        "end_to_end": percentiles([t.total() for t in timers]),
+        "stages": {stage: percentiles(values) for stage, values in stages.items()},
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+# --- Benchmarks ---
+def bench_pipeline(runs, concurrency):
+    from dreamsprout import run_pipeline
+
+    def one_run(i):
+        timer = StageTimer()
+        run_pipeline(f"benchmark dream {i}", ["fox", "moon"], on_progress=timer.update)
+        return timer.finish()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        timers = list(pool.map(one_run, range(runs)))
+    return summarize(timers, time.perf_counter() - start, concurrency)
+
+
+def bench_webapp(runs, concurrency, poll_interval=0.02):
+    import dreamsprout_webapp
+    client = dreamsprout_webapp.app.test_client()
+    # Measure steady state, not the background import of torch/diffusers
+    dreamsprout_webapp.warmup.done.wait()
+
+    def one_run(i):
+        timer = StageTimer()
+        form = {"dream": f"benchmark dream {i}", "elements": "fox, moon", "model": CONFIG["text_model"]["name"]}
+        response = client.post("/start", data=form)
+        while response.status_code == 429:  # queue full; back off like a client would
+            time.sleep(0.1)
+            response = client.post("/start", data=form)
+        run_id = response.get_json()["run_id"]
+        while True:
+            status = client.get(f"/status/{run_id}").get_json()
+            timer.update(status)
+            if status.get("done") or status.get("state") in ("failed", "cancelled"):
+                return timer.finish()
+            time.sleep(poll_interval)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        timers = list(pool.map(one_run, range(runs)))
+    return summarize(timers, time.perf_counter() - start, concurrency)
+
+
+def bench_backends(runs):
+    """Time the eager and fast image backends on the same prompts and seeds.
+
+    Needs the real SDXL weights and, for a meaningful result, a GPU. Load
+    time includes compilation (or a compile-cache load) and warmup.
+    """
+    from dreamsprout import _render_images, build_image_prompt
+    from model_pool import ModelPool
+    from model_registry import ModelRegistry
+    settings = CONFIG["image_model"]
+    prompts = [build_image_prompt(f"{' '.join(WORDS)} (scene {i + 1})") for i in range(runs)]
+    seeds = [settings["parameters"]["seed"] + i for i in range(runs)]
+
+    results = {}
+    for backend in ("eager", "fast"):
+        acceleration = dict(settings["acceleration"], backend=backend)
+        # A private pool that frees each pipeline as soon as it is released
+        with ModelRegistry(pool=ModelPool(max_idle_models=0), acceleration=acceleration) as registry:
+            start = time.perf_counter()
+            registry.register_image_model(settings["name"], settings["model_id"], settings["parameters"])
+            load_seconds = time.perf_counter() - start
+            image_model = registry.get_image_model(settings["name"])
+            timings = []
+            for prompt, seed in zip(prompts, seeds):
+                start = time.perf_counter()
+                _render_images(image_model, [prompt], [seed], 1)
+                timings.append(time.perf_counter() - start)
+        results[registry.backend] = {
+            "load_seconds": round(load_seconds, 2),
+            "per_image": percentiles(timings),
+            "memory_profile": registry.memory_profile
+        }
+
+    eager, fast = results["eager"]["per_image"], results[registry.backend]["per_image"]
+    results["speedup_p50"] = round(eager["p50"] / fast["p50"], 2) if fast["p50"] else None
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DreamSprout offline benchmark")
+    parser.add_argument("--mode", choices=["pipeline", "webapp", "both", "backends"], default="both")
+    parser.add_argument("--runs", type=int, default=4, help="Stories per concurrency level (images per backend with --mode backends)")
+    parser.add_argument("--concurrency", default="1,2,4", help="Comma-separated concurrency levels")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Seconds before the first token")
+    parser.add_argument("--ollama-servers", type=int, default=1, help="Stub Ollama servers to spread text generation over")
+    parser.add_argument("--tokens-per-second", type=float, default=2000.0)
+    parser.add_argument("--story-words", type=int, default=500)
+    parser.add_argument("--steps", type=int, default=CONFIG["image_model"]["parameters"]["num_inference_steps"])
+    parser.add_argument("--step-cost", type=float, default=0.002, help="Seconds per denoising step for one image")
+    parser.add_argument("--quality", choices=list(QUALITY_PRESETS), default=CONFIG["image_model"]["quality"],
+                        help="Quality preset; its step count overrides --steps")
+    parser.add_argument("--use-cache", action="store_true", help="Keep the LLM/image caches enabled")
+    parser.add_argument("--output", help="Write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+
+    # Isolate everything the benchmark writes in a temporary directory
+    workdir = tempfile.mkdtemp(prefix="dreamsprout_bench_")
+    CONFIG["pipeline"]["output_dir"] = f"{workdir}/outputs"
+    CONFIG["gallery"]["index_path"] = f"{workdir}/outputs/runs.sqlite"
+    CONFIG["cache"]["dir"] = f"{workdir}/cache"
+    CONFIG["cache"]["enabled"] = args.use_cache
+    CONFIG["model_pool"]["preload"] = False
+    CONFIG["text_model"]["stream"] = True
+    CONFIG["image_model"]["parameters"]["num_inference_steps"] = args.steps
+    CONFIG["image_model"]["quality"] = args.quality
+
+    if args.mode == "backends":
+        with contextlib.redirect_stdout(sys.stderr):
+            report = {"settings": vars(args), "backends": bench_backends(args.runs)}
+        _write_report(report, args.output)
+        return
+
+    servers, urls = zip(*(
+        start_stub_ollama(args.llm_latency, args.tokens_per_second, args.story_words)
+        for _ in range(args.ollama_servers)
+    ))
+    CONFIG["text_model"]["server_urls"] = list(urls)
+    inject_fake_image_model(args.step_cost)
+
+    # Pipeline progress and story text go to stderr; stdout is kept for the report
+    report = {"settings": vars(args), "pipeline": [], "webapp": []}
+    levels = [int(c) for c in args.concurrency.split(",")]
+    with contextlib.redirect_stdout(sys.stderr):
+        for concurrency in levels:
+            if args.mode in ("pipeline", "both"):
+                report["pipeline"].append(bench_pipeline(args.runs, concurrency))
+            if args.mode in ("webapp", "both"):
+                report["webapp"].append(bench_webapp(args.runs, concurrency))
+    from ollama_runner import get_endpoint_pool
+    report["ollama_servers"] = get_endpoint_pool().status()
+    for server in servers:
+        server.shutdown()
+    _write_report(report, args.output)
+
+def _write_report(report, output=None):
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main()
@@ -4,23 +4,49 @@
 # Uses DreamSprout core functions for story and image generation
 
 import os
-import threading
-import datetime
-from flask import Flask, request, render_template, send_from_directory, jsonify
+import json
+import time
+from flask import Flask, Response, request, render_template, send_from_directory, jsonify, stream_with_context
 # Import DreamSprout pipeline functions and configuration
-from config import CONFIG, AVAILABLE_LLM_MODELS
-from dreamsprout import compress_scene_for_illustration, run_pipeline, generate_story, split_scenes, build_image_prompt, render_storybook_html
-from model_registry import ModelRegistry
-from ollama_runner import OllamaRunner
+from config import CONFIG, AVAILABLE_LLM_MODELS, QUALITY_PRESETS
+from dreamsprout import create_run_dir
+from model_registry import ModelWarmup
+from job_scheduler import QueueFullError, create_scheduler
+from job_queue import get_job_queue
+from progress import ProgressTracker
+from run_index import get_run_index
+from metrics import METRICS, peak_device_memory
+from cache import cache_stats
+from checkpoint import RunCheckpoint, find_orphaned_runs
+from ollama_runner import get_endpoint_pool
+from dreamsprout_worker import run_job
 
 # Initialize Flask app
 app = Flask(__name__)
-progress_tracker = {}
+progress_tracker = ProgressTracker(ttl_seconds=CONFIG["scheduler"]["finished_ttl_seconds"])
+# "inline": a bounded pool of threads in this process runs queued stories.
+# "queue": jobs go to the durable job queue and dreamsprout_worker.py
+# processes run them, so this process never touches the GPU.
+queue_mode = CONFIG["scheduler"]["mode"] == "queue"
+scheduler = get_job_queue() if queue_mode else create_scheduler()
+
+# Gallery index; backfill it from run folders already on disk the first time
+run_index = get_run_index()
+if run_index.is_empty() and os.path.isdir(CONFIG["pipeline"]["output_dir"]):
+    run_index.rebuild_from_disk(CONFIG["pipeline"]["output_dir"])
+
+started_at = time.time()
+warmup = None  # background model warmup, started with the server (see start_background_work)
 
 # Define routes
 @app.route("/", methods=["GET", "POST"])
 def index():
-    return render_template("form.html", models=AVAILABLE_LLM_MODELS)
+    return render_template(
+        "form.html",
+        models=AVAILABLE_LLM_MODELS,
+        qualities=list(QUALITY_PRESETS),
+        default_quality=CONFIG["image_model"]["quality"]
+    )
 
 # Start the DreamSprout pipeline
 @app.route("/start", methods=["POST"])
@@ -28,107 +54,307 @@ def start():
     dream = request.form["dream"]
     elements = request.form["elements"].split(",")
     selected_model = request.form["model"]
+    quality = request.form.get("quality") or CONFIG["image_model"]["quality"]
+    if quality not in QUALITY_PRESETS:
+        return jsonify({"error": f"Unknown quality {quality!r}"}), 400
+
+# Create a unique run ID (and its output folder) using timestamp
+    run_id, output_dir, timestamp = create_run_dir(CONFIG["pipeline"]["output_dir"])
+
+# Queue the run; reject with 429 when the queue is full
+    try:
+        submit_job(run_id, "story", {
+            "output_dir": output_dir, "timestamp": timestamp, "dream": dream, "elements": elements,
+            "text_model": selected_model, "quality": quality
+        }, priority=request.form.get("priority", 0, type=int))
+    except QueueFullError as e:
+        os.rmdir(output_dir)
+        return jsonify({"error": str(e)}), 429
+    return jsonify({"run_id": run_id})
+
+# Start a model comparison: the same dream written by several models, shown side by side
+@app.route("/compare", methods=["POST"])
+def compare():
+    dream = request.form["dream"]
+    elements = request.form["elements"].split(",")
+    models = list(dict.fromkeys(m for m in request.form.getlist("models") if m))
+    quality = request.form.get("quality") or CONFIG["image_model"]["quality"]
+    if quality not in QUALITY_PRESETS:
+        return jsonify({"error": f"Unknown quality {quality!r}"}), 400
+    if len(models) < 2:
+        return jsonify({"error": "Choose at least two models to compare"}), 400
+    unknown = [m for m in models if m not in AVAILABLE_LLM_MODELS]
+    if unknown:
+        return jsonify({"error": f"Unknown models {unknown}"}), 400
+
+    run_id, output_dir, timestamp = create_run_dir(CONFIG["pipeline"]["output_dir"])
+    try:
+        submit_job(run_id, "compare", {
+            "output_dir": output_dir, "timestamp": timestamp, "dream": dream, "elements": elements,
+            "models": models, "quality": quality
+        }, priority=request.form.get("priority", 0, type=int))
+    except QueueFullError as e:
+        os.rmdir(output_dir)
+        return jsonify({"error": str(e)}), 429
+    return jsonify({"run_id": run_id})
+
+# Queue a job (see dreamsprout_worker.run_job for the kinds and their payloads):
+# on the job queue for the workers, or on this process's scheduler with a
+# progress entry for run_id. QueueFullError propagates to the caller.
+def submit_job(run_id, kind, payload, priority=0):
+    if queue_mode:
+        return scheduler.submit(run_id, kind, payload, priority=priority)
+
+    def background_task(job):
+        run_job(job, kind, payload, progress_tracker[run_id], device_slot=scheduler.device_slot)
+
+    progress_tracker.create(run_id, stage="Queued...")
+    try:
+        return scheduler.submit(run_id, background_task, priority=priority)
+    except QueueFullError:
+        progress_tracker.pop(run_id)
+        raise
+
+# Live progress of a run, or None if this process (or the job queue) doesn't have it
+def get_progress(run_id):
+    if queue_mode:
+        return scheduler.progress(run_id)
+    return progress_tracker.get(run_id)
+
+# Resume a checkpointed run from its last finished stage
+def resume_run(checkpoint, priority=0):
+    state = checkpoint.state
+    return submit_job(state["run_id"], "story", {
+        "output_dir": checkpoint.output_dir, "timestamp": state["timestamp"], "dream": state["dream"],
+        "elements": state["elements"], "text_model": state["text_model"],
+        "quality": state.get("quality") or CONFIG["image_model"]["quality"]
+    }, priority=priority)
 
-# Create a unique run ID using timestamp
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    run_id = f"run_{timestamp}"
-    output_dir = os.path.join(CONFIG["pipeline"]["output_dir"], run_id)
-    os.makedirs(output_dir, exist_ok=True)
-
-# Initialize progress tracking
-    progress_tracker[run_id] = {"percent": 0, "stage": "Starting...", "done": False}
-
-# Define the background task for the pipeline
-    def background_task():
-        progress_tracker[run_id].update({"percent": 5, "stage": "Registering image model..."})
-        registry = ModelRegistry()
-# Set up text and image generation models
-
-# Register Ollama text model
-        print("\n--- Registering Text Model ---")
-        ollama_runner = OllamaRunner(model_name=selected_model)
-        registry.register_text_model(selected_model, ollama_runner.generate)
-
-# Register image model
-        print("\n--- Registering Image Model ---")
-        registry.register_image_model(
-            CONFIG["image_model"]["name"],
-            CONFIG["image_model"]["model_id"],
-            CONFIG["image_model"]["parameters"]
-        )
-
-# Generate story
-        print("\n--- Generating Story ---")
-        progress_tracker[run_id].update({"percent": 10, "stage": "Generating story..."})
-        text_model_runner = registry.get_text_model(selected_model)
-        story = generate_story(text_model_runner, dream, elements)
-# Split story into scenes and build image prompts
-        progress_tracker[run_id].update({"percent": 30, "stage": "Splitting scenes..."})
-        scenes = split_scenes(story, CONFIG["pipeline"]["scenes"])
-# Compress each scene using Ollama
-        compressed_scenes = [compress_scene_for_illustration(s, text_model_runner) for s in scenes]
-# Build image prompts from compressed scenes
-        prompts = [build_image_prompt(cs) for cs in compressed_scenes]
-# Generate images for each scene
-        progress_tracker[run_id].update({"percent": 60, "stage": "Creating illustrations..."})
-        image_model = registry.get_image_model(CONFIG["image_model"]["name"])
-        image_paths = []
-        for i, p in enumerate(prompts, start=1):
-            img = image_model(
-                prompt=p,
-                num_inference_steps=CONFIG["image_model"]["parameters"]["num_inference_steps"],
-                guidance_scale=CONFIG["image_model"]["parameters"]["guidance_scale"]
-            ).images[0]
-            path = os.path.join(output_dir, f"scene_{i}.png")
-            img.save(path)
-            image_paths.append(path)
-# Render storybook HTML
-        progress_tracker[run_id].update({"percent": 90, "stage": "Rendering HTML..."})
-
-        html = render_storybook_html(
-            title="My Dream Story",
-            story=story,
-            image_paths=image_paths,
-            text_model=selected_model,
-            image_model=image_model,
-            text_prompt=dream,
-            image_prompts=prompts,
-            timestamp=timestamp
-        )
-
-        with open(os.path.join(output_dir, "storybook.html"), "w", encoding="utf-8") as f:
-            f.write(html)
-
-        progress_tracker[run_id].update({"percent": 100, "stage": "Complete!", "done": True})
-
-# Start the background task
-    threading.Thread(target=background_task).start()
+# Route to resume a failed, cancelled or interrupted run
+@app.route("/resume/<run_id>", methods=["POST"])
+def resume(run_id):
+    checkpoint = RunCheckpoint.load(os.path.join(CONFIG["pipeline"]["output_dir"], run_id))
+    if checkpoint is None:
+        return jsonify({"error": f"Unknown run {run_id}"}), 404
+    job = scheduler.get(run_id)
+    if job is not None and job.state in ("queued", "running"):
+        return jsonify({"error": f"Run {run_id} is already {job.state}"}), 409
+    status = checkpoint.get("status")
+    if status == "done" or (status == "running" and not checkpoint.orphaned):
+        return jsonify({"error": f"Run {run_id} is {status}"}), 409
+    try:
+        resume_run(checkpoint, priority=request.form.get("priority", 0, type=int))
+    except QueueFullError as e:
+        return jsonify({"error": str(e)}), 429
     return jsonify({"run_id": run_id})
 
 # Route to check the status of a run
 @app.route("/status/<run_id>")
 def status(run_id):
-    return jsonify(progress_tracker.get(run_id, {"percent": 0, "stage": "Starting...", "done": False}))
+    run_progress = get_progress(run_id)
+    if run_progress is not None:
+        progress = run_progress.snapshot()
+    else:
+        progress = checkpoint_progress(run_id) or {"percent": 0, "stage": "Starting...", "done": False}
+    progress.update(scheduler.queue_status(run_id))
+    job = scheduler.get(run_id)
+    if job is not None and job.state == "queued":
+        progress["stage"] = f"Queued (position {progress['queue_position']})..."
+    elif job is not None and job.state == "failed":
+        progress["stage"] = f"Failed: {job.error}"
+    elif job is not None and job.state == "cancelled":
+        progress["stage"] = "Cancelled"
+    return jsonify(progress)
 
-# Route to serve output files
-@app.route("/outputs/<run_folder>/<filename>")
+# Route to cancel a queued or running job
+@app.route("/cancel/<run_id>", methods=["POST"])
+def cancel(run_id):
+    if not scheduler.cancel(run_id):
+        return jsonify({"run_id": run_id, "cancelled": False}), 404
+    job = scheduler.get(run_id)
+    run_progress = get_progress(run_id)
+    if job.state == "cancelled" and run_progress is not None:
+        run_progress.update({"stage": "Cancelled", "state": "cancelled"})
+    return jsonify({"run_id": run_id, "cancelled": True})
+
+# Server-sent events: push story text, stage and per-step progress, and scene
+# previews as they happen (the form uses this instead of polling /status)
+@app.route("/stream/<run_id>")
+def stream(run_id):
+    def sse(event, data):
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    run_progress = get_progress(run_id)
+    if run_progress is None:
+        # Finished long ago or before a restart: report the last known state and stop
+        progress = checkpoint_progress(run_id)
+        if progress is None:
+            return jsonify({"error": f"Unknown run {run_id}"}), 404
+        return Response(sse("progress", progress), mimetype="text/event-stream")
+
+    def events():
+        cursor = 0
+        last_queue = None
+        yield sse("progress", run_progress.snapshot())
+        while True:
+            batch, cursor = run_progress.wait_for_events(cursor, timeout=2.0)
+            for event, data in batch:
+                yield sse(event, data)
+            if run_progress.finished:
+                # Send whatever was published between the read and the finish
+                batch, cursor = run_progress.wait_for_events(cursor, timeout=0)
+                for event, data in batch:
+                    yield sse(event, data)
+                return
+            # Queue position changes as other jobs start; report it while waiting
+            queue = scheduler.queue_status(run_id)
+            if queue.get("state") == "queued" and queue != last_queue:
+                last_queue = queue
+                yield sse("queue", queue)
+            elif not batch:
+                yield ": keep-alive\n\n"
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Liveness probe: the process is up and serving requests
+@app.route("/healthz")
+def healthz():
+    return jsonify({
+        "status": "ok",
+        "uptime_seconds": round(time.time() - started_at, 3),
+        "mode": CONFIG["scheduler"]["mode"],
+        "ollama": get_endpoint_pool().status()  # per-server load and health as last observed
+    })
+
+# Readiness probe: 200 once the ML stack is imported and the image model is loaded
+# (in queue mode: once at least one live worker has loaded it)
+@app.route("/readyz")
+def readyz():
+    if queue_mode:
+        workers = scheduler.workers()
+        states = {worker["state"] for worker in workers}
+        state = "ready" if "ready" in states else ("failed" if states == {"failed"} else "pending")
+        status = {"state": state, "workers": workers}
+    elif warmup is not None:
+        status = warmup.status()
+    else:
+        status = {"state": "pending", "error": None, "seconds": None}
+    status["queue_depth"] = scheduler.queue_depth()
+    return jsonify(status), 200 if status["state"] == "ready" else 503
+
+# Last progress recorded in a run's checkpoint, or None if it has none
+def checkpoint_progress(run_id):
+    checkpoint = RunCheckpoint.load(os.path.join(CONFIG["pipeline"]["output_dir"], run_id))
+    if checkpoint is None:
+        return None
+    progress = {"percent": 0, "stage": "Starting...", "done": False}
+    progress.update(checkpoint.get("progress") or {})
+    status = checkpoint.get("status")
+    if status in ("failed", "cancelled"):
+        progress["state"] = status
+        progress["stage"] = f"Failed: {checkpoint.get('error')}" if status == "failed" else "Cancelled"
+    elif status == "running" and checkpoint.orphaned:
+        progress["state"] = "interrupted"
+        progress["stage"] = "Interrupted; resume it with POST /resume/" + run_id
+    return progress
+
+# Prometheus metrics: stage timings, token rates, model loads, queue and cache state
+@app.route("/metrics")
+def metrics():
+    METRICS.set("dreamsprout_queue_depth", scheduler.queue_depth())
+    for kind, stats in cache_stats().items():
+        for event in ("hits", "misses", "coalesced", "evictions"):
+            METRICS.set("dreamsprout_cache_events", stats[event], cache=kind, event=event)
+    peak_device_memory()
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+# Route to serve output files (comparison runs keep each model's files in a sub-folder).
+# Scene images never change once written, so browsers may cache them for good;
+# pages and manifests carry an ETag and are revalidated on every visit.
+@app.route("/outputs/<run_folder>/<path:filename>")
 def serve_output(run_folder, filename):
-    return send_from_directory(os.path.join("outputs", run_folder), filename)
+    # Absolute, as the pipeline resolves output_dir from the working directory (Flask would use the app's root)
+    directory = os.path.join(os.path.abspath(CONFIG["pipeline"]["output_dir"]), run_folder)
+    if os.path.basename(filename).startswith("scene_"):
+        response = send_from_directory(directory, filename, max_age=CONFIG["images"]["cache_max_age"])
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response = send_from_directory(directory, filename, max_age=0)
+        response.cache_control.no_cache = True
+    return response
 
-# Route to display the gallery of past runs
+# Route to display the gallery of past runs, one page at a time from the run index
 @app.route("/gallery")
 def gallery():
-    output_root = CONFIG["pipeline"]["output_dir"]
-    runs = []
-    for folder in sorted(os.listdir(output_root), reverse=True):
-        run_path = os.path.join(output_root, folder)
-        if os.path.isdir(run_path) and "storybook.html" in os.listdir(run_path):
-            runs.append({
-                "name": folder,
-                "link": f"/outputs/{folder}/storybook.html"
-            })
-    return render_template("gallery.html", runs=runs)
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = CONFIG["gallery"]["per_page"]
+    sort = request.args.get("sort", "created")
+    order = request.args.get("order", "desc")
+    model = request.args.get("model") or None
+    query = request.args.get("q") or None
+
+    runs, total = run_index.list_runs(
+        page=page, per_page=per_page, sort=sort, descending=(order != "asc"),
+        text_model=model, query=query
+    )
+    for run in runs:
+        run["name"] = run["run_id"]
+        run["link"] = f"/outputs/{run['html_path']}"
+        run["thumbnail_link"] = f"/outputs/{run['thumbnail']}" if run["thumbnail"] else None
+    return render_template(
+        "gallery.html",
+        runs=runs,
+        page=page,
+        pages=max(1, -(-total // per_page)),
+        total=total,
+        sort=sort,
+        order=order,
+        model=model or "",
+        query=query or "",
+        models=run_index.text_models()
+    )
+
+# Re-queue runs that a crash or restart left unfinished. In queue mode a run
+# whose worker died is requeued by its lease, so only runs not in the queue are.
+def resume_interrupted_runs():
+    for checkpoint in find_orphaned_runs(CONFIG["pipeline"]["output_dir"]):
+        job = scheduler.get(checkpoint.get("run_id"))
+        if job is not None and job.state in ("queued", "running"):
+            continue
+        try:
+            resume_run(checkpoint)
+        except QueueFullError:
+            print("Job queue is full; resume the remaining interrupted runs with POST /resume/<run_id>")
+            break
+        print(f"Resuming interrupted run {checkpoint.get('run_id')}")
+
+# The debug reloader also imports this module in a watcher process that never
+# serves requests; background work belongs only in the process that does
+def is_serving_process(debug):
+    return not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true"
+
+# Work that starts with the server rather than on import. Importing torch/diffusers
+# and warming the shared model pool happen in the background, so the gallery,
+# status and health routes answer while CUDA initialises and the first /start
+# doesn't pay the SDXL load. In queue mode the workers own the models.
+def start_background_work():
+    global warmup
+    if not queue_mode:
+        warmup = ModelWarmup(preload=CONFIG["model_pool"]["preload"]).start()
+    if CONFIG["pipeline"]["resume_on_start"]:
+        resume_interrupted_runs()
+
+# Loaded by `flask run` or a WSGI server
+if __name__ != "__main__" and is_serving_process(app.debug):
+    start_background_work()
 
 # Run the Flask app
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    if is_serving_process(debug=True):
+        start_background_work()
+    app.run(debug=True)
@@ -0,0 +1,212 @@
+# dreamsprout_worker.py
+# Out-of-process worker for DreamSprout jobs.
+# Holds the shared image model pool and runs jobs from the durable job queue
+# (job_queue.py), so the web app can reload or crash without killing
+# in-flight stories or unloading SDXL. Start one worker per GPU, or several
+# CPU workers, against the same queue, from the project folder:
+#   python dreamsprout_worker.py --device cuda:0
+#   python dreamsprout_worker.py --device cuda:1
+# and set CONFIG["scheduler"]["mode"] = "queue" for the web app.
+# run_job() is also what the web app runs on its own threads in "inline" mode.
+
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from config import CONFIG
+from checkpoint import RunCheckpoint
+from comparison import run_comparison
+from job_queue import QueueProgress, get_job_queue
+from job_scheduler import JobCancelled
+from metrics import METRICS, RunMetrics
+from model_registry import ModelRegistry, ModelWarmup
+from pipeline_engine import StoryPipeline
+
+
+# Run one job and report into run_progress (a RunProgress or QueueProgress).
+# kind is "story" (a new run, or a checkpointed one to resume) or "compare".
+def run_job(job, kind, payload, run_progress, device_slot=None):
+    queue_wait = job.started_at - job.submitted_at
+    METRICS.observe("dreamsprout_queue_wait_seconds", queue_wait)
+    try:
+        # Cancelled after being taken off the queue but before starting
+        job.check_cancelled()
+        JOB_KINDS[kind](job, payload, run_progress, device_slot, queue_wait)
+    except Exception as e:
+        # A job whose lease was lost belongs to another worker now; leave its progress alone
+        if not getattr(job, "lease_lost", False):
+            if isinstance(e, JobCancelled):
+                run_progress.update({"stage": "Cancelled", "state": "cancelled"})
+            else:
+                run_progress.update({"stage": f"Failed: {e}", "state": "failed"})
+        raise
+
+
+def _run_story(job, payload, run_progress, device_slot, queue_wait):
+    on_token = None
+    if CONFIG["text_model"]["stream"]:
+        on_token = lambda token: run_progress.publish("story", token)
+    # Only the newest preview of each scene is kept for clients that connect later
+    on_preview = lambda preview: run_progress.publish("preview", preview, key=preview["scene"])
+    metrics = RunMetrics(job.run_id)
+    metrics.record("queue_wait_seconds", round(queue_wait, 4))
+    # A folder with a checkpoint is resumed: a /resume, or a job requeued after its worker was lost
+    checkpoint = RunCheckpoint.load(payload["output_dir"])
+    with ModelRegistry() as registry:
+        pipeline = StoryPipeline(
+            registry,
+            payload["text_model"],
+            on_progress=run_progress.update,
+            on_token=on_token,
+            check_cancelled=job.check_cancelled,
+            device_slot=device_slot,
+            metrics=metrics,
+            quality=payload["quality"],
+            on_preview=on_preview
+        )
+        pipeline.run(payload["dream"], payload["elements"], payload["output_dir"], payload["timestamp"],
+                     checkpoint=checkpoint)
+
+
+def _run_comparison(job, payload, run_progress, device_slot, queue_wait):
+    run_comparison(
+        payload["dream"], payload["elements"], payload["models"], payload["output_dir"], payload["timestamp"],
+        quality=payload["quality"],
+        on_progress=run_progress.update,
+        check_cancelled=job.check_cancelled,
+        device_slot=device_slot
+    )
+
+
+JOB_KINDS = {"story": _run_story, "compare": _run_comparison}
+
+
+class Worker:
+    def __init__(self, queue, worker_id: str, device: str = "auto", slots: int = None, device_slots: int = None):
+        """
+        slots: jobs run at once (text stages overlap); device_slots: jobs on the image model at once.
+        """
+        self.queue = queue
+        self.worker_id = worker_id
+        self.device = device
+        self.slots = slots or CONFIG["scheduler"]["workers"]
+        self.poll_seconds = 0.5
+        self._device = threading.BoundedSemaphore(device_slots or CONFIG["scheduler"]["device_slots"])
+        self._stopping = threading.Event()
+        self._active = {}  # run_id -> QueuedJob
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def device_slot(self):
+        """Hold one of the device slots while running GPU work."""
+        with self._device:
+            yield
+
+    def run(self):
+        """Claim and run jobs until interrupted; the first Ctrl+C (or SIGTERM)
+        stops taking jobs and finishes the running ones, a second quits now."""
+        self.queue.register_worker(self.worker_id, socket.gethostname(), os.getpid(), self.device, self.slots)
+        warmup = ModelWarmup(preload=CONFIG["model_pool"]["preload"]).start()
+        threads = [
+            threading.Thread(target=self._job_loop, name=f"dreamsprout-job-{i}", daemon=True)
+            for i in range(self.slots)
+        ]
+        for thread in threads:
+            thread.start()
+        print(f"Worker {self.worker_id} on {self.device} running {self.slots} jobs at once from {self.queue.path}")
+
+        try:
+            try:
+                self._heartbeat_until(lambda: self._stopping.is_set(), warmup)
+            except KeyboardInterrupt:
+                self._stopping.set()
+                print(f"Stopping: finishing {len(self._active)} running jobs (Ctrl+C again to quit now)")
+                self._heartbeat_until(lambda: not any(thread.is_alive() for thread in threads), warmup)
+        except KeyboardInterrupt:
+            # Leases run out and other workers resume the jobs from their checkpoints
+            print("Quitting with jobs still running; they are requeued once their leases expire")
+        finally:
+            self.queue.remove_worker(self.worker_id)
+
+    # Renew this worker's and its jobs' heartbeats until done() is true
+    def _heartbeat_until(self, done, warmup):
+        interval = CONFIG["scheduler"]["heartbeat_seconds"]
+        while not done():
+            self.queue.worker_heartbeat(self.worker_id, warmup.state, warmup.error)
+            with self._lock:
+                jobs = list(self._active.values())
+            for job in jobs:
+                if not self.queue.heartbeat(job):
+                    print(f"Job {job.run_id}: lease lost to another worker; stopping it")
+            time.sleep(interval)
+
+    def _job_loop(self):
+        while not self._stopping.is_set():
+            job = self.queue.claim(self.worker_id)
+            if job is None:
+                self._stopping.wait(self.poll_seconds)
+                continue
+            with self._lock:
+                self._active[job.run_id] = job
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    del self._active[job.run_id]
+
+    def _run(self, job):
+        print(f"Job {job.run_id} ({job.kind}, attempt {job.attempts}) started")
+        state, error = "done", None
+        try:
+            run_job(job, job.kind, job.payload, QueueProgress(self.queue, job.run_id), device_slot=self.device_slot)
+        except JobCancelled:
+            state = "cancelled"
+        except Exception as e:
+            state, error = "failed", str(e)
+            print(f"Job {job.run_id} failed: {e}")
+        if job.lease_lost or not self.queue.finish(job, state, error):
+            print(f"Job {job.run_id}: lease lost; its outcome here is discarded")
+        else:
+            print(f"Job {job.run_id} {state}")
+
+
+# Pin this process to one device before torch is imported: "cuda:N", "cpu" or "auto"
+def select_device(device: str):
+    if device == "cpu":
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    elif device.startswith("cuda:"):
+        os.environ["CUDA_VISIBLE_DEVICES"] = device[len("cuda:"):]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DreamSprout worker: runs jobs from the durable job queue")
+    parser.add_argument("--device", default="auto",
+                        help="cuda:N to use one GPU, cpu, or auto (default)")
+    parser.add_argument("--slots", type=int, default=CONFIG["scheduler"]["workers"],
+                        help="Jobs run at once (text stages overlap)")
+    parser.add_argument("--device-slots", type=int, default=CONFIG["scheduler"]["device_slots"],
+                        help="Jobs allowed on the image model at once")
+    parser.add_argument("--queue", default=CONFIG["scheduler"]["queue_path"],
+                        help="Job queue database shared with the web app")
+    parser.add_argument("--id", dest="worker_id",
+                        help="Worker name shown in /readyz (default: host:pid)")
+    args = parser.parse_args()
+
+    select_device(args.device)
+    CONFIG["scheduler"]["queue_path"] = args.queue
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    worker = Worker(
+        get_job_queue(),
+        args.worker_id or f"{socket.gethostname()}:{os.getpid()}",
+        device=args.device,
+        slots=max(1, args.slots),
+        device_slots=max(1, args.device_slots)
+    )
+    worker.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# html_renderer.py
+# Renders DreamSprout's HTML pages (storybooks and model comparisons).
+# One Jinja2 environment per process loads templates from the project's
+# templates folder, wherever the process was started, and keeps compiled
+# templates on disk (cache/jinja) so new processes skip parsing them.
+# Pages are streamed straight into their file and moved into place once
+# complete. rerender_all() regenerates every stored page from the runs'
+# checkpoints, e.g. after a template change, in parallel across cores.
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from config import CONFIG
+from checkpoint import RunCheckpoint
+from image_writer import picture_sources
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+STORYBOOK_TEMPLATE = "storybook_template.html"
+STORYBOOK_PAGE = "storybook.html"
+STORYBOOK_TITLE = "My Dream Story"
+
+
+_environment = None
+_environment_lock = threading.Lock()
+
+# Shared Jinja2 environment for this process. Edited templates are picked up
+# on their next use (auto_reload checks the file's mtime).
+def get_environment() -> Environment:
+    global _environment
+    with _environment_lock:
+        if _environment is None:
+            cache_dir = os.path.join(CONFIG["cache"]["dir"], "jinja")
+            os.makedirs(cache_dir, exist_ok=True)
+            _environment = Environment(
+                loader=FileSystemLoader(TEMPLATE_DIR),
+                bytecode_cache=FileSystemBytecodeCache(cache_dir),
+                auto_reload=True
+            )
+        return _environment
+
+
+# Stream a template into path; readers never see a half-written page
+def write_page(template_name: str, path: str, **context) -> str:
+    template = get_environment().get_template(template_name)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        template.stream(**context).dump(f)
+    os.replace(tmp_path, path)
+    return path
+
+
+# Interleave the story's paragraphs with its images, evenly spaced.
+# image_entries are the image_writer manifest entries for image_paths, if any;
+# with them, scenes are shown through <picture> with WebP/JPEG srcsets.
+def storybook_scenes(story: str, image_paths: list[str], image_entries: list[dict] = None) -> list[dict]:
+    paragraphs = [p.strip() for p in story.split("\n") if p.strip()]
+    scenes = []
+    fig_index = 0
+    for i, p in enumerate(paragraphs):
+        image = None
+        picture = None
+        if fig_index < len(image_paths) and (i+1) % max(1, len(paragraphs)//len(image_paths)) == 0:
+            image = os.path.basename(image_paths[fig_index])
+            if image_entries:
+                picture = picture_sources(image_entries[fig_index])
+            fig_index += 1
+        scenes.append({"text": p, "image": image, "picture": picture})
+    return scenes
+
+
+# Template variables for a storybook; the metadata block is left out without text_model
+def storybook_context(title, story, image_paths, text_model=None, image_model=None, text_prompt=None,
+                      image_prompts=None, timestamp=None, image_entries=None) -> dict:
+    return {
+        "title": title,
+        "scenes": storybook_scenes(story, image_paths, image_entries),
+        "text_model": text_model,
+        "image_model": image_model,
+        "text_prompt": text_prompt,
+        "image_prompts": image_prompts or [],
+        "timestamp": timestamp
+    }
+
+
+# Render the story and images into an HTML storybook
+def render_storybook_html(title: str, story: str, image_paths: list[str], text_model: str = None,
+                          image_model: str = None, text_prompt: str = None, image_prompts: list[str] = None,
+                          timestamp: str = None, image_entries: list[dict] = None) -> str:
+    context = storybook_context(title, story, image_paths, text_model, image_model, text_prompt,
+                                image_prompts, timestamp, image_entries)
+    return get_environment().get_template(STORYBOOK_TEMPLATE).render(**context)
+
+
+# Simple storybook: the story and its images without the metadata block
+def render_storybook_html_alt(title: str, story: str, image_paths: list[str]) -> str:
+    return render_storybook_html(title, story, image_paths)
+
+
+# Stream a storybook into output_dir/storybook.html; returns its path
+def write_storybook(output_dir: str, title: str, story: str, image_paths: list[str], **metadata) -> str:
+    context = storybook_context(title, story, image_paths, **metadata)
+    return write_page(STORYBOOK_TEMPLATE, os.path.join(output_dir, STORYBOOK_PAGE), **context)
+
+
+# --- Bulk re-render ---
+# Re-render one finished run folder (storybook or comparison) from its checkpoint.
+# Returns the page's path, or None if the folder has nothing to render from.
+def rerender_run(run_dir: str):
+    if os.path.isfile(os.path.join(run_dir, "comparison.json")):
+        # Imported here because comparison builds on the pipeline, which uses this module
+        from comparison import rerender_comparison
+        return rerender_comparison(run_dir)
+    checkpoint = RunCheckpoint.load(run_dir)
+    if checkpoint is None or checkpoint.get("status") != "done":
+        return None
+    state = checkpoint.state
+    image_entries = [entry for _, entry in sorted(checkpoint.images().items())]
+    return write_storybook(
+        run_dir,
+        title=STORYBOOK_TITLE,
+        story=state["story"],
+        image_paths=[entry["png"] for entry in image_entries],
+        text_model=state["text_model"],
+        image_model=state.get("image_model") or CONFIG["image_model"]["model_id"],
+        text_prompt=state["dream"],
+        image_prompts=[prompt for _, prompt in sorted(checkpoint.prompts().items())],
+        timestamp=state["timestamp"],
+        image_entries=image_entries
+    )
+
+
+def _rerender_safely(run_dir):
+    try:
+        return run_dir, rerender_run(run_dir), None
+    except Exception as e:
+        return run_dir, None, str(e)
+
+
+def rerender_all(output_root: str, jobs: int = None) -> dict:
+    """Regenerate every stored page under output_root, one run folder per task
+    over jobs processes (default: one per core). Returns counts by outcome."""
+    if not os.path.isdir(output_root):
+        return {"rendered": 0, "skipped": 0, "failed": 0}
+    run_dirs = sorted(entry.path for entry in os.scandir(output_root) if entry.is_dir())
+    counts = {"rendered": 0, "skipped": 0, "failed": 0}
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        for run_dir, page, error in pool.map(_rerender_safely, run_dirs, chunksize=4):
+            if error is not None:
+                counts["failed"] += 1
+                print(f"Could not re-render {run_dir}: {error}")
+            else:
+                counts["rendered" if page else "skipped"] += 1
+    return counts
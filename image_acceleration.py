@@ -0,0 +1,108 @@
+# image_acceleration.py
+# Opt-in "fast" backend for SDXL pipelines.
+# Applies channels-last memory format, fused QKV attention projections,
+# optional int8 quantization (via torchao) and torch.compile to the UNet,
+# text encoders and VAE decoder, then runs a short warmup so compilation
+# happens when the model pool loads the pipeline, not on a user's first story.
+# Inductor/Triton compile caches are kept on disk so restarts reuse them.
+
+import importlib.util
+import os
+
+QUANTIZATION_MODES = (None, "int8", "int8_weight_only")
+
+
+# Label used in pool and cache keys, e.g. "eager" or "fast+int8_weight_only".
+# Names what is actually applied: without torchao there is no quantization.
+def backend_label(acceleration: dict) -> str:
+    if not acceleration or acceleration.get("backend", "eager") != "fast":
+        return "eager"
+    quantization = acceleration.get("quantization")
+    return f"fast+{quantization}" if quantization and torchao_available() else "fast"
+
+
+def torchao_available() -> bool:
+    return importlib.util.find_spec("torchao") is not None
+
+
+# Point the Inductor and Triton caches at a persistent directory.
+# Must run before the first torch.compile call in this process.
+def configure_compile_cache(cache_dir: str):
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_dir, "inductor"))
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(cache_dir, "triton"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+    import torch._inductor.config as inductor_config
+    inductor_config.fx_graph_cache = True
+
+
+# Apply the fast backend to a loaded pipeline in place and return it.
+# Steps that don't fit the memory profile are adapted: compilation does not
+# work with sequential offload hooks, model offload hooks break the graph (so
+# it is compiled without fullgraph), and fused QKV replaces sliced attention.
+def accelerate_pipeline(pipe, acceleration: dict, profile: dict):
+    import torch
+    quantization = acceleration.get("quantization")
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization {quantization!r}; choose from {QUANTIZATION_MODES}")
+
+    if acceleration.get("channels_last", True):
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+
+    if acceleration.get("fuse_qkv", True) and profile["attention"] != "sliced":
+        # Uses PyTorch SDPA with one fused projection per attention block
+        pipe.fuse_qkv_projections()
+
+    if quantization:
+        _quantize(pipe, quantization)
+
+    if profile["offload"] == "sequential":
+        print("Skipping torch.compile: not supported with sequential CPU offload")
+        return pipe
+
+    configure_compile_cache(acceleration.get("compile_cache_dir", "cache/torch_compile"))
+    import torch._inductor.config as inductor_config
+    # Settings recommended by diffusers for compiling SDXL
+    inductor_config.conv_1x1_as_mm = True
+    inductor_config.coordinate_descent_tuning = True
+    inductor_config.epilogue_fusion = False
+    inductor_config.coordinate_descent_check_all_directions = True
+
+    mode = acceleration.get("compile_mode", "max-autotune")
+    fullgraph = profile["offload"] is None
+    pipe.unet = torch.compile(pipe.unet, mode=mode, fullgraph=fullgraph)
+    pipe.vae.decode = torch.compile(pipe.vae.decode, mode=mode, fullgraph=fullgraph)
+    return pipe
+
+
+# Quantize the UNet and both text encoders with torchao, if it is installed
+def _quantize(pipe, quantization: str):
+    if not torchao_available():
+        print(f"Warning: torchao is not installed; skipping {quantization} quantization (backend runs as \"fast\")")
+        return
+    from torchao.quantization import (
+        Int8DynamicActivationInt8WeightConfig,
+        Int8WeightOnlyConfig,
+        quantize_,
+    )
+    config = Int8WeightOnlyConfig() if quantization == "int8_weight_only" else Int8DynamicActivationInt8WeightConfig()
+    for module in (pipe.unet, pipe.text_encoder, pipe.text_encoder_2):
+        if module is not None:
+            quantize_(module, config)
+
+
+# Run a few denoising steps at every batch size the pipeline will see,
+# so compilation (or a compile-cache load) happens now
+def warmup_pipeline(pipe, steps: int, resolution, batch_sizes):
+    width, height = resolution
+    for batch_size in sorted(set(batch_sizes)):
+        pipe(
+            prompt=["warmup"] * batch_size,
+            negative_prompt=[""] * batch_size,
+            num_inference_steps=max(1, steps),
+            width=width,
+            height=height
+        )
@@ -0,0 +1,91 @@
+# image_previews.py
+# Cheap previews of scenes while they denoise.
+# Every few steps the current latents are decoded with a tiny autoencoder
+# (TAESDXL) instead of the full SDXL VAE, or with a fixed linear
+# latent-to-RGB projection when the tiny autoencoder can't be loaded, and
+# sent to the browser as small JPEG data URIs.
+
+import base64
+import io
+import threading
+
+from config import CONFIG
+
+# Approximate RGB of each SDXL latent channel, plus a bias (as used by ComfyUI)
+LATENT_RGB_FACTORS = [
+    [0.3651, 0.4232, 0.4341],
+    [-0.2533, -0.0042, 0.1068],
+    [0.1076, 0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+]
+LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
+
+class PreviewDecoder:
+    def __init__(self, method: str = "taesd", tiny_vae: str = "madebyollin/taesdxl", size: int = 256):
+        """
+        method: "taesd" (tiny autoencoder, falls back to "linear") or "linear".
+        size: maximum preview width in pixels.
+        """
+        self.method = method
+        self.tiny_vae = tiny_vae
+        self.size = size
+        self._vae = None
+        self._lock = threading.Lock()
+
+    def decode(self, latents) -> list:
+        """PIL preview images for a batch of SDXL latents."""
+        import torch
+        with torch.no_grad():
+            if self.method == "taesd" and self._load_vae(latents):
+                vae = self._vae
+                images = vae.decode(latents.to(vae.device, vae.dtype)).sample / 2 + 0.5
+            else:
+                factors = torch.tensor(LATENT_RGB_FACTORS, device=latents.device, dtype=torch.float32)
+                bias = torch.tensor(LATENT_RGB_BIAS, device=latents.device, dtype=torch.float32)
+                rgb = torch.einsum("bchw,cr->brhw", latents.float(), factors) + bias[:, None, None]
+                images = rgb / 2 + 0.5
+            images = images.clamp(0, 1).mul(255).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+        return [self._resize(image) for image in images]
+
+    # Load the tiny autoencoder next to the latents once; False if it isn't available
+    def _load_vae(self, latents) -> bool:
+        with self._lock:
+            if self._vae is None:
+                try:
+                    from diffusers import AutoencoderTiny
+                    self._vae = AutoencoderTiny.from_pretrained(self.tiny_vae, torch_dtype=latents.dtype).to(latents.device)
+                except Exception as e:
+                    print(f"Tiny autoencoder {self.tiny_vae} unavailable ({e}); using linear previews")
+                    self.method = "linear"
+                    return False
+            return True
+
+    def _resize(self, array):
+        from PIL import Image
+        img = Image.fromarray(array)
+        if img.width != self.size:
+            img = img.resize((self.size, round(img.height * self.size / img.width)), Image.BILINEAR)
+        return img
+
+
+# Encode a preview as a data URI small enough to send as one SSE event
+def preview_data_uri(img, quality: int = 60) -> str:
+    buffer = io.BytesIO()
+    img.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+_decoder = None
+_decoder_lock = threading.Lock()
+
+# Shared preview decoder for this process, or None if previews are off
+def get_preview_decoder():
+    global _decoder
+    settings = CONFIG["images"]["previews"]
+    if not settings["enabled"]:
+        return None
+    with _decoder_lock:
+        if _decoder is None:
+            _decoder = PreviewDecoder(settings["decoder"], settings["tiny_vae"], settings["size"])
+        return _decoder
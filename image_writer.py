@@ -0,0 +1,114 @@
+# image_writer.py
+# Background pool that writes rendered scenes to disk off the denoising loop.
+# Each scene is saved as the full-size PNG plus smaller WebP/JPEG display and
+# thumbnail variants. The storybook page loads the variants through srcset;
+# images.json in the run folder lists every file written for each scene.
+
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import CONFIG
+
+FORMATS = {"webp": ("WEBP", "webp", "image/webp"), "jpeg": ("JPEG", "jpg", "image/jpeg")}
+
+
+class ImageWriter:
+    def __init__(self, workers: int = 2, sizes: dict = None, formats: list = None, quality: int = 80):
+        """
+        sizes: variant name -> maximum width in pixels ("display" keeps the plain scene_N name).
+        formats: keys of FORMATS written for every size, preferred format first.
+        """
+        self.sizes = sizes or {"display": 768, "thumb": 256}
+        self.formats = formats or ["webp", "jpeg"]
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dreamsprout-writer")
+
+    def submit(self, img, output_dir: str, scene: int):
+        """Queue one scene image; the future resolves to its manifest entry."""
+        return self._executor.submit(self.write, img, output_dir, scene)
+
+    def write(self, img, output_dir: str, scene: int) -> dict:
+        """Write scene_<scene>.png and its variants, returning the manifest entry."""
+        from PIL import Image
+        stem = f"scene_{scene}"
+        entry = {"scene": scene, "png": f"{stem}.png", "width": img.width, "height": img.height, "variants": []}
+        _save_atomic(img, os.path.join(output_dir, entry["png"]), "PNG")
+
+        rgb = img.convert("RGB")
+        for size, max_width in self.sizes.items():
+            resized = rgb
+            if rgb.width > max_width:
+                resized = rgb.resize((max_width, round(rgb.height * max_width / rgb.width)), Image.LANCZOS)
+            suffix = "" if size == "display" else f"_{size}"
+            for fmt in self.formats:
+                pil_format, ext, _ = FORMATS[fmt]
+                filename = f"{stem}{suffix}.{ext}"
+                path = os.path.join(output_dir, filename)
+                _save_atomic(resized, path, pil_format, quality=self.quality)
+                entry["variants"].append({
+                    "size": size, "format": fmt, "file": filename,
+                    "width": resized.width, "bytes": os.path.getsize(path)
+                })
+        return entry
+
+
+# Save through a temporary file so a half-written image is never served
+def _save_atomic(img, path, pil_format, **options):
+    tmp_path = f"{path}.tmp"
+    img.save(tmp_path, format=pil_format, **options)
+    os.replace(tmp_path, path)
+
+
+# File name of one variant of a manifest entry, or None
+def variant_file(entry: dict, size: str, fmt: str):
+    return next((v["file"] for v in entry["variants"] if v["size"] == size and v["format"] == fmt), None)
+
+
+# <picture> sources for a manifest entry: one srcset per format, widths ascending.
+# The last format is the <img> fallback.
+def picture_sources(entry: dict, formats: list = None) -> dict:
+    formats = formats or list(dict.fromkeys(v["format"] for v in entry["variants"]))
+    srcsets = {}
+    for fmt in formats:
+        by_width = {}
+        for v in sorted(entry["variants"], key=lambda v: -v["bytes"]):
+            if v["format"] == fmt:
+                by_width[v["width"]] = v  # smallest file wins when sizes coincide
+        srcsets[fmt] = ", ".join(f"{by_width[w]['file']} {w}w" for w in sorted(by_width))
+    fallback = formats[-1]
+    return {
+        "sources": [{"type": FORMATS[fmt][2], "srcset": srcsets[fmt]} for fmt in formats[:-1]],
+        "src": variant_file(entry, "display", fallback) or entry["png"],
+        "srcset": srcsets[fallback],
+        "width": entry["width"],
+        "height": entry["height"]
+    }
+
+
+# Write images.json listing every scene's files
+def write_manifest(entries: list[dict], output_dir: str) -> str:
+    path = os.path.join(output_dir, "images.json")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"scenes": sorted(entries, key=lambda e: e["scene"])}, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+# Shared writer pool for this process
+def get_image_writer() -> ImageWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            settings = CONFIG["images"]
+            _writer = ImageWriter(
+                workers=settings["writer_threads"],
+                sizes=settings["sizes"],
+                formats=settings["formats"],
+                quality=settings["quality"]
+            )
+        return _writer
@@ -0,0 +1,443 @@
+# job_queue.py
+# Durable job queue shared by the web app and worker processes, stored in SQLite.
+# With CONFIG["scheduler"]["mode"] = "queue" the web app only enqueues jobs
+# and reads their progress; dreamsprout_worker.py processes (one per device,
+# or several CPU workers) claim and run them. A claimed job is leased to its
+# worker, which renews the lease with heartbeats. If the worker dies, the
+# job goes back on the queue once the lease runs out and the next worker
+# resumes it from the run's checkpoint.
+# Progress and SSE events are written to the same database, so the web app
+# can follow a job that runs in another process, and survive its own restarts.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from config import CONFIG
+from checkpoint import RunCheckpoint
+from job_scheduler import JobCancelled, QueueFullError
+
+FINISHED_STATES = ("done", "failed", "cancelled")
+PROGRESS_KEY = ""  # events table key of the progress snapshot (one per job)
+
+
+class QueuedJob:
+    """One row of the jobs table; a worker's handle on the job it claimed."""
+
+    def __init__(self, row):
+        self.run_id = row["run_id"]
+        self.kind = row["kind"]
+        self.payload = json.loads(row["payload"])
+        self.priority = row["priority"]
+        self.state = row["state"]  # queued -> running -> done | failed | cancelled
+        self.error = row["error"]
+        self.worker = row["worker"]
+        self.attempts = row["attempts"]
+        self.submitted_at = row["submitted_at"]
+        self.started_at = row["started_at"]
+        self.finished_at = row["finished_at"]
+        self.lease_lost = False
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        """Call between stages so a cancelled run stops at the next boundary."""
+        if self._cancelled.is_set():
+            raise JobCancelled(self.run_id)
+
+
+class JobQueue:
+    def __init__(self, path: str, max_queue_depth=8, lease_seconds=30, max_attempts=3, finished_ttl_seconds=600):
+        self.path = path
+        self.max_queue_depth = max_queue_depth
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.finished_ttl_seconds = finished_ttl_seconds
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Transactions are explicit (BEGIN IMMEDIATE), so claims are atomic across processes
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    run_id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    state TEXT NOT NULL,
+                    progress TEXT NOT NULL,
+                    error TEXT,
+                    worker TEXT,
+                    lease_until REAL,
+                    cancel_requested INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    submitted_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    run_id TEXT NOT NULL,
+                    event TEXT NOT NULL,
+                    key TEXT,
+                    data TEXT NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS events_run ON events (run_id, id)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS workers (
+                    worker_id TEXT PRIMARY KEY,
+                    host TEXT,
+                    pid INTEGER,
+                    device TEXT,
+                    slots INTEGER,
+                    state TEXT,
+                    error TEXT,
+                    started_at REAL,
+                    heartbeat_at REAL
+                )""")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    # --- Submission and cancellation (web app) ---
+    def submit(self, run_id: str, kind: str, payload: dict, priority: int = 0) -> QueuedJob:
+        """Queue a job for the workers; raises QueueFullError when full.
+
+        Submitting a run_id again (e.g. to resume it) replaces its old job.
+        """
+        now = time.time()
+        progress = {"percent": 0, "stage": "Queued...", "done": False}
+        with self._transaction() as conn:
+            waiting = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+            if waiting >= self.max_queue_depth:
+                raise QueueFullError(f"Job queue is full ({self.max_queue_depth} waiting)")
+            self._forget_finished(conn, now)
+            conn.execute("DELETE FROM events WHERE run_id = ?", (run_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (run_id, kind, payload, priority, state, progress, submitted_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (run_id, kind, json.dumps(payload), priority, json.dumps(progress), now)
+            )
+            self._append(conn, run_id, "progress", progress, PROGRESS_KEY)
+        return self.get(run_id)
+
+    def cancel(self, run_id: str) -> bool:
+        """Cancel a queued job outright, or flag a running job to stop."""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT state FROM jobs WHERE run_id = ?", (run_id,)).fetchone()
+            if row is None or row["state"] in FINISHED_STATES:
+                return False
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE run_id = ?", (run_id,))
+            if row["state"] == "queued":
+                conn.execute("UPDATE jobs SET state = 'cancelled', finished_at = ? WHERE run_id = ?",
+                             (time.time(), run_id))
+                self._merge_progress(conn, run_id, {"stage": "Cancelled", "state": "cancelled"})
+        return True
+
+    # --- Leases (workers) ---
+    def claim(self, worker_id: str):
+        """Lease the next queued job to worker_id, or return None if there is none.
+
+        Jobs whose worker stopped heartbeating are put back on the queue first.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            self._requeue_expired(conn, now)
+            row = conn.execute(
+                "SELECT run_id FROM jobs WHERE state = 'queued' ORDER BY priority, rowid LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET state = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                "started_at = ? WHERE run_id = ?",
+                (worker_id, now + self.lease_seconds, now, row["run_id"])
+            )
+            return QueuedJob(conn.execute("SELECT * FROM jobs WHERE run_id = ?", (row["run_id"],)).fetchone())
+
+    def heartbeat(self, job: QueuedJob) -> bool:
+        """Renew the job's lease; flags the job cancelled if a cancel was
+        requested or the lease was lost. Returns False once the lease is lost."""
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE run_id = ? AND worker = ? AND state = 'running'",
+                (time.time() + self.lease_seconds, job.run_id, job.worker)
+            ).rowcount
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE run_id = ?", (job.run_id,)).fetchone()
+        if not updated:
+            job.lease_lost = True
+            job._cancelled.set()
+            return False
+        if row["cancel_requested"]:
+            job._cancelled.set()
+        return True
+
+    def finish(self, job: QueuedJob, state: str, error: str = None) -> bool:
+        """Record the outcome of a leased job; False if its lease was lost."""
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, finished_at = ?, lease_until = NULL "
+                "WHERE run_id = ? AND worker = ? AND state = 'running'",
+                (state, error, time.time(), job.run_id, job.worker)
+            ).rowcount == 1
+
+    def _requeue_expired(self, conn, now):
+        # Caller holds a transaction
+        rows = conn.execute(
+            "SELECT run_id, payload, attempts, cancel_requested FROM jobs WHERE state = 'running' AND lease_until < ?",
+            (now,)
+        ).fetchall()
+        for row in rows:
+            error = None
+            if row["cancel_requested"]:
+                state, fields = "cancelled", {"stage": "Cancelled", "state": "cancelled"}
+            elif row["attempts"] >= self.max_attempts:
+                error = f"worker lost {row['attempts']} times"
+                state, fields = "failed", {"stage": f"Failed: {error}", "state": "failed"}
+            else:
+                state, fields = "queued", {"stage": "Worker lost; queued to resume..."}
+            conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, worker = NULL, lease_until = NULL, finished_at = ? "
+                "WHERE run_id = ?",
+                (state, error, None if state == "queued" else now, row["run_id"])
+            )
+            self._merge_progress(conn, row["run_id"], fields)
+            if state != "queued":
+                _close_checkpoint(json.loads(row["payload"]), state, error)
+            print(f"Job {row['run_id']} lease expired; {state}")
+
+    # --- Progress and events ---
+    def update_progress(self, run_id: str, fields: dict):
+        """Merge fields into the job's progress and publish it as a progress event."""
+        with self._transaction() as conn:
+            self._merge_progress(conn, run_id, fields)
+
+    def publish(self, run_id: str, event: str, data, key=None):
+        """Publish a non-state event; with a key it replaces the previous one of that name and key."""
+        self.publish_many(run_id, [(event, data, key)])
+
+    def publish_many(self, run_id: str, events: list):
+        """Publish (event, data, key) tuples in order, in one transaction."""
+        with self._transaction() as conn:
+            for event, data, key in events:
+                self._append(conn, run_id, event, data, None if key is None else str(key))
+
+    def events_after(self, run_id: str, cursor: int):
+        """Return (events after cursor, new cursor); the cursor is an event id."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, event, data FROM events WHERE run_id = ? AND id > ? ORDER BY id", (run_id, cursor)
+            ).fetchall()
+        if not rows:
+            return [], cursor
+        return [(row["event"], json.loads(row["data"])) for row in rows], rows[-1]["id"]
+
+    def progress_snapshot(self, run_id: str):
+        """The job's latest progress fields, or None if the queue never saw it."""
+        with self._lock:
+            row = self._conn.execute("SELECT progress FROM jobs WHERE run_id = ?", (run_id,)).fetchone()
+        return json.loads(row["progress"]) if row is not None else None
+
+    def progress(self, run_id: str):
+        """Progress handle for a queued job, or None if the queue never saw it."""
+        if self.get(run_id) is None:
+            return None
+        return QueueProgress(self, run_id)
+
+    def _merge_progress(self, conn, run_id, fields):
+        # Caller holds a transaction
+        row = conn.execute("SELECT progress FROM jobs WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            return
+        progress = json.loads(row["progress"])
+        progress.update(fields)
+        conn.execute("UPDATE jobs SET progress = ? WHERE run_id = ?", (json.dumps(progress), run_id))
+        self._append(conn, run_id, "progress", progress, PROGRESS_KEY)
+
+    def _append(self, conn, run_id, event, data, key):
+        # Caller holds a transaction; drops the event this one supersedes
+        if key is not None:
+            conn.execute("DELETE FROM events WHERE run_id = ? AND event = ? AND key = ?", (run_id, event, key))
+        conn.execute("INSERT INTO events (run_id, event, key, data) VALUES (?, ?, ?, ?)",
+                     (run_id, event, key, json.dumps(data)))
+
+    def _forget_finished(self, conn, now):
+        # Caller holds a transaction; keeps the event log bounded. Job rows stay for /status.
+        conn.execute(
+            "DELETE FROM events WHERE run_id IN (SELECT run_id FROM jobs WHERE finished_at < ?)",
+            (now - self.finished_ttl_seconds,)
+        )
+
+    # --- Introspection ---
+    def get(self, run_id: str):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE run_id = ?", (run_id,)).fetchone()
+        return QueuedJob(row) if row is not None else None
+
+    def position(self, run_id: str):
+        """1-based position among waiting jobs, or None if not queued."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT priority, rowid FROM jobs WHERE run_id = ? AND state = 'queued'", (run_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            ahead = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND (priority < ? OR (priority = ? AND rowid < ?))",
+                (row["priority"], row["priority"], row["rowid"])
+            ).fetchone()[0]
+        return ahead + 1
+
+    def eta(self, run_id: str):
+        """Rough seconds until the job starts, from recent job durations and the live workers' slots."""
+        position = self.position(run_id)
+        if position is None:
+            return None
+        with self._lock:
+            avg = self._conn.execute(
+                "SELECT AVG(finished_at - started_at) FROM (SELECT finished_at, started_at FROM jobs "
+                "WHERE state = 'done' ORDER BY finished_at DESC LIMIT 20)"
+            ).fetchone()[0]
+        if avg is None:
+            return None
+        slots = sum(worker["slots"] for worker in self.workers()) or 1
+        rounds = (position - 1) // slots + 1
+        return round(rounds * avg, 1)
+
+    def queue_depth(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+    def queue_status(self, run_id: str) -> dict:
+        job = self.get(run_id)
+        if job is None:
+            return {}
+        return {"state": job.state, "queue_position": self.position(run_id), "eta_seconds": self.eta(run_id)}
+
+    # --- Worker registry ---
+    def register_worker(self, worker_id: str, host: str, pid: int, device: str, slots: int):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?, ?, ?, 'starting', NULL, ?, ?)",
+                         (worker_id, host, pid, device, slots, now, now))
+
+    def worker_heartbeat(self, worker_id: str, state: str = None, error: str = None):
+        with self._transaction() as conn:
+            if state is None:
+                conn.execute("UPDATE workers SET heartbeat_at = ? WHERE worker_id = ?", (time.time(), worker_id))
+            else:
+                conn.execute("UPDATE workers SET heartbeat_at = ?, state = ?, error = ? WHERE worker_id = ?",
+                             (time.time(), state, error, worker_id))
+
+    def remove_worker(self, worker_id: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def workers(self) -> list:
+        """Workers that heartbeated within the lease period."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM workers WHERE heartbeat_at >= ? ORDER BY worker_id", (time.time() - self.lease_seconds,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+
+# Record a job the queue gave up on in its run's checkpoint, which its lost
+# worker left "running"; otherwise the web app would resume it on restart
+def _close_checkpoint(payload, state, error):
+    checkpoint = RunCheckpoint.load(payload.get("output_dir", ""))
+    if checkpoint is not None and checkpoint.get("status") == "running":
+        checkpoint.update(status=state, error=error)
+
+
+class QueueProgress:
+    """RunProgress for a job in the queue: same interface, backed by the database.
+
+    Unkeyed events (story tokens) are buffered and written together at most
+    every flush_seconds, or before the next progress update or keyed event,
+    rather than in one transaction each.
+    """
+
+    poll_seconds = 0.1
+    flush_seconds = 0.25
+
+    def __init__(self, queue: JobQueue, run_id: str):
+        self.queue = queue
+        self.run_id = run_id
+        self._pending = []  # (event, data, key) not yet written
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, fields: dict):
+        with self._lock:
+            self._flush()
+            self.queue.update_progress(self.run_id, fields)
+
+    def publish(self, event: str, data, key=None):
+        with self._lock:
+            self._pending.append((event, data, key))
+            if key is not None or time.monotonic() - self._flushed_at >= self.flush_seconds:
+                self._flush()
+
+    def _flush(self):
+        # Caller holds the lock
+        if self._pending:
+            self.queue.publish_many(self.run_id, self._pending)
+            self._pending = []
+        self._flushed_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        return self.queue.progress_snapshot(self.run_id) or {}
+
+    def wait_for_events(self, cursor: int, timeout: float):
+        """Return (events after cursor, new cursor), polling up to timeout for new ones."""
+        deadline = time.monotonic() + timeout
+        while True:
+            events, cursor = self.queue.events_after(self.run_id, cursor)
+            if events or time.monotonic() >= deadline:
+                return events, cursor
+            time.sleep(min(self.poll_seconds, max(0.0, deadline - time.monotonic())))
+
+    @property
+    def finished(self) -> bool:
+        state = self.snapshot()
+        return bool(state.get("done")) or state.get("state") in ("failed", "cancelled")
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+# Shared job queue for this process
+def get_job_queue() -> JobQueue:
+    global _queue
+    settings = CONFIG["scheduler"]
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(
+                settings["queue_path"],
+                max_queue_depth=settings["max_queue_depth"],
+                lease_seconds=settings["lease_seconds"],
+                max_attempts=settings["max_attempts"],
+                finished_ttl_seconds=settings["finished_ttl_seconds"]
+            )
+        return _queue
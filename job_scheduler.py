@@ -0,0 +1,180 @@
+# job_scheduler.py
+# Bounded job scheduler for DreamSprout runs.
+# A fixed pool of worker threads pulls jobs from a priority (then FIFO) queue.
+# GPU work is further gated by a device semaphore, so the number of pipelines
+# denoising at once is limited by the hardware, not by incoming requests.
+
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from config import CONFIG
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at max depth."""
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once it has been cancelled."""
+
+
+class Job:
+    def __init__(self, run_id, fn, priority, seq):
+        self.run_id = run_id
+        self.fn = fn
+        self.priority = priority
+        self.seq = seq
+        self.state = "queued"  # queued -> running -> done | failed | cancelled
+        self.error = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        """Call between stages so a cancelled run stops at the next boundary."""
+        if self._cancelled.is_set():
+            raise JobCancelled(self.run_id)
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class JobScheduler:
+    def __init__(self, num_workers=2, device_slots=1, max_queue_depth=8, finished_ttl_seconds=600):
+        self.max_queue_depth = max_queue_depth
+        self.finished_ttl_seconds = finished_ttl_seconds
+        self._queue = []  # heap of Job, lower priority value runs first
+        self._jobs = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._device = threading.BoundedSemaphore(device_slots)
+        self._num_workers = num_workers
+        self._avg_duration = None  # moving average of job run time, in seconds
+        self._workers = [
+            threading.Thread(target=self._worker_loop, name=f"dreamsprout-worker-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    # --- Submission and cancellation ---
+    def submit(self, run_id, fn, priority=0):
+        """Queue fn(job) to run on a worker; raises QueueFullError when full."""
+        with self._cond:
+            if len(self._queue) >= self.max_queue_depth:
+                raise QueueFullError(f"Job queue is full ({self.max_queue_depth} waiting)")
+            self._forget_finished()
+            job = Job(run_id, fn, priority, next(self._seq))
+            self._jobs[run_id] = job
+            heapq.heappush(self._queue, job)
+            self._cond.notify()
+        return job
+
+    def cancel(self, run_id):
+        """Cancel a queued job outright, or flag a running job to stop."""
+        with self._cond:
+            job = self._jobs.get(run_id)
+            if job is None or job.state in ("done", "failed", "cancelled"):
+                return False
+            job._cancelled.set()
+            if job.state == "queued":
+                self._queue.remove(job)
+                heapq.heapify(self._queue)
+                job.state = "cancelled"
+                job.finished_at = time.monotonic()
+        return True
+
+    # --- Introspection ---
+    def get(self, run_id):
+        return self._jobs.get(run_id)
+
+    def position(self, run_id):
+        """1-based position among waiting jobs, or None if not queued."""
+        with self._cond:
+            job = self._jobs.get(run_id)
+            if job is None or job.state != "queued":
+                return None
+            return sum(1 for other in self._queue if other < job) + 1
+
+    def eta(self, run_id):
+        """Rough seconds until the job starts, from the average job duration."""
+        position = self.position(run_id)
+        if position is None or self._avg_duration is None:
+            return None
+        rounds = (position - 1) // self._num_workers + 1
+        return round(rounds * self._avg_duration, 1)
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def queue_status(self, run_id):
+        job = self._jobs.get(run_id)
+        if job is None:
+            return {}
+        return {"state": job.state, "queue_position": self.position(run_id), "eta_seconds": self.eta(run_id)}
+
+    # --- Device gating ---
+    @contextmanager
+    def device_slot(self):
+        """Hold one of the device slots while running GPU work."""
+        with self._device:
+            yield
+
+    # --- Workers ---
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job = heapq.heappop(self._queue)
+                job.state = "running"
+                job.started_at = time.monotonic()
+
+            try:
+                # fn checks job.check_cancelled() itself, so a job cancelled
+                # between here and its first stage still reports it
+                job.fn(job)
+                job.state = "done"
+            except JobCancelled:
+                job.state = "cancelled"
+            except Exception as e:
+                job.state = "failed"
+                job.error = e
+                print(f"Job {job.run_id} failed: {e}")
+            finally:
+                job.finished_at = time.monotonic()
+                self._record_duration(job.finished_at - job.started_at)
+
+    def _forget_finished(self):
+        # Caller holds the lock; keeps _jobs bounded on long-lived servers
+        now = time.monotonic()
+        for run_id in [r for r, job in self._jobs.items()
+                       if job.finished_at is not None and now - job.finished_at > self.finished_ttl_seconds]:
+            del self._jobs[run_id]
+
+    def _record_duration(self, seconds):
+        with self._cond:
+            if self._avg_duration is None:
+                self._avg_duration = seconds
+            else:
+                self._avg_duration = 0.8 * self._avg_duration + 0.2 * seconds
+
+
+# Shared scheduler used by the web app
+def create_scheduler():
+    settings = CONFIG["scheduler"]
+    return JobScheduler(
+        num_workers=settings["workers"],
+        device_slots=settings["device_slots"],
+        max_queue_depth=settings["max_queue_depth"],
+        finished_ttl_seconds=settings["finished_ttl_seconds"]
+    )
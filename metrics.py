@@ -0,0 +1,190 @@
+# metrics.py
+# Per-run timing spans and process-wide Prometheus metrics.
+# RunMetrics records where one story's time goes (story, split, compress,
+# denoise, save, render, model load, queue wait) plus Ollama token rates,
+# and is written to metrics.json in the run folder. Every span and LLM call
+# is also folded into the shared METRICS registry served at /metrics.
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from ollama_runner import count_tokens
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320)
+
+
+class _Metric:
+    def __init__(self, name, kind, help_text, buckets=None):
+        self.name = name
+        self.kind = kind  # "counter", "gauge" or "histogram"
+        self.help = help_text
+        self.buckets = buckets
+        self.values = {}  # label tuple -> value, or [bucket counts, sum, count]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        self._metrics[name] = _Metric(name, "counter", help_text)
+
+    def gauge(self, name, help_text):
+        self._metrics[name] = _Metric(name, "gauge", help_text)
+
+    def histogram(self, name, help_text, buckets=DURATION_BUCKETS):
+        self._metrics[name] = _Metric(name, "histogram", help_text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            metric = self._metrics[name]
+            key = _label_key(labels)
+            metric.values[key] = metric.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._metrics[name].values[_label_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            metric = self._metrics[name]
+            key = _label_key(labels)
+            counts, total, count = metric.values.get(key, ([0] * len(metric.buckets), 0.0, 0))
+            counts = [c + (1 if value <= bound else 0) for c, bound in zip(counts, metric.buckets)]
+            metric.values[key] = (counts, total + value, count + 1)
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        with self._lock:
+            for metric in self._metrics.values():
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                for key, value in sorted(metric.values.items()):
+                    if metric.kind != "histogram":
+                        lines.append(f"{metric.name}{_format_labels(key)} {value}")
+                        continue
+                    counts, total, count = value
+                    for bound, c in zip(metric.buckets, counts):
+                        lines.append(f"{metric.name}_bucket{_format_labels(key + (('le', str(bound)),))} {c}")
+                    lines.append(f"{metric.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{metric.name}_sum{_format_labels(key)} {total}")
+                    lines.append(f"{metric.name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(key):
+    if not key:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in key)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(key, escaped)) + "}"
+
+
+# Shared registry served by the web app's /metrics endpoint
+METRICS = MetricsRegistry()
+METRICS.histogram("dreamsprout_stage_seconds", "Time spent in each pipeline stage")
+METRICS.histogram("dreamsprout_run_seconds", "End-to-end time per story")
+METRICS.histogram("dreamsprout_queue_wait_seconds", "Time a job waited in the scheduler queue")
+METRICS.histogram("dreamsprout_model_load_seconds", "Time to load an image pipeline into the model pool")
+METRICS.histogram("dreamsprout_llm_tokens_per_second", "Ollama generation rate (eval_count / eval_duration)", RATE_BUCKETS)
+METRICS.histogram("dreamsprout_llm_prompt_eval_seconds", "Ollama prompt prefill time")
+METRICS.counter("dreamsprout_llm_tokens_total", "Tokens generated by Ollama")
+METRICS.counter("dreamsprout_llm_requests_total", "Ollama generate calls")
+METRICS.counter("dreamsprout_runs_total", "Finished stories by outcome")
+METRICS.gauge("dreamsprout_peak_device_memory_bytes", "Peak device memory allocated by this process")
+METRICS.gauge("dreamsprout_queue_depth", "Jobs waiting in the scheduler queue")
+METRICS.gauge("dreamsprout_cache_events", "Content cache counters by cache and event")
+
+
+class RunMetrics:
+    def __init__(self, run_id: str):
+        self.run_id = run_id
+        self.started = time.time()
+        self._t0 = time.perf_counter()
+        self.spans = []
+        self.llm_calls = []
+        self.values = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str, **attrs):
+        """Time a block as one span of this run."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            span = {"stage": stage, "start": round(start - self._t0, 4), "seconds": round(end - start, 4)}
+            span.update(attrs)
+            with self._lock:
+                self.spans.append(span)
+            METRICS.observe("dreamsprout_stage_seconds", end - start, stage=stage)
+
+    def record(self, name: str, value):
+        with self._lock:
+            self.values[name] = value
+
+    def record_llm(self, model: str, data: dict, cached: bool = False):
+        """Record one Ollama call from its final response fields."""
+        call = {"model": model, "cached": cached}
+        eval_count = data.get("eval_count")
+        eval_ns = data.get("eval_duration")
+        if eval_count and eval_ns:
+            call["eval_count"] = eval_count
+            call["tokens_per_second"] = round(eval_count / (eval_ns / 1e9), 2)
+            METRICS.observe("dreamsprout_llm_tokens_per_second", call["tokens_per_second"], model=model)
+        else:
+            # Cached or stats-less responses: approximate from the text
+            eval_count = count_tokens(data.get("response", ""))
+            call["eval_count"] = eval_count
+        if data.get("prompt_eval_duration"):
+            call["prompt_eval_seconds"] = round(data["prompt_eval_duration"] / 1e9, 4)
+            METRICS.observe("dreamsprout_llm_prompt_eval_seconds", call["prompt_eval_seconds"], model=model)
+        METRICS.inc("dreamsprout_llm_requests_total", model=model, cached=cached)
+        METRICS.inc("dreamsprout_llm_tokens_total", eval_count, model=model)
+        with self._lock:
+            self.llm_calls.append(call)
+
+    def finish(self, outcome: str):
+        elapsed = time.perf_counter() - self._t0
+        self.record("total_seconds", round(elapsed, 4))
+        self.record("outcome", outcome)
+        peak = peak_device_memory()
+        if peak is not None:
+            self.record("peak_device_memory_bytes", peak)
+        METRICS.observe("dreamsprout_run_seconds", elapsed)
+        METRICS.inc("dreamsprout_runs_total", outcome=outcome)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "run_id": self.run_id,
+                "started": self.started,
+                "spans": list(self.spans),
+                "llm_calls": list(self.llm_calls),
+                **self.values
+            }
+
+    def write(self, output_dir: str):
+        with open(os.path.join(output_dir, "metrics.json"), "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+# Peak CUDA memory allocated by this process, or None without a GPU.
+# Never imports torch itself, so /metrics stays fast while models warm up.
+def peak_device_memory():
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    peak = torch.cuda.max_memory_allocated()
+    METRICS.set("dreamsprout_peak_device_memory_bytes", peak)
+    return peak
@@ -0,0 +1,143 @@
+# model_pool.py
+# Process-wide, thread-safe pool of loaded image pipelines.
+# Each (model_id, dtype, device) key is loaded once and shared by reference.
+# Callers acquire/release pipelines; idle ones are evicted on an LRU/TTL budget,
+# checked on release and by a background thread while any model is loaded.
+
+import gc
+import threading
+import time
+from collections import OrderedDict
+
+from config import CONFIG
+from metrics import METRICS
+
+
+class _PoolEntry:
+    def __init__(self):
+        self.model = None
+        self.refcount = 0
+        self.pinned = False
+        self.last_used = time.monotonic()
+        self.loaded = threading.Event()
+        self.error = None
+
+
+class ModelPool:
+    def __init__(self, max_idle_models=1, idle_ttl_seconds=1800, evict_interval_seconds=60):
+        self.max_idle_models = max_idle_models
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.evict_interval_seconds = evict_interval_seconds
+        self._entries = OrderedDict()  # key -> _PoolEntry, least recently used first
+        self._lock = threading.Lock()
+        self._evictor = None
+
+    def acquire(self, key, loader):
+        """Return the model for key, loading it with loader() on first use."""
+        with self._lock:
+            entry = self._entries.get(key)
+            is_loader = entry is None
+            if is_loader:
+                entry = _PoolEntry()
+                self._entries[key] = entry
+            entry.refcount += 1
+            self._entries.move_to_end(key)
+            self._start_evictor()
+
+        if is_loader:
+            try:
+                start = time.perf_counter()
+                entry.model = loader()
+                METRICS.observe("dreamsprout_model_load_seconds", time.perf_counter() - start, model=key[0])
+            except BaseException as e:
+                entry.error = e
+                with self._lock:
+                    self._entries.pop(key, None)
+                raise
+            finally:
+                entry.loaded.set()
+        else:
+            # Another thread may still be loading the same weights; wait for it
+            entry.loaded.wait()
+            if entry.error is not None:
+                raise RuntimeError(f"Loading {key} failed: {entry.error}")
+
+        return entry.model
+
+    def release(self, key):
+        """Drop one reference to key; idle models become eligible for eviction."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refcount = max(0, entry.refcount - 1)
+            entry.last_used = time.monotonic()
+        self.evict_idle()
+
+    def preload(self, key, loader, pin=True):
+        """Load key ahead of time; pinned models are never evicted."""
+        self.acquire(key, loader)
+        with self._lock:
+            self._entries[key].pinned = self._entries[key].pinned or pin
+        self.release(key)
+
+    def evict_idle(self):
+        """Evict unpinned idle models past their TTL, then the LRU ones over budget."""
+        evicted = []
+        now = time.monotonic()
+        with self._lock:
+            idle = [k for k, e in self._entries.items() if e.refcount == 0 and e.loaded.is_set()]
+            for key in idle:
+                entry = self._entries[key]
+                if not entry.pinned and now - entry.last_used > self.idle_ttl_seconds:
+                    evicted.append(self._entries.pop(key))
+            idle = [k for k in idle if k in self._entries and not self._entries[k].pinned]
+            while len(idle) > self.max_idle_models:
+                evicted.append(self._entries.pop(idle.pop(0)))
+
+        if evicted:
+            for entry in evicted:
+                entry.model = None
+            _free_device_memory()
+        return len(evicted)
+
+    # Caller holds the lock. Started with the first model, so the TTL also
+    # applies to models that are never released again.
+    def _start_evictor(self):
+        if self._evictor is None and self.evict_interval_seconds:
+            self._evictor = threading.Thread(target=self._evict_loop, name="dreamsprout-evictor", daemon=True)
+            self._evictor.start()
+
+    def _evict_loop(self):
+        while True:
+            time.sleep(self.evict_interval_seconds)
+            try:
+                self.evict_idle()
+            except Exception as e:
+                print(f"Idle model eviction failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                str(key): {"refcount": e.refcount, "pinned": e.pinned, "loaded": e.loaded.is_set()}
+                for key, e in self._entries.items()
+            }
+
+
+# Release cached CUDA blocks after an eviction so other processes can use them
+def _free_device_memory():
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+# Shared pool used by every ModelRegistry in this process
+MODEL_POOL = ModelPool(
+    max_idle_models=CONFIG["model_pool"]["max_idle_models"],
+    idle_ttl_seconds=CONFIG["model_pool"]["idle_ttl_seconds"],
+    evict_interval_seconds=CONFIG["model_pool"]["evict_interval_seconds"]
+)
@@ -2,15 +2,32 @@
 # ModelRegistry class to manage text and image generation models.
 # Uses OllamaRunner for text models.
 # Uses HuggingFace diffusers for image models.
+# torch and diffusers are imported on first use; ModelWarmup does that (and
+# the preload) on a background thread so the web app can start serving at once.
 
-from diffusers import StableDiffusionXLPipeline
-import torch
+import copy
+import os
+import threading
+import time
+from contextlib import contextmanager
+from config import CONFIG, MEMORY_PROFILES, QUALITY_PRESETS, SAMPLERS
+from image_acceleration import accelerate_pipeline, backend_label, warmup_pipeline
+from model_pool import MODEL_POOL
+
+LCM_ADAPTER = "lcm"  # adapter name of image_model.lcm_lora on pooled pipelines
 
 class ModelRegistry:
-    def __init__(self, device="cuda"):
-        self.device = device
+    def __init__(self, device=None, pool=MODEL_POOL, memory_profile=None, acceleration=None):
+        self.memory_profile = select_memory_profile(memory_profile)
+        self.profile = MEMORY_PROFILES[self.memory_profile]
+        self.device = device or self.profile["device"]
+        self.acceleration = acceleration or CONFIG["image_model"].get("acceleration", {})
+        self.backend = backend_label(self.acceleration)
+        self.samplers = {name: dict(sampler) for name, sampler in SAMPLERS.items()}
+        self.pool = pool
         self.text_models = {}
         self.image_models = {}
+        self._pool_keys = {}
 
     # --- Text Models ---
     def register_text_model(self, name, model_runner):
@@ -20,45 +37,284 @@ class ModelRegistry:
     def get_text_model(self, name):
         return self.text_models.get(name)
 
-    # --- Image Models ---
-    def register_image_model(self, name, model_id, parameters, dtype=torch.float16):
-        """Register a Stable Diffusion XL pipeline with config parameters."""
+    # --- Samplers ---
+    def register_sampler(self, name, scheduler, options=None, lora=None):
+        """Add a sampler: a diffusers scheduler class name plus config overrides."""
+        self.samplers[name] = {"scheduler": scheduler, "options": options or {}, "lora": lora}
 
-        pipe = StableDiffusionXLPipeline.from_pretrained(
-            model_id,
-            torch_dtype=dtype,
-            use_safetensors=True,
-            variant="fp16"
-        ).to(self.device)
+    def resolve_quality(self, quality=None):
+        """Sampler, steps and guidance for a QUALITY_PRESETS entry."""
+        quality = quality or CONFIG["image_model"].get("quality", "final")
+        if quality not in QUALITY_PRESETS:
+            raise ValueError(f"Unknown quality {quality!r}; choose from {list(QUALITY_PRESETS)}")
+        preset = dict(QUALITY_PRESETS[quality])
+        without_lora = preset.pop("without_lora", None)
+        if self.samplers[preset["sampler"]].get("lora") == "lcm" and not CONFIG["image_model"].get("lcm_lora"):
+            if without_lora is None:
+                raise ValueError(f"Quality {quality!r} needs image_model.lcm_lora to be set")
+            preset = dict(without_lora)
+        preset["quality"] = quality
+        return preset
 
-        pipe.enable_xformers_memory_efficient_attention()
+    # --- Image Models ---
+    def register_image_model(self, name, model_id, parameters, dtype=None, quality=None):
+        """Register a Stable Diffusion XL pipeline with config parameters.
+
+        The pipeline itself comes from the shared model pool, so it is loaded
+        from disk only the first time (model_id, dtype, device, profile, backend)
+        is requested. With the fast backend, compilation and warmup also
+        happen then. The registered pipeline is a view of the pooled one with
+        the quality preset's scheduler; the weights are shared. Samplers that
+        need the LCM-LoRA switch its adapter on for their own calls.
+        """
+        preset = self.resolve_quality(quality)
+        dtype = dtype or self.image_dtype(parameters)
+        key = self.image_pool_key(model_id, parameters, dtype)
+        if name in self._pool_keys:
+            self.pool.release(self._pool_keys.pop(name))
+        pipe = self.pool.acquire(key, lambda: self.load_image_pipeline(model_id, parameters, dtype))
+        self._pool_keys[name] = key
+        pipe = _with_sampler(pipe, self.samplers[preset["sampler"]])
 
         # Store generation parameters for later use
         pipe.generation_config = {
-            "num_inference_steps": parameters.get("num_inference_steps", 30),
-            "guidance_scale": parameters.get("guidance_scale", 7.5),
+            "model_id": model_id,
+            "quality": preset["quality"],
+            "sampler": preset["sampler"],
+            "num_inference_steps": preset.get("num_inference_steps", parameters.get("num_inference_steps", 30)),
+            "guidance_scale": preset.get("guidance_scale", parameters.get("guidance_scale", 7.5)),
             "resolution": parameters.get("resolution", (768, 512)),
             "seed": parameters.get("seed", 42),
-            "negative_prompt": parameters.get("negative_prompt", "")
+            "negative_prompt": parameters.get("negative_prompt", ""),
+            "backend": self.backend,
+            "batch_size": min(parameters.get("batch_size", 1), self.profile.get("max_batch_size", 1))
         }
 
         self.image_models[name] = pipe
 
+    def image_dtype(self, parameters):
+        """Torch dtype from the memory profile, or from parameters["dtype"]."""
+        import torch
+        return getattr(torch, self.profile["dtype"] or parameters.get("dtype", "float16"))
+
+    def image_pool_key(self, model_id, parameters, dtype=None):
+        return pool_key(model_id, dtype or self.image_dtype(parameters), self.device, self.memory_profile,
+                        self.backend, CONFIG["image_model"].get("lcm_lora"))
+
+    def load_image_pipeline(self, model_id, parameters, dtype=None):
+        """Load a pipeline for this registry's profile and backend (bypasses the pool)."""
+        return _load_sdxl_pipeline(
+            model_id, dtype or self.image_dtype(parameters), self.device, self.profile,
+            self.acceleration, parameters, CONFIG["image_model"].get("lcm_lora")
+        )
+
     def get_image_model(self, name):
         return self.image_models.get(name)
 
+    def close(self):
+        """Hand every pooled pipeline back to the shared pool."""
+        for key in self._pool_keys.values():
+            self.pool.release(key)
+        self._pool_keys.clear()
+        self.image_models.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Key under which a pipeline is shared in the model pool (lora: the LCM-LoRA loaded as an adapter)
+def pool_key(model_id, dtype, device, memory_profile, backend="eager", lora=None):
+    return (model_id, str(dtype), device, memory_profile, backend, lora)
+
+
+# A shallow copy of pipe that samples with sampler's scheduler.
+# Schedulers keep per-call state, so each registration gets its own.
+def _with_sampler(pipe, sampler):
+    view = copy.copy(pipe)
+    view.lora_adapter = LCM_ADAPTER if sampler.get("lora") == "lcm" else None
+    if sampler["scheduler"] is not None:
+        import diffusers
+        scheduler_class = getattr(diffusers, sampler["scheduler"])
+        view.scheduler = scheduler_class.from_config(pipe.scheduler.config, **sampler.get("options", {}))
+    else:
+        view.scheduler = copy.deepcopy(pipe.scheduler)
+    return view
+
+
+class AdapterSwitch:
+    """Turns a pooled pipeline's LoRA adapter on or off for the calls that need it.
+
+    The adapter lives in the shared UNet, so calls wanting the same adapter
+    (or none) run together and a call wanting the other waits for them.
+    """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.active = None
+        self.users = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def use(self, adapter):
+        with self._cond:
+            while self.users and self.active != adapter:
+                self._cond.wait()
+            if adapter != self.active:
+                if adapter is None:
+                    self.pipe.disable_lora()
+                else:
+                    self.pipe.enable_lora()
+                    self.pipe.set_adapters([adapter])
+                self.active = adapter
+            self.users += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.users -= 1
+                self._cond.notify_all()
+
+
+# Hold the adapter a sampler view needs (if any) around a call to it
+@contextmanager
+def adapter_scope(pipe):
+    switch = getattr(pipe, "adapter_switch", None)
+    if switch is None:
+        yield
+        return
+    with switch.use(getattr(pipe, "lora_adapter", None)):
+        yield
+
+
+# --- Memory profiles ---
+# Pick the configured memory profile, or the best fit for this machine when "auto"
+def select_memory_profile(requested=None):
+    requested = requested or CONFIG["image_model"].get("memory_profile", "auto")
+    if requested != "auto":
+        if requested not in MEMORY_PROFILES:
+            raise ValueError(f"Unknown memory profile {requested!r}; choose from {sorted(MEMORY_PROFILES)}")
+        return requested
+
+    import torch
+    if torch.cuda.is_available():
+        vram_gb = torch.cuda.get_device_properties(0).total_memory / 1024 ** 3
+        for name, profile in MEMORY_PROFILES.items():
+            if profile["device"] == "cuda" and vram_gb >= profile["min_vram_gb"]:
+                return name
+    if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        return "mps"
+    # bfloat16 halves the CPU footprint on machines short of RAM
+    ram_gb = _system_ram_gb()
+    if ram_gb is not None and ram_gb < MEMORY_PROFILES["cpu_bfloat16"]["max_ram_gb"]:
+        return "cpu_bfloat16"
+    return "cpu"
+
+def _system_ram_gb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# Load an SDXL pipeline from disk, add the LCM-LoRA as a (disabled) adapter if
+# given and apply the memory profile, then the fast backend and its warmup when
+# acceleration asks for it. One copy of the weights serves every sampler.
+def _load_sdxl_pipeline(model_id, dtype, device, profile, acceleration=None, parameters=None, lora=None):
+    from diffusers import StableDiffusionXLPipeline
+    pipe = StableDiffusionXLPipeline.from_pretrained(
+        model_id,
+        torch_dtype=dtype,
+        use_safetensors=True,
+        variant="fp16"
+    )
+    if lora:
+        pipe.load_lora_weights(lora, adapter_name=LCM_ADAPTER)
+        pipe.disable_lora()
+        pipe.adapter_switch = AdapterSwitch(pipe)
+
+    # Offloaded pipelines manage device placement themselves
+    if profile["offload"] == "model":
+        pipe.enable_model_cpu_offload()
+    elif profile["offload"] == "sequential":
+        pipe.enable_sequential_cpu_offload()
+    else:
+        pipe = pipe.to(device)
+
+    if profile["attention"] == "xformers":
+        try:
+            pipe.enable_xformers_memory_efficient_attention()
+        except Exception as e:
+            # Diffusers already uses PyTorch's scaled-dot-product attention by default
+            print(f"xformers unavailable ({e}), using PyTorch SDPA attention")
+    elif profile["attention"] == "sliced":
+        pipe.enable_attention_slicing()
+
+    if profile.get("vae_tiling"):
+        pipe.enable_vae_tiling()
+    if profile.get("max_batch_size", 1) > 1:
+        pipe.enable_vae_slicing()
+
+    if backend_label(acceleration) != "eager":
+        pipe = accelerate_pipeline(pipe, acceleration, profile)
+        parameters = parameters or CONFIG["image_model"]["parameters"]
+        max_batch = min(parameters.get("batch_size", 1), profile.get("max_batch_size", 1))
+        print(f"Warming up {model_id} ({backend_label(acceleration)}) for batch sizes 1-{max_batch}")
+        warmup_pipeline(
+            pipe,
+            acceleration.get("warmup_steps", 2),
+            parameters.get("resolution", (768, 512)),
+            range(1, max_batch + 1)
+        )
+    return pipe
+
+
+# Load the configured image model into the shared pool at server startup
+def preload_image_models(device=None, pool=MODEL_POOL, memory_profile=None):
+    registry = ModelRegistry(device=device, pool=pool, memory_profile=memory_profile)
+    model_id = CONFIG["image_model"]["model_id"]
+    parameters = CONFIG["image_model"]["parameters"]
+    dtype = registry.image_dtype(parameters)
+    print(f"Preloading {model_id} with memory profile {registry.memory_profile}, {registry.backend} backend")
+    pool.preload(
+        registry.image_pool_key(model_id, parameters, dtype),
+        lambda: registry.load_image_pipeline(model_id, parameters, dtype)
+    )
+
 
-#    def register_image_model(self, name, model_id, dtype=torch.float16):
-#        """Register a HuggingFace diffusers pipeline for image generation."""
+# Background warmup for the web app: import the ML stack and preload the
+# configured image model off the main thread. /readyz reports its status.
+class ModelWarmup:
+    def __init__(self, preload=True):
+        self.preload = preload
+        self.state = "pending"  # "pending", "warming", "ready" or "failed"
+        self.error = None
+        self.seconds = None
+        self.done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="dreamsprout-warmup", daemon=True)
 
-#        pipe = StableDiffusionXLPipeline.from_pretrained(
-#            "stabilityai/stable-diffusion-xl-base-1.0",
-#        torch_dtype=torch.float16,
-#        use_safetensors=True,
-#        variant="fp16"
-#        ).to("cuda")
+    def start(self):
+        self._thread.start()
+        return self
 
-#        pipe = pipe.to(self.device)
-#        pipe.enable_xformers_memory_efficient_attention()
-#        self.image_models[name] = pipe
+    def _run(self):
+        self.state = "warming"
+        start = time.perf_counter()
+        try:
+            import torch  # noqa: F401 - the slow part of a cold start
+            import diffusers  # noqa: F401
+            if self.preload:
+                preload_image_models()
+            self.state = "ready"
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+            print(f"Model warmup failed: {e}")
+        finally:
+            self.seconds = round(time.perf_counter() - start, 3)
+            self.done.set()
 
+    def status(self) -> dict:
+        return {"state": self.state, "error": self.error, "seconds": self.seconds}
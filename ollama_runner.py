@@ -1,37 +1,625 @@
 # ollama_runner.py
 # OllamaRunner class to interface with Ollama API for text generation.
-# Uses requests to send prompts and receive responses.
+# Requests are spread over one or more Ollama servers (text_model.server_urls):
+# each goes to the healthy server with the fewest requests in flight, over a
+# pooled keep-alive session. Failed requests are retried with exponential
+# backoff on the next server; a failing server is skipped for a cooldown and
+# health-checked (/api/version) before it gets traffic again. Per-server
+# limits on requests in flight and on distinct models in use keep servers
+# from swapping models back and forth. Failures raise OllamaError instead of
+# returning error text as if it were the story.
+# AsyncOllamaRunner is the asyncio version (requires httpx).
+
+import asyncio
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
 
 import requests
-from config import CONFIG, OLLAMA_URL
+from requests.adapters import HTTPAdapter
+
+from config import CONFIG
+from cache import ContentCache, get_cache
 
 # Simple token counter (replace with a real tokenizer if needed)
 def count_tokens(text: str) -> int:
     return len(text.split())
 
-# OllamaRunner class to interface with Ollama API for text generation.
-class OllamaRunner:
-    def __init__(self, model_name="dummy", server_url=OLLAMA_URL):
+
+# --- Errors ---
+class OllamaError(RuntimeError):
+    """An Ollama request failed. retryable is False if another attempt cannot help (e.g. unknown model)."""
+
+    def __init__(self, message, endpoint=None, status=None, retryable=False):
+        super().__init__(message)
+        self.endpoint = endpoint
+        self.status = status
+        self.retryable = retryable
+
+class OllamaTimeout(OllamaError):
+    """The server did not answer within the configured timeout."""
+
+    def __init__(self, message, endpoint=None):
+        super().__init__(message, endpoint, retryable=True)
+
+class OllamaUnavailable(OllamaError):
+    """No server could be reached (connection refused, failed health check)."""
+
+    def __init__(self, message, endpoint=None):
+        super().__init__(message, endpoint, retryable=True)
+
+
+# --- Endpoints ---
+class OllamaEndpoint:
+    """One Ollama server: its URLs, keep-alive session and load/health bookkeeping."""
+
+    def __init__(self, url: str, max_connections: int = 8):
+        base = url.rstrip("/")
+        if base.endswith("/api/generate"):
+            base = base[:-len("/api/generate")]
+        self.base_url = base
+        self.generate_url = f"{base}/api/generate"
+        self.health_url = f"{base}/api/version"
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.outstanding = 0    # requests in flight
+        self.requests = 0       # requests sent in total
+        self.failures = 0       # consecutive failures; > 0 means "check health before use"
+        self.down_until = 0.0   # monotonic time until which the endpoint is skipped
+        self.models = {}        # model -> requests in flight plus holds
+
+    def status(self) -> dict:
+        return {
+            "url": self.base_url,
+            "healthy": self.failures == 0,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "models": sorted(self.models)
+        }
+
+
+class EndpointPool:
+    """Least-outstanding-requests routing over a set of Ollama servers.
+
+    max_parallel caps the requests in flight per server (OLLAMA_NUM_PARALLEL)
+    and max_models the distinct models in use on it (OLLAMA_MAX_LOADED_MODELS);
+    a request that fits nowhere waits, rather than making a server swap models.
+    """
+
+    def __init__(self, urls: list[str], max_connections: int = 8, cooldown: float = 5.0,
+                 max_cooldown: float = 60.0, health_timeout: float = 2.0,
+                 max_parallel: int = 4, max_models: int = 3):
+        if not urls:
+            raise ValueError("At least one Ollama server URL is required")
+        self.endpoints = [OllamaEndpoint(url, max_connections) for url in dict.fromkeys(urls)]
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.health_timeout = health_timeout
+        self.max_parallel = max_parallel
+        self.max_models = max_models
+        self._cond = threading.Condition()
+
+    def choose(self, model: str, held: OllamaEndpoint = None):
+        """Reserve the least busy endpoint for a request for model, waiting for room.
+
+        held is the endpoint of a hold() on model, if any: it is used (waited
+        for when busy) while it is up, so the held model slot is the one used.
+        Returns (endpoint, probe): probe is True if the endpoint failed recently
+        and must pass a health check first. If every endpoint that could take
+        the model is cooling down, the one that recovers soonest is returned
+        for probing. The caller must release() the endpoint.
+        """
+        with self._cond:
+            while True:
+                endpoint = self._pick(model, request=True, held=held)
+                if endpoint is not None:
+                    break
+                self._cond.wait(timeout=1.0)  # also wakes to notice cooldowns ending
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            endpoint.models[model] = endpoint.models.get(model, 0) + 1
+            return endpoint, endpoint.failures > 0
+
+    def release(self, endpoint: OllamaEndpoint, model: str, failed: bool = False):
+        """Return a chosen endpoint; failed=None leaves its health unchanged."""
+        with self._cond:
+            endpoint.outstanding -= 1
+            self._drop_model(endpoint, model)
+        if failed:
+            self.mark_down(endpoint)
+        elif failed is not None:
+            self.mark_up(endpoint)
+
+    @contextmanager
+    def hold(self, model: str):
+        """Keep model counted as in use on one server across several requests
+        (e.g. a story and its scene plan), so other models can't take the
+        server's model slot in between and make it reload."""
+        with self._cond:
+            while True:
+                endpoint = self._pick(model, request=False)
+                if endpoint is not None:
+                    break
+                self._cond.wait(timeout=1.0)
+            endpoint.models[model] = endpoint.models.get(model, 0) + 1
+        try:
+            yield endpoint
+        finally:
+            with self._cond:
+                self._drop_model(endpoint, model)
+
+    def _pick(self, model, request, held=None):
+        # Caller holds the lock. Servers already using the model need no free model slot.
+        now = time.monotonic()
+        if held is not None and held.down_until <= now:
+            return held if not request or held.outstanding < self.max_parallel else None
+        eligible = [e for e in self.endpoints if model in e.models or len(e.models) < self.max_models]
+        if not eligible:
+            return None
+        up = [e for e in eligible if e.down_until <= now]
+        if not up:
+            return min(eligible, key=lambda e: e.down_until)
+        if request:
+            up = [e for e in up if e.outstanding < self.max_parallel]
+            if not up:
+                return None
+        return min(up, key=lambda e: (e.outstanding, model not in e.models, e.requests))
+
+    def _drop_model(self, endpoint, model):
+        # Caller holds the lock
+        endpoint.models[model] -= 1
+        if not endpoint.models[model]:
+            del endpoint.models[model]
+        self._cond.notify_all()
+
+    def mark_up(self, endpoint: OllamaEndpoint):
+        with self._cond:
+            endpoint.failures = 0
+            endpoint.down_until = 0.0
+            self._cond.notify_all()
+
+    # The cooldown doubles with each consecutive failure, up to max_cooldown
+    def mark_down(self, endpoint: OllamaEndpoint):
+        with self._cond:
+            endpoint.failures += 1
+            cooldown = min(self.max_cooldown, self.cooldown * 2 ** (endpoint.failures - 1))
+            endpoint.down_until = time.monotonic() + cooldown
+
+    def check(self, endpoint: OllamaEndpoint) -> bool:
+        """Health-check one endpoint and record the result."""
+        try:
+            healthy = endpoint.session.get(endpoint.health_url, timeout=self.health_timeout).ok
+        except requests.RequestException:
+            healthy = False
+        if healthy:
+            self.mark_up(endpoint)
+        else:
+            self.mark_down(endpoint)
+        return healthy
+
+    def check_all(self) -> list[dict]:
+        """Health-check every endpoint; returns their status."""
+        for endpoint in self.endpoints:
+            self.check(endpoint)
+        return self.status()
+
+    def status(self) -> list[dict]:
+        with self._cond:
+            return [endpoint.status() for endpoint in self.endpoints]
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Shared endpoint pool per server list, so sessions and load counts span runs
+def get_endpoint_pool(urls: list[str] = None) -> EndpointPool:
+    settings = CONFIG["text_model"]
+    urls = tuple(urls or settings["server_urls"])
+    with _pools_lock:
+        if urls not in _pools:
+            _pools[urls] = EndpointPool(
+                list(urls),
+                max_connections=settings["max_connections"],
+                cooldown=settings["cooldown_seconds"],
+                health_timeout=settings["timeout"]["health"],
+                max_parallel=settings["max_parallel"],
+                max_models=settings["max_loaded_models"]
+            )
+        return _pools[urls]
+
+
+# Exponential backoff with jitter: about base, 2*base, 4*base... seconds
+def backoff_delay(base: float, attempt: int, cap: float = 30.0) -> float:
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+# Turn an unsuccessful HTTP response into an OllamaError; 429 and 5xx may be retried
+def _status_error(status: int, body: str, endpoint: OllamaEndpoint) -> OllamaError:
+    try:
+        detail = json.loads(body).get("error", body)
+    except (ValueError, AttributeError):
+        detail = body
+    return OllamaError(
+        f"Ollama at {endpoint.base_url} returned HTTP {status}: {str(detail)[:200]}".strip(),
+        endpoint.base_url, status, retryable=status == 429 or status >= 500
+    )
+
+def _requests_error(error: requests.RequestException, endpoint: OllamaEndpoint) -> OllamaError:
+    if isinstance(error, requests.Timeout):
+        return OllamaTimeout(f"Ollama at {endpoint.base_url} timed out: {error}", endpoint.base_url)
+    if isinstance(error, requests.ConnectionError):
+        return OllamaUnavailable(f"Cannot reach Ollama at {endpoint.base_url}: {error}", endpoint.base_url)
+    return OllamaError(f"Ollama request to {endpoint.base_url} failed: {error}", endpoint.base_url, retryable=True)
+
+# Ollama reports errors inside a 200 response as {"error": "..."}
+def _check_body(data: dict, endpoint: OllamaEndpoint) -> dict:
+    if "error" in data:
+        raise OllamaError(f"Ollama at {endpoint.base_url}: {data['error']}", endpoint.base_url)
+    return data
+
+
+# Payload, cache key and metrics shared by the sync and async runners
+class _OllamaClient:
+    def __init__(self, model_name="dummy", server_url=None, metrics=None, pool=None):
+        settings = CONFIG["text_model"]
         self.model_name = model_name
-        self.server_url = server_url
+        self.pool = pool or get_endpoint_pool([server_url] if server_url else None)
+        self.metrics = metrics  # optional RunMetrics that receives per-call token stats
+        self.timeout = settings["timeout"]
+        self.retries = settings["retries"]
+        self.backoff = settings["backoff_seconds"]
+        self._held = None  # endpoint held by hold(), preferred for this client's requests
 
-    def generate(self, prompt: str) -> str:
-        print(f"Using model: {self.model_name}")  # Debug line
+    @contextmanager
+    def hold(self):
+        """Keep this model on one server for a series of calls (see EndpointPool.hold);
+        the calls go to that server while it is up."""
+        with self.pool.hold(self.model_name) as endpoint:
+            previous, self._held = self._held, endpoint
+            try:
+                yield endpoint
+            finally:
+                self._held = previous
+
+    def _record_stats(self, data, cached=False):
+        if self.metrics is not None:
+            self.metrics.record_llm(self.model_name, data, cached=cached)
+
+    # Identical model, prompt, options, context and format give a cache hit
+    def _cache_key(self, payload):
+        return ContentCache.make_key(
+            "ollama", self.model_name, payload["prompt"], payload["options"],
+            payload.get("context"), payload.get("format")
+        )
+
+    def _build_payload(self, prompt, context, format, stream):
         payload = {
             "model": self.model_name,
             "prompt": prompt,
-            "stream": False,
+            "stream": stream,
             "options": {
                 "num_ctx": CONFIG["text_model"]["parameters"]["num_ctx"],
                 "temperature": CONFIG["text_model"]["parameters"]["temperature"],
                 "top_p": CONFIG["text_model"]["parameters"]["top_p"]
             }
         }
+        if CONFIG["text_model"].get("keep_alive") is not None:
+            payload["keep_alive"] = CONFIG["text_model"]["keep_alive"]
+        if context:
+            payload["context"] = context
+        if format:
+            payload["format"] = format
+        return payload
+
+    # Whether a failed attempt should be retried, after waiting how long
+    def _retry_delay(self, error: OllamaError, attempt: int):
+        if not error.retryable or attempt >= self.retries:
+            return None
+        delay = backoff_delay(self.backoff, attempt)
+        print(f"{error} - retrying in {delay:.1f}s ({attempt + 1}/{self.retries})")
+        return delay
+
+
+# OllamaRunner class to interface with Ollama API for text generation.
+class OllamaRunner(_OllamaClient):
+    def generate(self, prompt: str) -> str:
+        return self.generate_with_context(prompt)[0]
+
+    def generate_with_context(self, prompt: str, context: list[int] = None, format: str = None):
+        """Generate text and also return Ollama's context tokens.
+
+        Passing the returned context into a follow-up call continues the same
+        conversation without re-sending (and re-prefilling) the earlier text.
+        format="json" asks Ollama to constrain the output to valid JSON.
+        Raises OllamaError if every attempt fails.
+        """
+        print(f"Using model: {self.model_name}")  # Debug line
+        payload = self._build_payload(prompt, context, format, stream=False)
+
+        computed = []
+
+        def request_response():
+            response, endpoint = self._post(payload)
+            try:
+                data = _check_body(response.json(), endpoint)
+            except ValueError as e:
+                raise OllamaError(f"Invalid response from Ollama at {endpoint.base_url}: {e}", endpoint.base_url)
+            finally:
+                self.pool.release(endpoint, self.model_name)
+            computed.append(data)
+            return _encode_result(data.get("response", ""), data.get("context"))
+
+        cache = get_cache("text")
+        if cache is None:
+            text, final_context = _decode_result(request_response())
+        else:
+            key = self._cache_key(payload)
+            text, final_context = _decode_result(cache.get_or_compute(key, request_response))
+        self._record_stats(computed[0] if computed else {"response": text}, cached=not computed)
+        return text, final_context
 
+    def generate_stream(self, prompt: str, context: list[int] = None):
+        """Yield chunks of generated text as Ollama produces them."""
+        for chunk in self._stream_chunks(prompt, context):
+            if chunk.get("response"):
+                yield chunk["response"]
+
+    def generate_stream_with_context(self, prompt: str, on_token, context: list[int] = None):
+        """Stream a generation, calling on_token(text) per chunk.
+
+        Returns the full text and Ollama's context tokens, like generate_with_context.
+        A cached response is delivered to on_token in a single chunk.
+        """
+        print(f"Using model: {self.model_name}")  # Debug line
+        cache = get_cache("text")
+        state = None
+        if cache is not None:
+            key = self._cache_key(self._build_payload(prompt, context, None, stream=False))
+            state, value = cache.begin(key)
+            if state == "wait":
+                # An identical request is streaming already; if it fails, stream uncached
+                value = cache.wait(key, value)
+                state = "hit" if value is not None else None
+            if state == "hit":
+                text, final_context = _decode_result(value)
+                on_token(text)
+                self._record_stats({"response": text}, cached=True)
+                return text, final_context
+
+        parts = []
+        final_context = None
+        result = None
+        try:
+            for chunk in self._stream_chunks(prompt, context):
+                token = chunk.get("response", "")
+                if token:
+                    parts.append(token)
+                    on_token(token)
+                if chunk.get("done"):
+                    final_context = chunk.get("context")
+                    self._record_stats(dict(chunk, response="".join(parts)))
+            result = _encode_result("".join(parts), final_context)
+        finally:
+            if state == "lead":
+                cache.finish(key, result)
+        return "".join(parts), final_context
+
+    # Ollama streams one JSON object per line; the last one has "done": true.
+    # Only opening the stream is retried: once tokens are out, a failure is raised.
+    def _stream_chunks(self, prompt, context=None):
+        payload = self._build_payload(prompt, context, None, stream=True)
+        response, endpoint = self._post(payload, stream=True)
+        failed = False
         try:
-            response = requests.post(self.server_url, json=payload)
-            response.raise_for_status()
-            data = response.json()
-            return data.get("response", "")
-        except Exception as e:
-            return f"Error calling Ollama API: {e}"
\ No newline at end of file
+            with response:
+                for line in response.iter_lines():
+                    if line:
+                        yield _check_body(json.loads(line), endpoint)
+        except requests.RequestException as e:
+            failed = True
+            raise _requests_error(e, endpoint) from e
+        finally:
+            self.pool.release(endpoint, self.model_name, failed=failed)
+
+    def _post(self, payload, stream=False):
+        """POST payload to the least busy endpoint, retrying with backoff.
+
+        Returns (response, endpoint); the caller must release the endpoint.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._post_once(payload, stream)
+            except OllamaError as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    def _post_once(self, payload, stream):
+        endpoint, probe = self.pool.choose(self.model_name, self._held)
+        if probe and not self.pool.check(endpoint):
+            self.pool.release(endpoint, self.model_name, failed=None)
+            raise OllamaUnavailable(f"Ollama at {endpoint.base_url} failed its health check", endpoint.base_url)
+        try:
+            response = endpoint.session.post(
+                endpoint.generate_url, json=payload, stream=stream,
+                timeout=(self.timeout["connect"], self.timeout["read"])
+            )
+        except requests.RequestException as e:
+            self.pool.release(endpoint, self.model_name, failed=True)
+            raise _requests_error(e, endpoint) from e
+        if not response.ok:
+            error = _status_error(response.status_code, response.text, endpoint)
+            response.close()
+            self.pool.release(endpoint, self.model_name, failed=error.retryable)
+            raise error
+        return response, endpoint
+
+
+# asyncio version of OllamaRunner, sharing the same endpoint pool.
+# Use as "async with AsyncOllamaRunner(model) as runner:" to close its connections.
+class AsyncOllamaRunner(_OllamaClient):
+    def __init__(self, model_name="dummy", server_url=None, metrics=None, pool=None):
+        super().__init__(model_name, server_url, metrics, pool)
+        try:
+            import httpx
+        except ImportError as e:
+            raise ImportError("AsyncOllamaRunner requires httpx (pip install httpx)") from e
+        self._httpx = httpx
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout["read"], connect=self.timeout["connect"]),
+            limits=httpx.Limits(max_keepalive_connections=CONFIG["text_model"]["max_connections"])
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def generate(self, prompt: str) -> str:
+        return (await self.generate_with_context(prompt))[0]
+
+    async def generate_with_context(self, prompt: str, context: list[int] = None, format: str = None):
+        """Like OllamaRunner.generate_with_context."""
+        payload = self._build_payload(prompt, context, format, stream=False)
+
+        async def request_response():
+            response, endpoint = await self._post(payload)
+            try:
+                data = _check_body(response.json(), endpoint)
+            except ValueError as e:
+                raise OllamaError(f"Invalid response from Ollama at {endpoint.base_url}: {e}", endpoint.base_url)
+            finally:
+                self.pool.release(endpoint, self.model_name)
+            self._record_stats(data)
+            return _encode_result(data.get("response", ""), data.get("context"))
+
+        return _decode_result(await self._cached(payload, request_response))
+
+    async def generate_stream_with_context(self, prompt: str, on_token, context: list[int] = None):
+        """Like OllamaRunner.generate_stream_with_context; on_token is a plain callable."""
+        payload = self._build_payload(prompt, context, None, stream=True)
+        streamed = []
+
+        async def stream_response():
+            parts = []
+            final_context = None
+            response, endpoint = await self._post(payload, stream=True)
+            failed = False
+            try:
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    chunk = _check_body(json.loads(line), endpoint)
+                    if chunk.get("response"):
+                        parts.append(chunk["response"])
+                        on_token(chunk["response"])
+                    if chunk.get("done"):
+                        final_context = chunk.get("context")
+                        self._record_stats(dict(chunk, response="".join(parts)))
+            except self._httpx.HTTPError as e:
+                failed = True
+                raise self._httpx_error(e, endpoint) from e
+            finally:
+                await response.aclose()
+                self.pool.release(endpoint, self.model_name, failed=failed)
+            streamed.append(True)
+            return _encode_result("".join(parts), final_context)
+
+        text, final_context = _decode_result(await self._cached(payload, stream_response))
+        if not streamed:
+            on_token(text)  # a cached response arrives in one chunk
+        return text, final_context
+
+    # ContentCache.get_or_compute for a coroutine; waiting on another caller happens in a thread
+    async def _cached(self, payload, compute):
+        cache = get_cache("text")
+        if cache is None:
+            return await compute()
+        key = self._cache_key(dict(payload, stream=False))
+        while True:
+            state, value = cache.begin(key)
+            if state == "hit":
+                self._record_stats({"response": _decode_result(value)[0]}, cached=True)
+                return value
+            if state == "wait":
+                data = await asyncio.to_thread(cache.wait, key, value)
+                if data is not None:
+                    self._record_stats({"response": _decode_result(data)[0]}, cached=True)
+                    return data
+                continue
+            data = None
+            try:
+                data = await compute()
+                return data
+            finally:
+                cache.finish(key, data)
+
+    async def _post(self, payload, stream=False):
+        attempt = 0
+        while True:
+            try:
+                return await self._post_once(payload, stream)
+            except OllamaError as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _post_once(self, payload, stream):
+        endpoint, probe = await asyncio.to_thread(self.pool.choose, self.model_name, self._held)
+        if probe and not await self._check(endpoint):
+            self.pool.release(endpoint, self.model_name, failed=None)
+            raise OllamaUnavailable(f"Ollama at {endpoint.base_url} failed its health check", endpoint.base_url)
+        try:
+            request = self._client.build_request("POST", endpoint.generate_url, json=payload)
+            response = await self._client.send(request, stream=stream)
+            if not response.is_success:
+                body = (await response.aread()).decode("utf-8", "replace")
+                await response.aclose()
+                error = _status_error(response.status_code, body, endpoint)
+                self.pool.release(endpoint, self.model_name, failed=error.retryable)
+                raise error
+        except self._httpx.HTTPError as e:
+            self.pool.release(endpoint, self.model_name, failed=True)
+            raise self._httpx_error(e, endpoint) from e
+        return response, endpoint
+
+    async def _check(self, endpoint):
+        try:
+            response = await self._client.get(endpoint.health_url, timeout=self.pool.health_timeout)
+            healthy = response.is_success
+        except self._httpx.HTTPError:
+            healthy = False
+        if healthy:
+            self.pool.mark_up(endpoint)
+        else:
+            self.pool.mark_down(endpoint)
+        return healthy
+
+    def _httpx_error(self, error, endpoint):
+        if isinstance(error, self._httpx.TimeoutException):
+            return OllamaTimeout(f"Ollama at {endpoint.base_url} timed out: {error!r}", endpoint.base_url)
+        if isinstance(error, (self._httpx.ConnectError, self._httpx.NetworkError)):
+            return OllamaUnavailable(f"Cannot reach Ollama at {endpoint.base_url}: {error!r}", endpoint.base_url)
+        return OllamaError(f"Ollama request to {endpoint.base_url} failed: {error!r}", endpoint.base_url, retryable=True)
+
+
+# Cached responses are stored as JSON bytes of {"response": ..., "context": ...}
+def _encode_result(text, context):
+    return json.dumps({"response": text, "context": context}).encode("utf-8")
+
+def _decode_result(data):
+    result = json.loads(data)
+    return result["response"], result["context"]
@@ -0,0 +1,542 @@
+# pipeline_engine.py
+# Staged DreamSprout pipeline shared by the CLI and the web app.
+# Stages run as producers/consumers connected by queues:
+#   story -> split -> compress (producer thread) -> images (consumer) -> render
+# Each compressed scene is handed to the image stage as soon as it is ready,
+# so scene N can be denoising while scene N+1 is still being compressed.
+# The device slot is held per image batch, so the text stages of another
+# job can run while this one is on the GPU.
+# Every finished stage is checkpointed into the run folder (checkpoint.py);
+# running a pipeline on a checkpointed folder resumes after the last one.
+# Several pipelines can share one ImageBatcher, which renders their scene
+# prompts through a single image model in combined batches (comparison.py).
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import ExitStack, nullcontext
+
+from config import CONFIG
+from dreamsprout import (
+    build_image_prompt,
+    compress_scene_for_illustration,
+    generate_images,
+    generate_story_with_context,
+    plan_scenes_for_illustration,
+    split_scenes,
+)
+from html_renderer import STORYBOOK_TITLE, write_storybook
+from ollama_runner import OllamaRunner
+from image_writer import get_image_writer, variant_file, write_manifest
+from run_index import get_run_index
+from metrics import RunMetrics
+from job_scheduler import JobCancelled
+from checkpoint import RunCheckpoint
+from image_previews import get_preview_decoder, preview_data_uri
+
+_DONE = object()  # end-of-stream marker for stage queues
+
+
+class StoryPipeline:
+    def __init__(self, registry, text_model_name, on_progress=None, on_token=None,
+                 check_cancelled=None, device_slot=None, metrics=None, quality=None,
+                 image_batcher=None, add_to_gallery=True, on_preview=None):
+        """
+        registry: ModelRegistry that owns the models for this run.
+        metrics: RunMetrics to record spans into (one is created per run if omitted).
+        on_progress(fields): receives {"percent": ..., "stage": ...} updates.
+        on_token(text): receives story chunks as they stream in (optional).
+        check_cancelled(): raises to abort the run between stages (optional).
+        device_slot(): context manager held around GPU work (optional).
+        quality: QUALITY_PRESETS entry for the illustrations (config default if omitted).
+        image_batcher: shared ImageBatcher to render through instead of this run's own
+            image model (its quality applies; device_slot is then unused).
+        add_to_gallery: record the finished run in the gallery index.
+        on_preview(data): receives {"scene", "step", "steps", "image"} previews of scenes
+            while they denoise, image being a JPEG data URI (optional).
+        """
+        self.registry = registry
+        self.text_model_name = text_model_name
+        self.on_progress = on_progress or (lambda fields: None)
+        self.on_token = on_token
+        self.check_cancelled = check_cancelled or (lambda: None)
+        self.device_slot = device_slot or nullcontext
+        self.metrics = metrics
+        self.quality = quality
+        self.image_batcher = image_batcher
+        self.add_to_gallery = add_to_gallery
+        self.on_preview = on_preview
+        self.checkpoint = None
+
+    def run(self, dream_input: str, core_elements: list[str], output_dir: str, timestamp: str,
+            checkpoint: RunCheckpoint = None) -> dict:
+        """Run (or, given the run's checkpoint, resume) the pipeline into output_dir."""
+        os.makedirs(output_dir, exist_ok=True)
+        if self.metrics is None:
+            self.metrics = RunMetrics(os.path.basename(os.path.abspath(output_dir)))
+        if checkpoint is None:
+            checkpoint = RunCheckpoint.create(
+                output_dir, dream=dream_input, elements=core_elements, text_model=self.text_model_name,
+                quality=self.quality, timestamp=timestamp, image_model=CONFIG["image_model"]["model_id"]
+            )
+        else:
+            checkpoint.claim()
+        self.checkpoint = checkpoint
+        outcome = "failed"
+        error = None
+        try:
+            result = self._run_stages(dream_input, core_elements, output_dir, timestamp)
+            outcome = "done"
+            return result
+        except JobCancelled:
+            outcome = "cancelled"
+            raise
+        except BaseException as e:
+            error = str(e) or type(e).__name__
+            raise
+        finally:
+            # Timings go next to the storybook, whether or not the run finished
+            self.metrics.finish(outcome)
+            self.metrics.write(output_dir)
+            checkpoint.update(status=outcome, error=error)
+
+    def _progress(self, fields):
+        self.on_progress(fields)
+        self.checkpoint.update(progress=fields)
+
+    def _run_stages(self, dream_input, core_elements, output_dir, timestamp):
+        metrics = self.metrics
+        checkpoint = self.checkpoint
+
+        # Register Ollama text model
+        print("\n--- Registering Text Model ---")
+        ollama_runner = OllamaRunner(model_name=self.text_model_name, metrics=metrics)
+        self.registry.register_text_model(self.text_model_name, ollama_runner.generate)
+
+        # Keep the text model on one Ollama server until the scene prompts are
+        # planned, so another model can't take its slot between calls
+        text_hold = ExitStack()
+        try:
+            with metrics.span("text_model_wait"):
+                text_hold.enter_context(ollama_runner.hold())
+
+            # Generate story
+            story = checkpoint.get("story")
+            story_context = checkpoint.story_context()
+            if story is None:
+                print("\n--- Generating Story ---")
+                self._progress({"percent": 10, "stage": "Generating story..."})
+                with metrics.span("story"):
+                    story, story_context = generate_story_with_context(
+                        ollama_runner, dream_input, core_elements, on_token=self.on_token
+                    )
+                checkpoint.record_story(story, story_context)
+            else:
+                print("\n--- Resuming: story already written ---")
+                if self.on_token is not None:
+                    self.on_token(story)
+            self.check_cancelled()
+
+            # Split into scenes
+            scenes = checkpoint.get("scenes")
+            if scenes is None:
+                print("\n--- Splitting Scenes ---")
+                self._progress({"percent": 30, "stage": "Splitting scenes..."})
+                with metrics.span("split"):
+                    scenes = split_scenes(story, CONFIG["pipeline"]["scenes"])
+                checkpoint.update(stage="split", scenes=scenes)
+        except BaseException:
+            text_hold.close()
+            raise
+
+        # Compress scenes in a producer thread while the image stage consumes them
+        print("\n--- Compressing Scenes and Generating Images ---")
+        prompt_queue = queue.Queue()
+        stop_compress = threading.Event()
+        producer = threading.Thread(
+            target=self._compress_stage,
+            args=(ollama_runner, scenes, story_context, prompt_queue, text_hold, stop_compress),
+            name="dreamsprout-compress",
+            daemon=True
+        )
+        producer.start()
+        try:
+            prompts, image_paths, image_entries = self._image_stage(prompt_queue, len(scenes), output_dir)
+        finally:
+            # If the image stage failed or was cancelled, don't leave the producer calling Ollama
+            stop_compress.set()
+            producer.join()
+
+        # Render HTML
+        print("\n--- Rendering HTML ---")
+        checkpoint.update(stage="images")
+        self._progress({"percent": 90, "stage": "Rendering HTML..."})
+        with metrics.span("render"):
+            html_path = write_storybook(
+                output_dir,
+                title=STORYBOOK_TITLE,
+                story=story,
+                image_paths=image_paths,
+                text_model=self.text_model_name,
+                image_model=CONFIG["image_model"]["model_id"],
+                text_prompt=dream_input,
+                image_prompts=prompts,
+                timestamp=timestamp,
+                image_entries=image_entries
+            )
+
+        # Record the finished run in the gallery index
+        if self.add_to_gallery:
+            output_root = os.path.dirname(os.path.abspath(output_dir))
+            thumbnail = thumbnail_path(output_dir, image_entries)
+            get_run_index().add_run(
+                run_id=os.path.basename(os.path.abspath(output_dir)),
+                title=STORYBOOK_TITLE,
+                text_model=self.text_model_name,
+                image_model=CONFIG["image_model"]["name"],
+                dream=dream_input,
+                created_at=timestamp,
+                html_path=os.path.relpath(html_path, output_root),
+                thumbnail=os.path.relpath(thumbnail, output_root) if thumbnail else None
+            )
+
+        checkpoint.update(stage="render")
+        self._progress({"percent": 100, "stage": "Complete!", "done": True})
+        return {
+            "story": story, "scenes": scenes, "prompts": prompts, "images": image_paths,
+            "image_entries": image_entries, "html": html_path
+        }
+
+    # --- Stages ---
+    def _compress_stage(self, ollama_runner, scenes, story_context, out_queue, text_hold, stop):
+        """Producer: put (scene index, image prompt) items, then _DONE.
+
+        Prompts already in the checkpoint are put first; only the rest are planned.
+        text_hold (the text model's server hold) is released once planning ends.
+        Stops before the next Ollama call once stop is set.
+        """
+        try:
+            known = self.checkpoint.prompts()
+            for i in sorted(known):
+                out_queue.put((i, known[i]))
+            missing = [i for i in range(len(scenes)) if i not in known]
+            if not missing:
+                return
+
+            if CONFIG["pipeline"]["scene_planning"] == "batched":
+                # Paragraph numbers in a context-based plan only line up for the whole story
+                if not CONFIG["pipeline"]["reuse_story_context"] or len(missing) < len(scenes):
+                    story_context = None
+                with self.metrics.span("compress", scenes=len(missing)):
+                    compressed = plan_scenes_for_illustration([scenes[i] for i in missing], ollama_runner, story_context)
+                for i, summary in zip(missing, compressed):
+                    prompt = build_image_prompt(summary)
+                    self.checkpoint.record_prompt(i, prompt)
+                    out_queue.put((i, prompt))
+            else:
+                text_model_runner = self.registry.get_text_model(self.text_model_name)
+                for i in missing:
+                    if stop.is_set():
+                        return
+                    self.check_cancelled()
+                    with self.metrics.span("compress", scene=i + 1):
+                        summary = compress_scene_for_illustration(scenes[i], text_model_runner)
+                    prompt = build_image_prompt(summary)
+                    self.checkpoint.record_prompt(i, prompt)
+                    out_queue.put((i, prompt))
+        except BaseException as e:
+            out_queue.put(e)
+        finally:
+            text_hold.close()
+            out_queue.put(_DONE)
+
+    def _image_stage(self, in_queue, num_scenes, output_dir):
+        """Consumer: render whatever prompts are ready, up to one micro-batch at a time.
+
+        Finished images go to the background writer pool, so the next batch can
+        start denoising while the previous one is being encoded and saved.
+        Scenes whose images are already checkpointed are not rendered again, and
+        the image model is only registered once there is something to render.
+        """
+        saved = self.checkpoint.images()
+        writer = get_image_writer()
+        image_model = None
+        batch_size = 1
+        prompts = {}
+        entries = {scene: entry for scene, entry in saved.items() if scene <= num_scenes}
+        writes = []
+        pending = []
+        finished = False
+        while True:
+            # Block for at least one prompt, then take whatever else is already queued
+            if not pending and not finished:
+                finished = self._take(in_queue, pending, block=True)
+            while not finished and len(pending) < batch_size:
+                done = self._take(in_queue, pending, block=False)
+                if done is None:
+                    break
+                finished = done
+            for i, prompt in pending:
+                prompts[i] = prompt
+            pending = sorted((i, prompt) for i, prompt in pending if i + 1 not in entries)
+            if not pending:
+                if finished:
+                    break
+                continue
+
+            if image_model is None:
+                image_model = self._register_image_model()
+                batch_size = max(1, image_model.generation_config.get("batch_size", 1))
+
+            self.check_cancelled()
+            if self.image_batcher is not None:
+                # Seeds are passed per scene, and the batcher sizes the device batches
+                batch = pending
+            else:
+                # Seeds follow scene numbers, so a batch is a run of consecutive scenes
+                batch = pending[:1]
+                while len(batch) < min(batch_size, len(pending)) and pending[len(batch)][0] == batch[-1][0] + 1:
+                    batch.append(pending[len(batch)])
+            pending = pending[len(batch):]
+            first, last = batch[0][0], batch[-1][0]
+            batch_prompts = [prompt for _, prompt in batch]
+            self._progress({
+                "percent": 60 + int(30 * first / max(1, num_scenes)),
+                "stage": f"Creating illustrations ({first + 1}-{last + 1} of {num_scenes})..."
+            })
+            scene_range = f"{first + 1}-{last + 1}"
+            stage = f"Creating illustrations ({first + 1}-{last + 1} of {num_scenes})"
+            on_step = self._step_reporter(len(entries), num_scenes, stage)
+            if self.image_batcher is not None:
+                # Includes waiting for the shared batches these scenes are part of
+                with self.metrics.span("denoise", scenes=scene_range, shared=True):
+                    images = self.image_batcher.render(batch_prompts, [i for i, _ in batch], on_step)
+            else:
+                with ExitStack() as slot:
+                    with self.metrics.span("device_wait", scenes=scene_range):
+                        slot.enter_context(self.device_slot())
+                    with self.metrics.span("denoise", scenes=scene_range):
+                        images = generate_images(
+                            image_model, batch_prompts, batch_size=len(batch), first_scene=first,
+                            on_step=lambda positions, *step: on_step([batch[p][0] for p in positions], *step)
+                        )
+            for (i, _), img in zip(batch, images):
+                scene = i + 1
+                future = writer.submit(img, output_dir, scene)
+                future.add_done_callback(self._checkpoint_image)
+                writes.append(future)
+                entries[scene] = None
+
+        # Only the writes still outstanding after the last batch cost wall time here
+        with self.metrics.span("save", scenes=len(writes)):
+            for future in writes:
+                entry = future.result()
+                entries[entry["scene"]] = entry
+        image_entries = [entries[scene] for scene in sorted(entries)]
+        if image_entries:
+            write_manifest(image_entries, output_dir)
+        image_paths = [os.path.join(output_dir, entry["png"]) for entry in image_entries]
+        return [prompts[i] for i in sorted(prompts)], image_paths, image_entries
+
+    def _register_image_model(self):
+        if self.image_batcher is not None:
+            image_model = self.image_batcher.wait_ready()
+            self.metrics.record("image_quality", self.image_batcher.quality_summary())
+            return image_model
+        print("\n--- Registering Image Model ---")
+        with self.metrics.span("model_load"):
+            self.registry.register_image_model(
+                CONFIG["image_model"]["name"],
+                CONFIG["image_model"]["model_id"],
+                CONFIG["image_model"]["parameters"],
+                quality=self.quality
+            )
+        image_model = self.registry.get_image_model(CONFIG["image_model"]["name"])
+        gen = image_model.generation_config
+        self.metrics.record("image_quality", {
+            "quality": gen["quality"], "sampler": gen["sampler"], "steps": gen["num_inference_steps"]
+        })
+        return image_model
+
+    def _step_reporter(self, done, num_scenes, stage):
+        """on_step(scenes, step, steps, latents) for one render call, after done scenes.
+
+        Publishes per-step progress (at most every step_progress_interval seconds)
+        and, every few steps, a preview of each scene being denoised.
+        """
+        interval = CONFIG["images"]["step_progress_interval"]
+        every = CONFIG["images"]["previews"]["every_steps"]
+        previews = get_preview_decoder() if self.on_preview is not None else None
+        state = {"last": 0.0, "previews": previews}
+
+        def on_step(scenes, step, steps, latents):
+            now = time.monotonic()
+            if step == steps or now - state["last"] >= interval:
+                state["last"] = now
+                self.on_progress({
+                    "percent": 60 + int(30 * (done + len(scenes) * step / steps) / max(1, num_scenes)),
+                    "stage": f"{stage}: step {step} of {steps}..."
+                })
+            decoder = state["previews"]
+            if decoder is None or latents is None or step % every or step == steps:
+                return
+            try:
+                images = decoder.decode(latents)
+            except Exception as e:
+                print(f"Disabling previews for this batch: {e}")
+                state["previews"] = None
+                return
+            for scene, img in zip(scenes, images):
+                self.on_preview({"scene": scene + 1, "step": step, "steps": steps, "image": preview_data_uri(img)})
+
+        return on_step
+
+    def _checkpoint_image(self, future):
+        # Runs on the writer thread once a scene's files are on disk
+        if future.exception() is None:
+            self.checkpoint.record_image(future.result())
+
+    @staticmethod
+    def _take(in_queue, pending, block):
+        """Move one item from the queue to pending.
+
+        Returns True at end of stream, False after taking an item, or None if
+        nothing was ready (non-blocking only).
+        """
+        try:
+            item = in_queue.get(block=block)
+        except queue.Empty:
+            return None
+        if isinstance(item, BaseException):
+            raise item
+        if item is _DONE:
+            return True
+        pending.append(item)
+        return False
+
+
+
+# Path of a run's gallery thumbnail (first scene's thumb variant), or None
+def thumbnail_path(output_dir: str, image_entries: list[dict]):
+    if not image_entries:
+        return None
+    thumb_name = variant_file(image_entries[0], "thumb", CONFIG["images"]["formats"][0])
+    return os.path.join(output_dir, thumb_name or image_entries[0]["png"])
+
+
+class ImageBatcher:
+    """Renders scene prompts from several pipelines through one image model.
+
+    Prompts queued by any pipeline are combined into batches of the model's
+    batch size, one batch at a time under the device slot. The model is loaded
+    on the batcher's thread as soon as it starts, while the text stages run.
+    """
+
+    def __init__(self, load_model, device_slot=None, metrics=None):
+        """
+        load_model(): returns the registered image model (called once, on the batcher thread).
+        device_slot(): context manager held around each batch (optional).
+        metrics: RunMetrics that receives a span per shared batch (optional).
+        """
+        self.load_model = load_model
+        self.device_slot = device_slot or nullcontext
+        self.metrics = metrics
+        self.image_model = None
+        self.batches = []  # scenes per batch, for reporting
+        self._error = None
+        self._ready = threading.Event()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="dreamsprout-image-batcher", daemon=True)
+        self._thread.start()
+
+    def wait_ready(self):
+        """The loaded image model; raises if loading failed."""
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self.image_model
+
+    def quality_summary(self) -> dict:
+        gen = self.wait_ready().generation_config
+        return {"quality": gen["quality"], "sampler": gen["sampler"], "steps": gen["num_inference_steps"]}
+
+    def render(self, prompts: list[str], scenes: list[int], on_step=None) -> list:
+        """Render prompts (0-based scene indices give the seeds); blocks until done.
+
+        on_step(scenes, step, steps, latents) gets the denoising steps of these
+        scenes, with latents reduced to their rows (optional).
+        """
+        futures = []
+        for prompt, scene in zip(prompts, scenes):
+            future = Future()
+            self._queue.put((prompt, scene, future, on_step))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def close(self):
+        """Stop the batcher thread once everything queued is rendered."""
+        self._queue.put(_DONE)
+        self._thread.join()
+
+    def _run(self):
+        try:
+            self.image_model = self.load_model()
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._ready.set()
+
+        finished = False
+        while not finished:
+            item = self._queue.get()
+            if item is _DONE:
+                break
+            batch = [item]
+            batch_size = 1
+            if self.image_model is not None:
+                batch_size = max(1, self.image_model.generation_config.get("batch_size", 1))
+            while len(batch) < batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    finished = True
+                    break
+                batch.append(item)
+            self._render_batch(batch)
+
+    def _render_batch(self, batch):
+        if self._error is not None:
+            for _, _, future, _ in batch:
+                future.set_exception(self._error)
+            return
+        prompts = [prompt for prompt, _, _, _ in batch]
+        scenes = [scene for _, scene, _, _ in batch]
+
+        # Hand each caller the steps of its own scenes
+        def on_step(positions, step, steps, latents):
+            handlers = {}
+            for row, position in enumerate(positions):
+                handler = batch[position][3]
+                if handler is not None:
+                    handlers.setdefault(handler, []).append((row, position))
+            for handler, rows in handlers.items():
+                own_latents = latents[[row for row, _ in rows]] if latents is not None else None
+                handler([batch[position][1] for _, position in rows], step, steps, own_latents)
+
+        try:
+            with ExitStack() as stack:
+                stack.enter_context(self.device_slot())
+                if self.metrics is not None:
+                    stack.enter_context(self.metrics.span("denoise", scenes=len(batch)))
+                images = generate_images(self.image_model, prompts, batch_size=len(batch), scenes=scenes, on_step=on_step)
+        except BaseException as e:
+            for _, _, future, _ in batch:
+                future.set_exception(e)
+            return
+        self.batches.append(len(batch))
+        for (_, _, future, _), img in zip(batch, images):
+            future.set_result(img)
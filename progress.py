@@ -0,0 +1,119 @@
+# progress.py
+# Per-run progress state and event log for the web app.
+# Pipeline code updates a run's progress; /status reads the latest snapshot
+# and /stream/<run_id> follows the event log to push updates to the browser.
+# Only the latest progress snapshot (and the latest preview per scene) is
+# kept in the event log; superseded events are removed, so per-step updates
+# don't grow it without bound.
+# Finished runs are dropped from memory after a TTL; their last progress is
+# still available from the checkpoint in the run folder (see checkpoint.py).
+
+import bisect
+import threading
+import time
+
+
+class RunProgress:
+    def __init__(self, **initial):
+        self._state = {"percent": 0, "stage": "Starting...", "done": False}
+        self._state.update(initial)
+        self._events = []  # (sequence number, event name, data) in publish order, superseded ones removed
+        self._next_seq = 0  # sequence number of the next event; cursors count published events
+        self._latest = {}  # (event name, key) -> sequence number of its latest event
+        self._cond = threading.Condition()
+        self.finished_at = None  # time.monotonic() when the run finished
+
+    def update(self, fields: dict):
+        """Merge fields into the state and publish it as a progress event."""
+        with self._cond:
+            self._state.update(fields)
+            self._append("progress", dict(self._state), key=None)
+            if self.finished_at is None and self._is_finished():
+                self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def publish(self, event: str, data, key=None):
+        """Publish a non-state event, e.g. a chunk of story text.
+
+        With a key, the event supersedes the previous one of the same name
+        and key, e.g. the newest preview of a scene replaces the older ones.
+        """
+        with self._cond:
+            if key is None:
+                self._push(event, data)
+            else:
+                self._append(event, data, key)
+            self._cond.notify_all()
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return dict(self._state)
+
+    def wait_for_events(self, cursor: int, timeout: float):
+        """Return (events after cursor, new cursor), waiting up to timeout for new ones."""
+        with self._cond:
+            if cursor >= self._next_seq:
+                self._cond.wait(timeout)
+            start = bisect.bisect_left(self._events, (cursor,))
+            return [(event, data) for _, event, data in self._events[start:]], self._next_seq
+
+    @property
+    def finished(self) -> bool:
+        with self._cond:
+            return self._is_finished()
+
+    def _append(self, event, data, key):
+        # Caller holds the lock; removes the event this one supersedes
+        previous = self._latest.get((event, key))
+        if previous is not None:
+            del self._events[bisect.bisect_left(self._events, (previous,))]
+        self._latest[(event, key)] = self._push(event, data)
+
+    def _push(self, event, data):
+        # Caller holds the lock
+        seq = self._next_seq
+        self._next_seq += 1
+        self._events.append((seq, event, data))
+        return seq
+
+    def _is_finished(self):
+        # Caller holds the lock
+        return bool(self._state.get("done")) or self._state.get("state") in ("failed", "cancelled")
+
+
+class ProgressTracker:
+    def __init__(self, ttl_seconds: float = 600):
+        self.ttl_seconds = ttl_seconds
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def create(self, run_id: str, **initial) -> RunProgress:
+        with self._lock:
+            self._evict_expired()
+            progress = self._runs[run_id] = RunProgress(**initial)
+            return progress
+
+    def get(self, run_id: str):
+        with self._lock:
+            self._evict_expired()
+            return self._runs.get(run_id)
+
+    def pop(self, run_id: str):
+        with self._lock:
+            return self._runs.pop(run_id, None)
+
+    def __getitem__(self, run_id: str) -> RunProgress:
+        return self._runs[run_id]
+
+    def __contains__(self, run_id: str) -> bool:
+        return run_id in self._runs
+
+    def _evict_expired(self):
+        # Caller holds the lock
+        now = time.monotonic()
+        expired = [
+            run_id for run_id, progress in self._runs.items()
+            if progress.finished_at is not None and now - progress.finished_at > self.ttl_seconds
+        ]
+        for run_id in expired:
+            del self._runs[run_id]
@@ -0,0 +1,120 @@
+# run_index.py
+# Persistent index of completed DreamSprout runs, stored in SQLite.
+# Runs are added incrementally as they complete, so the gallery can list,
+# sort, filter and paginate without scanning the outputs directory.
+
+import os
+import sqlite3
+import threading
+
+from config import CONFIG
+
+SORT_COLUMNS = {"created": "created_at", "model": "text_model", "name": "run_id"}
+
+
+class RunIndex:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    run_id TEXT PRIMARY KEY,
+                    title TEXT NOT NULL,
+                    text_model TEXT,
+                    image_model TEXT,
+                    dream TEXT,
+                    created_at TEXT NOT NULL,
+                    html_path TEXT NOT NULL,
+                    thumbnail TEXT
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS runs_created ON runs (created_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS runs_model ON runs (text_model, created_at)")
+
+    def add_run(self, run_id: str, title: str, text_model: str, image_model: str, dream: str,
+                created_at: str, html_path: str, thumbnail: str = None):
+        """Insert or replace one run. Paths are relative to the output root."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, title, text_model, image_model, dream, created_at, html_path, thumbnail)
+            )
+
+    def list_runs(self, page: int = 1, per_page: int = 24, sort: str = "created",
+                  descending: bool = True, text_model: str = None, query: str = None):
+        """Return (runs on this page, total matching runs)."""
+        where, params = [], []
+        if text_model:
+            where.append("text_model = ?")
+            params.append(text_model)
+        if query:
+            where.append("(dream LIKE ? OR title LIKE ?)")
+            params += [f"%{query}%", f"%{query}%"]
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+        order_sql = f"{SORT_COLUMNS.get(sort, 'created_at')} {'DESC' if descending else 'ASC'}, run_id"
+        offset = (max(1, page) - 1) * per_page
+
+        with self._lock:
+            total = self._conn.execute(f"SELECT COUNT(*) FROM runs {where_sql}", params).fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT * FROM runs {where_sql} ORDER BY {order_sql} LIMIT ? OFFSET ?",
+                params + [per_page, offset]
+            ).fetchall()
+        return [dict(row) for row in rows], total
+
+    def all_runs(self):
+        return self.list_runs(page=1, per_page=-1)[0]
+
+    def text_models(self) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT text_model FROM runs WHERE text_model IS NOT NULL ORDER BY 1").fetchall()
+        return [row[0] for row in rows]
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM runs LIMIT 1").fetchone() is None
+
+    def rebuild_from_disk(self, output_root: str) -> int:
+        """Index run folders that already exist on disk (one-time backfill)."""
+        count = 0
+        for folder in sorted(os.listdir(output_root)):
+            run_path = os.path.join(output_root, folder)
+            if not os.path.isfile(os.path.join(run_path, "storybook.html")):
+                continue
+            files = sorted(os.listdir(run_path))
+            # Prefer a thumbnail variant; older runs only have full-size PNGs
+            thumbnail = next((f"{folder}/{f}" for f in files if f.startswith("scene_") and f.endswith("_thumb.webp")), None)
+            thumbnail = thumbnail or next((f"{folder}/{f}" for f in files if f.startswith("scene_") and f.endswith(".png")), None)
+            created_at = folder[len("run_"):] if folder.startswith("run_") else ""
+            self.add_run(folder, "My Dream Story", None, None, None, created_at, f"{folder}/storybook.html", thumbnail)
+            count += 1
+        return count
+
+
+_index = None
+_index_lock = threading.Lock()
+
+# Shared run index for this process
+def get_run_index() -> RunIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = RunIndex(CONFIG["gallery"]["index_path"])
+        return _index
+
+
+# Regenerate the static outputs/index.html listing from the run index
+def write_static_index(run_index: RunIndex, output_root: str):
+    lines = ["<h1>DreamSprout Runs</h1>", "<ul>"]
+    for run in run_index.all_runs():
+        lines.append(f"<li><a href='{run['html_path']}'>{run['run_id']}</a></li>")
+    lines.append("</ul>")
+    index_path = os.path.join(output_root, "index.html")
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, index_path)